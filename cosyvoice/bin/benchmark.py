@@ -0,0 +1,251 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""End to end inference benchmark of scaled-down CosyVoice1/2/3 with random weights, runs on cpu without pretrained models.
+
+model inputs are random tokens and features, so text frontend and prompt extraction are not measured.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import resource
+import tempfile
+from contextlib import contextmanager
+logging.getLogger('matplotlib').setLevel(logging.WARNING)
+import torch
+from hyperpyyaml import load_hyperpyyaml
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.model import CosyVoiceModel, CosyVoice2Model, CosyVoice3Model, SESSION_CACHES, SessionReaped
+from cosyvoice.utils.common import set_all_random_seed
+from cosyvoice.utils.metrics import PrometheusMetrics, set_metrics
+from cosyvoice.utils.profiler import ChromeTraceProfiler, TorchProfiler, set_profiler
+
+# text vocab of the tiny qwen2 llm of CosyVoice2/3
+QWEN_VOCAB_SIZE = 1024
+
+TINY_ENCODER = {'output_size': 64, 'attention_heads': 2, 'linear_units': 128, 'num_blocks': 1}
+TINY_HIFT = {'base_channels': 32, 'f0_predictor': {'cond_channels': 32}}
+
+# model: (yaml under examples/libritts, model class, overrides of the shipped yaml)
+MODELS = {
+    'cosyvoice': ('cosyvoice/conf/cosyvoice.yaml', CosyVoiceModel, {
+        'text_encoder_input_size': 64, 'llm_input_size': 64, 'llm_output_size': 64,
+        'llm': {'text_encoder': TINY_ENCODER, 'llm': dict(TINY_ENCODER, num_blocks=2)},
+        'flow': {'input_size': 64, 'encoder': dict(TINY_ENCODER, input_size=64),
+                 'decoder': {'estimator': {'channels': [64], 'attention_head_dim': 32, 'n_blocks': 1, 'num_mid_blocks': 1, 'num_heads': 2}}},
+        'hift': TINY_HIFT}),
+    'cosyvoice2': ('cosyvoice2/conf/cosyvoice2.yaml', CosyVoice2Model, {
+        'llm_input_size': 64, 'llm_output_size': 64,
+        # NOTE pre lookahead and upsample layers of UpsampleConformerEncoder are built with 512 channels
+        'flow': {'encoder': {'attention_heads': 2, 'linear_units': 128, 'num_blocks': 1},
+                 'decoder': {'estimator': {'channels': [64], 'attention_head_dim': 32, 'n_blocks': 1, 'num_mid_blocks': 1, 'num_heads': 2}}},
+        'hift': TINY_HIFT}),
+    'cosyvoice3': ('cosyvoice3/conf/cosyvoice3.yaml', CosyVoice3Model, {
+        'llm_input_size': 64, 'llm_output_size': 64,
+        'flow': {'pre_lookahead_layer': {'channels': 64}, 'decoder': {'estimator': {'dim': 64, 'depth': 2, 'heads': 2, 'dim_head': 32}}},
+        'hift': TINY_HIFT}),
+}
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='benchmark tiny random weight models')
+    parser.add_argument('--models', nargs='+', default=list(MODELS.keys()), choices=list(MODELS.keys()),
+                        help='peak rss is a process high-water mark, benchmark one model per run to compare it')
+    parser.add_argument('--modes', nargs='+', default=['sft', 'zero_shot'], choices=['sft', 'zero_shot'])
+    parser.add_argument('--stream', nargs='+', default=['false', 'true'], choices=['false', 'true'])
+    parser.add_argument('--text_len', type=int, default=16, help='text tokens, speech tokens are at most 20 times of it')
+    parser.add_argument('--prompt_len', type=int, default=75, help='prompt speech tokens of zero_shot mode')
+    parser.add_argument('--num_runs', type=int, default=3, help='timed runs after one warmup run')
+    parser.add_argument('--num_threads', type=int, default=0, help='torch threads, 0 means torch default')
+    parser.add_argument('--seed', type=int, default=1986)
+    parser.add_argument('--skip_check_sessions', action='store_true', help='skip checking that session memory is released after cancelled and abandoned streams')
+    parser.add_argument('--output', type=str, default='', help='json file of results, empty means stdout')
+    parser.add_argument('--trace_dir', type=str, default='', help='write a trace of timed runs of every model/mode/stream, empty means disabled')
+    parser.add_argument('--trace_format', type=str, default='chrome', choices=['chrome', 'torch'],
+                        help='chrome records profiler spans only, torch runs torch.profiler with spans as record_function ranges')
+    args = parser.parse_args()
+    return args
+
+
+def tiny_qwen(path):
+    """Save a random 2-layer qwen2 as qwen_pretrain_path, Qwen2Encoder loads it by from_pretrained."""
+    from transformers import Qwen2Config, Qwen2ForCausalLM
+    config = Qwen2Config(vocab_size=QWEN_VOCAB_SIZE, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                         num_attention_heads=2, num_key_value_heads=1, max_position_embeddings=4096)
+    Qwen2ForCausalLM(config).save_pretrained(path)
+
+
+def build_model(name, qwen_path):
+    yaml_path, model_cls, overrides = MODELS[name]
+    if name != 'cosyvoice':
+        overrides = dict(overrides, qwen_pretrain_path=qwen_path)
+    with open(os.path.join(ROOT_DIR, '../../examples/libritts', yaml_path), 'r') as f:
+        configs = load_hyperpyyaml(f, overrides=overrides)
+    model = model_cls(configs['llm'], configs['flow'], configs['hift'])
+    for module in [model.llm, model.flow, model.hift]:
+        module.to(model.device).eval()
+    return model, configs['sample_rate']
+
+
+def model_input(model, mode, args):
+    """Random tokens and features in the layout of CosyVoiceFrontEnd outputs."""
+    text_vocab = QWEN_VOCAB_SIZE if isinstance(model, CosyVoice2Model) else model.llm.text_embedding.num_embeddings
+    embedding = torch.nn.functional.normalize(torch.randn(1, 192), dim=1)
+    inputs = {'text': torch.randint(0, text_vocab, (1, args.text_len), dtype=torch.int32), 'llm_embedding': embedding, 'flow_embedding': embedding}
+    if mode == 'zero_shot':
+        prompt_token = torch.randint(0, model.llm.speech_token_size, (1, args.prompt_len), dtype=torch.int32)
+        if isinstance(model, CosyVoice2Model):
+            prompt_feat_len = args.prompt_len * model.flow.token_mel_ratio
+        else:
+            prompt_feat_len = int(args.prompt_len / model.flow.input_frame_rate * 22050 / 256)
+        inputs.update({'prompt_text': torch.randint(0, text_vocab, (1, 8), dtype=torch.int32), 'llm_prompt_speech_token': prompt_token,
+                       'flow_prompt_speech_token': prompt_token, 'prompt_speech_feat': torch.randn(1, prompt_feat_len, 80)})
+    return inputs
+
+
+def run(model, sample_rate, inputs, stream):
+    start_time = time.perf_counter()
+    first_chunk, speech_len = None, 0
+    for model_output in model.tts(**inputs, stream=stream):
+        if first_chunk is None:
+            first_chunk = time.perf_counter() - start_time
+        speech_len += model_output['tts_speech'].shape[1]
+    return time.perf_counter() - start_time, first_chunk, speech_len / sample_rate
+
+
+@contextmanager
+def trace(profiler, args, name):
+    """Trace the with block as request name, torch format exports a torch.profiler trace to trace_dir/name.json."""
+    if profiler is None:
+        yield
+        return
+    with profiler.request(name, sampled=True):
+        if args.trace_format == 'chrome':
+            yield
+            return
+        with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU] +
+                                    ([torch.profiler.ProfilerActivity.CUDA] if torch.cuda.is_available() else [])) as prof:
+            yield
+        prof.export_chrome_trace(os.path.join(args.trace_dir, '{}.json'.format(name)))
+
+
+def check_sessions(model, args):
+    """Assert session memory returns to baseline after a stream is cancelled by its consumer and after an abandoned stream is reaped.
+
+    runs on its own zero_shot inputs, and a reaped stream must raise SessionReaped when its consumer comes back.
+    """
+    inputs = model_input(model, 'zero_shot', args)
+    assert model.session_stats()['sessions'] == 0
+    model_output = model.tts(**inputs, stream=True)
+    next(model_output)
+    stats = model.session_stats()
+    assert stats['sessions'] == 1 and sum(stats['bytes'].values()) > 0, stats
+    model_output.close()
+    assert model.session_stats() == {'sessions': 0, 'oldest_seconds': 0.0, 'bytes': {}, 'per_session': {}}
+    # consumer keeps the generator but never asks for the next chunk
+    abandoned = model.tts(**inputs, stream=True)
+    next(abandoned)
+    assert len(model.reap_sessions(0)) == 1 and model.session_stats()['sessions'] == 0
+    assert all([len(getattr(model, '{}_dict'.format(k), {})) == 0 for k in SESSION_CACHES + ['llm_end']])
+    try:
+        next(abandoned)
+        raise RuntimeError('reaped session should not be resumed')
+    except SessionReaped:
+        pass
+    assert model.session_stats()['sessions'] == 0
+    return True
+
+
+def mean(histogram):
+    return histogram['sum'] / histogram['count'] if histogram['count'] != 0 else 0.0
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    profiler = None
+    if args.trace_dir != '':
+        # NOTE warmup runs are outside of requests, so only timed runs are traced
+        if args.trace_format == 'chrome':
+            profiler = ChromeTraceProfiler(outside_requests=False, trace_dir=args.trace_dir)
+        else:
+            profiler = TorchProfiler(outside_requests=False)
+            os.makedirs(args.trace_dir, exist_ok=True)
+        set_profiler(profiler)
+    results = []
+    with tempfile.TemporaryDirectory() as qwen_path:
+        tiny_qwen(qwen_path)
+        for name in args.models:
+            set_all_random_seed(args.seed)
+            start_time = time.perf_counter()
+            model, sample_rate = build_model(name, qwen_path)
+            load_time = time.perf_counter() - start_time
+            params = {k: sum([p.numel() for p in getattr(model, k).parameters()]) for k in ['llm', 'flow', 'hift']}
+            if args.skip_check_sessions is False:
+                # NOTE before timed runs, so the extra requests are not measured
+                set_all_random_seed(args.seed)
+                check_sessions(model, args)
+                logging.info('{} sessions are released after cancelled and abandoned streams'.format(name))
+            for mode in args.modes:
+                for stream in args.stream:
+                    stream = stream == 'true'
+                    set_all_random_seed(args.seed)
+                    inputs = model_input(model, mode, args)
+                    run(model, sample_rate, inputs, stream)
+                    metrics = PrometheusMetrics()
+                    set_metrics(metrics)
+                    costs, first_chunks, speech_lens = [], [], []
+                    trace_name = '{}_{}_stream{}'.format(name, mode, stream)
+                    with trace(profiler, args, trace_name):
+                        for i in range(args.num_runs):
+                            set_all_random_seed(args.seed + i)
+                            cost, first_chunk, speech_len = run(model, sample_rate, inputs, stream)
+                            costs.append(cost)
+                            first_chunks.append(first_chunk)
+                            speech_lens.append(speech_len)
+                    values = metrics.values
+                    result = {'model': name, 'mode': mode, 'stream': stream, 'device': str(model.device), 'num_threads': torch.get_num_threads(),
+                              'params': params, 'load_seconds': load_time, 'num_runs': args.num_runs,
+                              'rtf': sum(costs) / sum(speech_lens), 'first_chunk_seconds': sum(first_chunks) / len(first_chunks),
+                              'speech_seconds': sum(speech_lens) / len(speech_lens), 'seconds': sum(costs) / len(costs),
+                              'llm_tokens': values['llm_tokens_total'] / args.num_runs,
+                              'llm_tokens_per_second': mean(values['llm_tokens_per_second']),
+                              'llm_first_token_seconds': mean(values['llm_first_token_seconds']),
+                              # per-stage seconds of a request, llm runs in its own thread concurrently with flow/hift
+                              'flow_seconds': values['flow_chunk_seconds']['sum'] / args.num_runs,
+                              'hift_seconds': values['hift_chunk_seconds']['sum'] / args.num_runs,
+                              'flow_chunks': values['flow_chunk_seconds']['count'] / args.num_runs,
+                              'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                              'sessions_checked': not args.skip_check_sessions}
+                    logging.info('{} {} stream {} rtf {:.3f} first chunk {:.3f}s speech {:.2f}s llm {:.1f} tokens/s flow {:.3f}s hift {:.3f}s'.format(
+                        name, mode, stream, result['rtf'], result['first_chunk_seconds'], result['speech_seconds'],
+                        result['llm_tokens_per_second'], result['flow_seconds'], result['hift_seconds']))
+                    results.append(result)
+            del model
+    if args.output != '':
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
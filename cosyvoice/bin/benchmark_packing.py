@@ -0,0 +1,137 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Padded against packed llm training of scaled-down CosyVoice2/3 with random weights, runs on cpu without pretrained models.
+
+batches of random utts go through processor.padding with pack_length 0 and --pack_length, loss and acc of both must match up to float error,
+then forward and backward of both are timed in real lm tokens/s, which excludes padding.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import logging
+import tempfile
+logging.getLogger('matplotlib').setLevel(logging.WARNING)
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.bin.benchmark import QWEN_VOCAB_SIZE, tiny_qwen, build_model
+from cosyvoice.dataset.processor import padding
+from cosyvoice.utils.common import set_all_random_seed
+
+MODELS = ['cosyvoice2', 'cosyvoice3']
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='padded against packed llm training of tiny random weight models')
+    parser.add_argument('--models', nargs='+', default=MODELS, choices=MODELS)
+    parser.add_argument('--batch_size', type=int, default=32, help='utts per batch')
+    parser.add_argument('--num_batches', type=int, default=4, help='timed batches after one warmup batch')
+    parser.add_argument('--max_speech_len', type=int, default=500, help='speech tokens of the longest utt, most utts are much shorter')
+    parser.add_argument('--pack_length', type=int, default=0, help='pack_length of padding, 0 means lm input length of the longest utt')
+    parser.add_argument('--num_threads', type=int, default=0, help='torch threads, 0 means torch default')
+    parser.add_argument('--seed', type=int, default=1986)
+    parser.add_argument('--tolerance', type=float, default=1e-4, help='allowed abs difference of loss and acc')
+    parser.add_argument('--output', type=str, default='', help='json file of results, empty means stdout')
+    args = parser.parse_args()
+    return args
+
+
+def random_batch(speech_token_size, args):
+    """Utts in the layout of processor.padding inputs, speech lengths are long tailed like real corpora."""
+    sample = []
+    for i in range(args.batch_size):
+        speech_len = min(max(int(random.lognormvariate(4.5, 0.8)), 10), args.max_speech_len)
+        text_len = max(speech_len // 8 + random.randint(-3, 3), 1)
+        sample.append({'utt': 'utt{}'.format(i), 'text': '', 'text_token': torch.randint(0, QWEN_VOCAB_SIZE, (text_len,)).tolist(),
+                       'speech_token': torch.randint(0, speech_token_size, (speech_len,)).tolist(), 'speech_feat': torch.zeros(speech_len * 2, 80),
+                       'speech': torch.zeros(1, 1), 'instruct_token': [], 'utt_embedding': torch.zeros(192), 'spk_embedding': torch.zeros(192)})
+    return sample
+
+
+def step(llm, batch, seed, backward):
+    """Loss and acc of batch, bistream choices of prepare_lm_input_target depend on seed."""
+    random.seed(seed)
+    llm.zero_grad()
+    result = llm(batch, torch.device('cpu'))
+    if backward is True:
+        result['loss'].backward()
+    return result['loss'].item(), result['acc'].item()
+
+
+def run(name, llm, args):
+    set_all_random_seed(args.seed)
+    samples = [random_batch(llm.speech_token_size, args) for _ in range(args.num_batches + 1)]
+    lengths = [[len(i['text_token']) + len(i['speech_token']) + 2 for i in sample] for sample in samples]
+    pack_length = args.pack_length if args.pack_length != 0 else max([max(i) for i in lengths])
+    padded = list(padding(iter(samples), use_spk_embedding=False))
+    packed = list(padding(iter(samples), use_spk_embedding=False, pack_length=pack_length))
+    packed_rows = [int(i['pack_row'].max().item()) + 1 for i in packed]
+    result = {'model': name, 'pack_length': pack_length, 'tokens': sum([sum(i) for i in lengths[1:]]),
+              'padded_rows': args.batch_size, 'packed_rows': sum(packed_rows[1:]) / args.num_batches,
+              'padded_efficiency': sum([sum(i) for i in lengths]) / sum([max(i) * len(i) for i in lengths]),
+              'packed_efficiency': sum([sum(i) for i in lengths]) / sum([n * pack_length for n in packed_rows])}
+    # llm has no dropout, so train mode gives the same loss for both layouts
+    llm.train()
+    errors = {'loss': 0.0, 'acc': 0.0}
+    for i in range(len(samples)):
+        padded_loss, padded_acc = step(llm, padded[i], args.seed + i, False)
+        packed_loss, packed_acc = step(llm, packed[i], args.seed + i, False)
+        errors['loss'] = max(errors['loss'], abs(padded_loss - packed_loss))
+        errors['acc'] = max(errors['acc'], abs(padded_acc - packed_acc))
+    result.update({'max_loss_error': errors['loss'], 'max_acc_error': errors['acc']})
+    for path, batches in [('padded', padded), ('packed', packed)]:
+        step(llm, batches[0], args.seed, True)
+        start_time = time.perf_counter()
+        for i in range(1, len(batches)):
+            step(llm, batches[i], args.seed + i, True)
+        result['{}_tokens_per_second'.format(path)] = result['tokens'] / (time.perf_counter() - start_time)
+    result['speedup'] = result['packed_tokens_per_second'] / result['padded_tokens_per_second']
+    return result
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    results, failed = [], False
+    with tempfile.TemporaryDirectory() as qwen_path:
+        tiny_qwen(qwen_path)
+        for name in args.models:
+            set_all_random_seed(args.seed)
+            model, _ = build_model(name, qwen_path)
+            result = run(name, model.llm, args)
+            failed = failed or result['max_loss_error'] > args.tolerance or result['max_acc_error'] > args.tolerance
+            logging.info('{} {} rows packed into {:.1f}, efficiency {:.2%} -> {:.2%}, max loss error {:.2e} acc error {:.2e}, '
+                         'tokens/s padded {:.0f} packed {:.0f} ({:.2f}x)'.format(
+                             name, result['padded_rows'], result['packed_rows'], result['padded_efficiency'], result['packed_efficiency'],
+                             result['max_loss_error'], result['max_acc_error'], result['padded_tokens_per_second'],
+                             result['packed_tokens_per_second'], result['speedup']))
+            results.append(result)
+            del model
+    if args.output != '':
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+    sys.exit(1 if failed is True else 0)
+
+
+if __name__ == '__main__':
+    main()
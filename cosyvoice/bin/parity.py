@@ -0,0 +1,185 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Streaming/offline parity and performance regression check of scaled-down CosyVoice1/2/3 with random weights.
+
+tts(stream=True) and tts(stream=False) run on the same inputs, the vc path skips llm and feeds fixed random speech tokens to flow,
+the llm path samples speech tokens from text with seeded tts sessions, so both runs sample the same tokens although stream llm runs in its own thread.
+concatenated stream chunks are compared with offline speech by max abs error and log spectral distance around every chunk boundary.
+exit code is 1 if any model exceeds the tolerance of its family, or exceeds --baseline errors by more than --error_tolerance,
+or is slower than --baseline by more than --time_tolerance.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import tempfile
+logging.getLogger('matplotlib').setLevel(logging.WARNING)
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.bin.benchmark import MODELS, tiny_qwen, build_model, model_input
+from cosyvoice.cli.model import seeded
+from cosyvoice.utils.common import set_all_random_seed
+
+# model and path: max abs error of whole speech and max log spectral distance (dB) around chunk boundaries between stream and offline speech,
+# calibrated by default args with seeds 1986-1995, about 1.3x of max abs error and max + 1dB of boundary lsd, above mean + 5 std of both,
+# CosyVoice3 errors are float noise, so 3x of both. NOTE CosyVoice1 draws new flow noise for every chunk and fades overlapping mel,
+# CosyVoice2 cross-fades hift output with its source cache, so only CosyVoice3 stream output matches offline output up to float error.
+# CosyVoice1 stream rounds down mel length of every chunk, so its llm path stream speech is a few frames shorter than offline speech
+TOLERANCES = {
+    'cosyvoice': {'vc': {'max_abs_error': 0.055, 'boundary_lsd': 8.6}, 'llm': {'max_abs_error': 0.095, 'boundary_lsd': 8.7}},
+    'cosyvoice2': {'vc': {'max_abs_error': 0.05, 'boundary_lsd': 8.0}, 'llm': {'max_abs_error': 0.05, 'boundary_lsd': 7.9}},
+    'cosyvoice3': {'vc': {'max_abs_error': 1.1e-3, 'boundary_lsd': 0.36}, 'llm': {'max_abs_error': 6e-4, 'boundary_lsd': 0.22}},
+}
+# text tokens of the llm path, CosyVoice1 needs 120 speech tokens for its first stream chunk, random weight CosyVoice2/3 llm mostly runs to
+# 20 tokens per text token, and CosyVoice2 stream flow reruns all previous tokens for every chunk
+LLM_TEXT_LEN = {'cosyvoice': 64, 'cosyvoice2': 16, 'cosyvoice3': 16}
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='streaming/offline parity of tiny random weight models')
+    parser.add_argument('--models', nargs='+', default=list(MODELS.keys()), choices=list(MODELS.keys()))
+    parser.add_argument('--paths', nargs='+', default=['vc', 'llm'], choices=['vc', 'llm'])
+    parser.add_argument('--token_len', type=int, default=200, help='source speech tokens of the vc path, long enough for several stream chunks')
+    parser.add_argument('--prompt_len', type=int, default=75, help='prompt speech tokens')
+    parser.add_argument('--text_len', type=int, default=0, help='text tokens of the llm path, speech tokens are 2 to 20 times of it, 0 means LLM_TEXT_LEN')
+    parser.add_argument('--boundary_window', type=int, default=2048, help='samples on each side of a chunk boundary for spectral distance')
+    parser.add_argument('--num_runs', type=int, default=3, help='timed runs of each path after one warmup run')
+    parser.add_argument('--num_threads', type=int, default=0, help='torch threads, 0 means torch default')
+    parser.add_argument('--seed', type=int, default=1986)
+    parser.add_argument('--baseline', type=str, default='', help='json output of a previous run, errors and rtf are compared with it')
+    parser.add_argument('--error_tolerance', type=float, default=0.5, help='allowed relative max_abs_error and boundary_lsd increase over baseline')
+    parser.add_argument('--time_tolerance', type=float, default=0.2, help='allowed relative rtf increase over baseline')
+    parser.add_argument('--output', type=str, default='', help='json file of results, empty means stdout')
+    args = parser.parse_args()
+    return args
+
+
+def synthesize(model, inputs, stream, seed):
+    """Return chunks and seconds of the first chunk and of the whole request, llm sampling and noise are seeded per tts session."""
+    start_time = time.perf_counter()
+    chunks, first_chunk = [], None
+    for model_output in seeded(model.tts(**inputs, stream=stream), seed):
+        if first_chunk is None:
+            first_chunk = time.perf_counter() - start_time
+        chunks.append(model_output['tts_speech'].flatten())
+    return chunks, first_chunk, time.perf_counter() - start_time
+
+
+def log_spectral_distance(x, y, n_fft=512):
+    """Mean over frames of rms over frequency bins of the log power ratio in dB."""
+    window = torch.hann_window(n_fft)
+    x = torch.stft(x, n_fft, hop_length=n_fft // 4, window=window, return_complex=True).abs() ** 2
+    y = torch.stft(y, n_fft, hop_length=n_fft // 4, window=window, return_complex=True).abs() ** 2
+    ratio = 10 * torch.log10((x + 1e-8) / (y + 1e-8))
+    return ratio.pow(2).mean(dim=0).sqrt().mean().item()
+
+
+def compare(stream_chunks, offline, window):
+    stream = torch.concat(stream_chunks)
+    n = min(len(stream), len(offline))
+    error = (stream[:n] - offline[:n]).abs()
+    boundaries = torch.cumsum(torch.tensor([len(i) for i in stream_chunks[:-1]]), dim=0).tolist()
+    lsd = [log_spectral_distance(stream[max(b - window, 0): min(b + window, n)], offline[max(b - window, 0): min(b + window, n)])
+           for b in boundaries if b < n]
+    return {'stream_samples': len(stream), 'offline_samples': len(offline), 'num_chunks': len(stream_chunks),
+            'max_abs_error': error.max().item(), 'mean_abs_error': error.mean().item(),
+            'boundary_lsd': max(lsd, default=0.0), 'mean_boundary_lsd': sum(lsd) / len(lsd) if len(lsd) != 0 else 0.0,
+            'boundary_max_abs_error': max([error[max(b - window, 0): b + window].max().item() for b in boundaries if b < n], default=0.0)}
+
+
+def run(name, model, sample_rate, path, args):
+    set_all_random_seed(args.seed)
+    text_len = args.text_len if args.text_len != 0 else LLM_TEXT_LEN[name]
+    inputs = model_input(model, 'zero_shot', argparse.Namespace(text_len=text_len, prompt_len=args.prompt_len))
+    if path == 'vc':
+        inputs['source_speech_token'] = torch.randint(0, model.llm.speech_token_size, (1, args.token_len), dtype=torch.int32)
+    offline, _, _ = synthesize(model, inputs, False, args.seed)
+    stream_chunks, _, _ = synthesize(model, inputs, True, args.seed)
+    result = dict({'model': name, 'path': path, 'sample_rate': sample_rate, 'token_len': args.token_len if path == 'vc' else None,
+                   'text_len': text_len if path == 'llm' else None},
+                  **compare(stream_chunks, torch.concat(offline), args.boundary_window))
+    for stream in [False, True]:
+        costs, first_chunks = [], []
+        for i in range(args.num_runs):
+            chunks, first_chunk, cost = synthesize(model, inputs, stream, args.seed + i)
+            costs.append(cost)
+            first_chunks.append(first_chunk)
+        path = 'stream' if stream is True else 'offline'
+        result['{}_rtf'.format(path)] = sum(costs) / len(costs) / (sum([len(i) for i in chunks]) / sample_rate)
+        result['{}_first_chunk_seconds'.format(path)] = sum(first_chunks) / len(first_chunks)
+    return result
+
+
+def check(result, baseline, args):
+    """Return violations of the tolerance of model family, and of the baseline errors and rtf."""
+    violations = []
+    tolerances = TOLERANCES[result['model']][result['path']]
+    if result['num_chunks'] < 2:
+        violations.append('stream output is a single chunk, no chunk boundary is compared')
+    for k, v in tolerances.items():
+        if result[k] > v:
+            violations.append('{} {:.4f} over tolerance {}'.format(k, result[k], v))
+    if baseline is not None:
+        for k in tolerances:
+            # NOTE errors far below tolerance are not compared with baseline, a tiny baseline error would make any float noise a violation
+            if result[k] > max(baseline[k] * (1 + args.error_tolerance), tolerances[k] * 0.01):
+                violations.append('{} {:.4f} over baseline {:.4f} by more than {:.0%}'.format(k, result[k], baseline[k], args.error_tolerance))
+        for k in ['offline_rtf', 'stream_rtf']:
+            if result[k] > baseline[k] * (1 + args.time_tolerance):
+                violations.append('{} {:.4f} over baseline {:.4f} by more than {:.0%}'.format(k, result[k], baseline[k], args.time_tolerance))
+    return violations
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    baselines = {}
+    if args.baseline != '':
+        with open(args.baseline, 'r') as f:
+            # NOTE results without path are of the vc path, before the llm path was added
+            baselines = {(i['model'], i.get('path', 'vc')): i for i in json.load(f)}
+    results, failed = [], False
+    with tempfile.TemporaryDirectory() as qwen_path:
+        # NOTE seeded, so llm path of CosyVoice2/3 is comparable with baseline of another process
+        set_all_random_seed(args.seed)
+        tiny_qwen(qwen_path)
+        for name in args.models:
+            set_all_random_seed(args.seed)
+            model, sample_rate = build_model(name, qwen_path)
+            for path in args.paths:
+                result = run(name, model, sample_rate, path, args)
+                result['violations'] = check(result, baselines.get((name, path)), args)
+                failed = failed or len(result['violations']) != 0
+                logging.info('{} {} path {} chunks max abs error {:.2e} boundary lsd {:.2f}dB, rtf offline {:.3f} stream {:.3f}, first chunk {:.3f}s, {}'.format(
+                    name, path, result['num_chunks'], result['max_abs_error'], result['boundary_lsd'], result['offline_rtf'], result['stream_rtf'],
+                    result['stream_first_chunk_seconds'], 'FAIL ' + '; '.join(result['violations']) if len(result['violations']) != 0 else 'ok'))
+                results.append(result)
+            del model
+    if args.output != '':
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+    sys.exit(1 if failed is True else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -79,6 +79,10 @@ def get_args():
                         action='store_true',
                         default=False,
                         help='Use Direct Preference Optimization')
+    parser.add_argument('--precomputed_feat',
+                        action='store_true',
+                        default=False,
+                        help='Load speech_feat/pitch_feat of tools/extract_acoustic_feature.py instead of computing them')
     parser.add_argument('--deepspeed.save_states',
                         dest='save_states',
                         default='model_only',
@@ -14,6 +14,7 @@
 import os
 import time
 from typing import Generator
+from functools import wraps
 from tqdm import tqdm
 from hyperpyyaml import load_hyperpyyaml
 from modelscope import snapshot_download
@@ -22,9 +23,43 @@ from cosyvoice.cli.frontend import CosyVoiceFrontEnd
 from cosyvoice.cli.model import CosyVoiceModel, CosyVoice2Model, CosyVoice3Model
 from cosyvoice.utils.file_utils import logging
 from cosyvoice.utils.class_utils import get_model_type
+from cosyvoice.utils.metrics import get_metrics
+from cosyvoice.utils.profiler import get_profiler
+
+
+def track_inference(func):
+    """Record first chunk latency, rtf and speech length of an inference_* request, time spent by the consumer is excluded."""
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        metrics = get_metrics()
+        if metrics.enabled is False:
+            yield from func(self, *args, **kwargs)
+            return
+        model_outputs, speech_len, compute_time = func(self, *args, **kwargs), 0, 0
+        try:
+            while True:
+                start_time = time.time()
+                model_output = next(model_outputs, None)
+                compute_time += time.time() - start_time
+                if model_output is None:
+                    break
+                if speech_len == 0:
+                    metrics.observe('first_chunk_seconds', compute_time)
+                speech_len += model_output['tts_speech'].shape[1] / self.sample_rate
+                yield model_output
+        finally:
+            # NOTE close so that model.tts stops llm when the consumer stops early
+            model_outputs.close()
+        metrics.inc('requests_total')
+        metrics.inc('speech_seconds_total', speech_len)
+        if speech_len != 0:
+            metrics.observe('rtf', compute_time / speech_len)
+    return wrapper
 
 
 class CosyVoice:
+    # NOTE tqdm and per chunk logging cost a few ms per chunk, servers set verbose to False
+    verbose = True
 
     def __init__(self, model_dir, load_jit=False, load_trt=False, fp16=False, trt_concurrent=1):
         self.model_dir = model_dir
@@ -77,63 +112,55 @@ class CosyVoice:
     def save_spkinfo(self):
         torch.save(self.frontend.spk2info, '{}/spk2info.pt'.format(self.model_dir))
 
-    def inference_sft(self, tts_text, spk_id, stream=False, speed=1.0, text_frontend=True):
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
-            model_input = self.frontend.frontend_sft(i, spk_id)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
+    def text_normalize(self, text, split=True, text_frontend=True):
+        with get_metrics().timer('text_normalize_seconds'), get_profiler().span('frontend_text_normalize'):
+            texts = self.frontend.text_normalize(text, split=split, text_frontend=text_frontend)
+        return tqdm(texts) if split is True and self.verbose is True else texts
+
+    def synthesize(self, model_input, stream=False, speed=1.0, text=None):
+        if self.verbose is True and text is not None:
+            logging.info('synthesis text {}'.format(text))
+        start_time = time.time()
+        for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
+            if self.verbose is True:
                 speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
                 logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
+            yield model_output
+            start_time = time.time()
+
+    @track_inference
+    def inference_sft(self, tts_text, spk_id, stream=False, speed=1.0, text_frontend=True):
+        for i in self.text_normalize(tts_text, split=True, text_frontend=text_frontend):
+            model_input = self.frontend.frontend_sft(i, spk_id)
+            yield from self.synthesize(model_input, stream=stream, speed=speed, text=i)
 
+    @track_inference
     def inference_zero_shot(self, tts_text, prompt_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
-        prompt_text = self.frontend.text_normalize(prompt_text, split=False, text_frontend=text_frontend)
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
+        prompt_text = self.text_normalize(prompt_text, split=False, text_frontend=text_frontend)
+        for i in self.text_normalize(tts_text, split=True, text_frontend=text_frontend):
             if (not isinstance(i, Generator)) and len(i) < 0.5 * len(prompt_text):
                 logging.warning('synthesis text {} too short than prompt text {}, this may lead to bad performance'.format(i, prompt_text))
             model_input = self.frontend.frontend_zero_shot(i, prompt_text, prompt_wav, self.sample_rate, zero_shot_spk_id)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
+            yield from self.synthesize(model_input, stream=stream, speed=speed, text=i)
 
+    @track_inference
     def inference_cross_lingual(self, tts_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
+        for i in self.text_normalize(tts_text, split=True, text_frontend=text_frontend):
             model_input = self.frontend.frontend_cross_lingual(i, prompt_wav, self.sample_rate, zero_shot_spk_id)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
+            yield from self.synthesize(model_input, stream=stream, speed=speed, text=i)
 
+    @track_inference
     def inference_instruct(self, tts_text, spk_id, instruct_text, stream=False, speed=1.0, text_frontend=True):
         assert self.__class__.__name__ == 'CosyVoice', 'inference_instruct is only implemented for CosyVoice!'
-        instruct_text = self.frontend.text_normalize(instruct_text, split=False, text_frontend=text_frontend)
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
+        instruct_text = self.text_normalize(instruct_text, split=False, text_frontend=text_frontend)
+        for i in self.text_normalize(tts_text, split=True, text_frontend=text_frontend):
             model_input = self.frontend.frontend_instruct(i, spk_id, instruct_text)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
+            yield from self.synthesize(model_input, stream=stream, speed=speed, text=i)
 
+    @track_inference
     def inference_vc(self, source_wav, prompt_wav, stream=False, speed=1.0):
         model_input = self.frontend.frontend_vc(source_wav, prompt_wav, self.sample_rate)
-        start_time = time.time()
-        for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-            speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-            logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-            yield model_output
-            start_time = time.time()
+        yield from self.synthesize(model_input, stream=stream, speed=speed)
 
 
 class CosyVoice2(CosyVoice):
@@ -174,21 +201,16 @@ class CosyVoice2(CosyVoice):
                                 self.fp16)
         del configs
 
+    @track_inference
     def inference_instruct2(self, tts_text, instruct_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
+        for i in self.text_normalize(tts_text, split=True, text_frontend=text_frontend):
             model_input = self.frontend.frontend_instruct2(i, instruct_text, prompt_wav, self.sample_rate, zero_shot_spk_id)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
+            yield from self.synthesize(model_input, stream=stream, speed=speed, text=i)
 
 
 class CosyVoice3(CosyVoice2):
 
-    def __init__(self, model_dir, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1):
+    def __init__(self, model_dir, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1, f0_policy=None):
         self.model_dir = model_dir
         self.fp16 = fp16
         if not os.path.exists(model_dir):
@@ -213,6 +235,9 @@ class CosyVoice3(CosyVoice2):
         self.model.load('{}/llm.pt'.format(model_dir),
                         '{}/flow.pt'.format(model_dir),
                         '{}/hift.pt'.format(model_dir))
+        # NOTE None keeps f0_policy of the yaml, which is cpu by default, see CausalHiFTGenerator.set_f0_policy
+        if f0_policy is not None:
+            self.model.hift.set_f0_policy(f0_policy)
         if load_vllm:
             self.model.load_vllm('{}/vllm'.format(model_dir))
         if load_trt:
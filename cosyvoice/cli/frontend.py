@@ -22,11 +22,37 @@ from typing import Callable
 import torchaudio.compliance.kaldi as kaldi
 import os
 import re
+import hashlib
+import threading
+import weakref
 import inflect
 from cosyvoice.utils.file_utils import logging, load_wav
+from cosyvoice.utils.metrics import get_metrics
+from cosyvoice.utils.profiler import traced
 from cosyvoice.utils.frontend_utils import contains_chinese, replace_blank, replace_corner_mark, remove_bracket, spell_out_number, split_paragraph, is_only_punctuation
 
 
+# NOTE models hosted in one process share sessions of identical onnx files, e.g. campplus.onnx, a session is freed with its last frontend
+_onnx_sessions = weakref.WeakValueDictionary()
+_onnx_lock = threading.Lock()
+
+
+def onnx_session(model_path: str, sess_options, providers: list):
+    digest = hashlib.sha256()
+    with open(model_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 24), b''):
+            digest.update(block)
+    key = (digest.hexdigest(), tuple(providers))
+    with _onnx_lock:
+        session = _onnx_sessions.get(key)
+        if session is None:
+            session = onnxruntime.InferenceSession(model_path, sess_options=sess_options, providers=providers)
+            _onnx_sessions[key] = session
+        else:
+            logging.info('share onnx session of {}'.format(model_path))
+    return session
+
+
 class CosyVoiceFrontEnd:
 
     def __init__(self,
@@ -42,10 +68,9 @@ class CosyVoiceFrontEnd:
         option = onnxruntime.SessionOptions()
         option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
         option.intra_op_num_threads = 1
-        self.campplus_session = onnxruntime.InferenceSession(campplus_model, sess_options=option, providers=["CPUExecutionProvider"])
-        self.speech_tokenizer_session = onnxruntime.InferenceSession(speech_tokenizer_model, sess_options=option,
-                                                                     providers=["CUDAExecutionProvider" if torch.cuda.is_available() else
-                                                                                "CPUExecutionProvider"])
+        self.campplus_session = onnx_session(campplus_model, option, ["CPUExecutionProvider"])
+        self.speech_tokenizer_session = onnx_session(speech_tokenizer_model, option,
+                                                     ["CUDAExecutionProvider" if torch.cuda.is_available() else "CPUExecutionProvider"])
         if os.path.exists(spk2info):
             self.spk2info = torch.load(spk2info, map_location=self.device)
         else:
@@ -75,6 +100,7 @@ class CosyVoiceFrontEnd:
                 logging.info('no frontend is avaliable')
 
 
+    @traced('frontend_text_token')
     def _extract_text_token(self, text):
         if isinstance(text, Generator):
             logging.info('get tts_text generator, will return _extract_text_token_generator!')
@@ -92,6 +118,7 @@ class CosyVoiceFrontEnd:
             for i in range(text_token.shape[1]):
                 yield text_token[:, i: i + 1]
 
+    @traced('frontend_speech_token')
     def _extract_speech_token(self, prompt_wav):
         speech = load_wav(prompt_wav, 16000)
         assert speech.shape[1] / 16000 <= 30, 'do not support extract speech token for audio longer than 30s'
@@ -105,6 +132,7 @@ class CosyVoiceFrontEnd:
         speech_token_len = torch.tensor([speech_token.shape[1]], dtype=torch.int32).to(self.device)
         return speech_token, speech_token_len
 
+    @traced('frontend_spk_embedding')
     def _extract_spk_embedding(self, prompt_wav):
         speech = load_wav(prompt_wav, 16000)
         feat = kaldi.fbank(speech,
@@ -117,6 +145,7 @@ class CosyVoiceFrontEnd:
         embedding = torch.tensor([embedding]).to(self.device)
         return embedding
 
+    @traced('frontend_speech_feat')
     def _extract_speech_feat(self, prompt_wav):
         speech = load_wav(prompt_wav, 24000)
         speech_feat = self.feat_extractor(speech).squeeze(dim=0).transpose(0, 1).to(self.device)
@@ -169,21 +198,23 @@ class CosyVoiceFrontEnd:
         tts_text_token, tts_text_token_len = self._extract_text_token(tts_text)
         if zero_shot_spk_id == '':
             prompt_text_token, prompt_text_token_len = self._extract_text_token(prompt_text)
-            speech_feat, speech_feat_len = self._extract_speech_feat(prompt_wav)
-            speech_token, speech_token_len = self._extract_speech_token(prompt_wav)
-            if resample_rate == 24000:
-                # cosyvoice2, force speech_feat % speech_token = 2
-                token_len = min(int(speech_feat.shape[1] / 2), speech_token.shape[1])
-                speech_feat, speech_feat_len[:] = speech_feat[:, :2 * token_len], 2 * token_len
-                speech_token, speech_token_len[:] = speech_token[:, :token_len], token_len
-            embedding = self._extract_spk_embedding(prompt_wav)
+            with get_metrics().timer('prompt_extract_seconds'):
+                speech_feat, speech_feat_len = self._extract_speech_feat(prompt_wav)
+                speech_token, speech_token_len = self._extract_speech_token(prompt_wav)
+                if resample_rate == 24000:
+                    # cosyvoice2, force speech_feat % speech_token = 2
+                    token_len = min(int(speech_feat.shape[1] / 2), speech_token.shape[1])
+                    speech_feat, speech_feat_len[:] = speech_feat[:, :2 * token_len], 2 * token_len
+                    speech_token, speech_token_len[:] = speech_token[:, :token_len], token_len
+                embedding = self._extract_spk_embedding(prompt_wav)
             model_input = {'prompt_text': prompt_text_token, 'prompt_text_len': prompt_text_token_len,
                            'llm_prompt_speech_token': speech_token, 'llm_prompt_speech_token_len': speech_token_len,
                            'flow_prompt_speech_token': speech_token, 'flow_prompt_speech_token_len': speech_token_len,
                            'prompt_speech_feat': speech_feat, 'prompt_speech_feat_len': speech_feat_len,
                            'llm_embedding': embedding, 'flow_embedding': embedding}
         else:
-            model_input = self.spk2info[zero_shot_spk_id]
+            # NOTE copy as model_input is modified below and by other frontend, spk2info may be shared by concurrent requests
+            model_input = self.spk2info[zero_shot_spk_id].copy()
         model_input['text'] = tts_text_token
         model_input['text_len'] = tts_text_token_len
         return model_input
@@ -208,14 +239,18 @@ class CosyVoiceFrontEnd:
 
     def frontend_instruct2(self, tts_text, instruct_text, prompt_wav, resample_rate, zero_shot_spk_id):
         model_input = self.frontend_zero_shot(tts_text, instruct_text, prompt_wav, resample_rate, zero_shot_spk_id)
+        if zero_shot_spk_id != '' and instruct_text != '':
+            # registered speaker keeps prompt text of its registration, use instruct_text instead
+            model_input['prompt_text'], model_input['prompt_text_len'] = self._extract_text_token(instruct_text)
         del model_input['llm_prompt_speech_token']
         del model_input['llm_prompt_speech_token_len']
         return model_input
 
     def frontend_vc(self, source_speech_16k, prompt_wav, resample_rate):
-        prompt_speech_token, prompt_speech_token_len = self._extract_speech_token(prompt_wav)
-        prompt_speech_feat, prompt_speech_feat_len = self._extract_speech_feat(prompt_wav)
-        embedding = self._extract_spk_embedding(prompt_wav)
+        with get_metrics().timer('prompt_extract_seconds'):
+            prompt_speech_token, prompt_speech_token_len = self._extract_speech_token(prompt_wav)
+            prompt_speech_feat, prompt_speech_feat_len = self._extract_speech_feat(prompt_wav)
+            embedding = self._extract_spk_embedding(prompt_wav)
         source_speech_token, source_speech_token_len = self._extract_speech_token(source_speech_16k)
         model_input = {'source_speech_token': source_speech_token, 'source_speech_token_len': source_speech_token_len,
                        'flow_prompt_speech_token': prompt_speech_token, 'flow_prompt_speech_token_len': prompt_speech_token_len,
@@ -13,17 +13,119 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import os
+import sys
 from typing import Generator
 import torch
 import numpy as np
 import threading
 import time
+import contextvars
 from torch.nn import functional as F
-from contextlib import nullcontext
+from contextlib import nullcontext, contextmanager
 import uuid
-from cosyvoice.utils.common import fade_in_out
-from cosyvoice.utils.file_utils import convert_onnx_to_trt, export_cosyvoice2_vllm
+from cosyvoice.utils.common import fade_in_out, use_generator
+from cosyvoice.utils.file_utils import convert_onnx_to_trt, export_cosyvoice2_vllm, logging
 from cosyvoice.utils.common import TrtContextWrapper
+from cosyvoice.utils.metrics import get_metrics
+from cosyvoice.utils.profiler import get_profiler, bind_trace
+
+# per session caches of tts, <name>_dict holds the cache of every session, mel_overlap is CosyVoice1 only
+SESSION_CACHES = ['tts_speech_token', 'mel_overlap', 'flow_cache', 'hift_cache']
+
+
+def session_nbytes(obj):
+    """Bytes held by a session cache, storage of a tensor view counts in full as the view keeps it alive."""
+    if isinstance(obj, torch.Tensor):
+        return obj.untyped_storage().nbytes()
+    if isinstance(obj, dict):
+        return sum([session_nbytes(i) for i in obj.values()])
+    if isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum([session_nbytes(i) for i in obj])
+    return sys.getsizeof(obj) if obj is not None else 0
+
+
+class SessionCancelled(RuntimeError):
+    """Raised by tts of a session whose CancelScope is cancelled, e.g. its rpc is cancelled or past its deadline."""
+
+
+class SessionReaped(RuntimeError):
+    """Raised by tts of a session released by reap_sessions, when its consumer asks for the next chunk after being idle for too long."""
+
+
+class CancelScope:
+    """Cancel tts sessions started under bind() from any thread, e.g. the event loop of a server.
+
+    cancel() stops llm jobs of the sessions and makes their tts raise SessionCancelled instead of running flow and hift of the next chunk,
+    sessions started after cancel() raise at once. NOTE sessions in model worker processes of WorkerPool are not in the scope,
+    they stop when their output is closed.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def bind(self):
+        """Put tts sessions started in this context, not in threads started by it, into the scope."""
+        token = _cancel_scope.set(self)
+        try:
+            yield self
+        finally:
+            _cancel_scope.reset(token)
+
+    def add(self, model, session_id):
+        with self.lock:
+            self.sessions[session_id] = model
+            cancelled = self.cancelled
+        if cancelled is True:
+            model.end_session(session_id)
+
+    def remove(self, session_id):
+        with self.lock:
+            self.sessions.pop(session_id, None)
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            sessions = list(self.sessions.items())
+        for session_id, model in sessions:
+            model.end_session(session_id)
+
+    def check(self):
+        if self.cancelled is True:
+            raise SessionCancelled('session is cancelled')
+
+
+_cancel_scope = contextvars.ContextVar('cancel_scope', default=None)
+
+
+def current_cancel_scope() -> CancelScope:
+    """CancelScope bound in this context, or a new one which is never cancelled."""
+    scope = _cancel_scope.get()
+    return scope if scope is not None else CancelScope()
+
+
+_sampling_seed = contextvars.ContextVar('sampling_seed', default=None)
+
+
+def seeded(model_output, seed: int):
+    """Run model_output, a generator of cosyvoice inference_*, with its tts sessions drawing sampling and noise from generators seeded with seed.
+
+    the global rng is untouched, so concurrent requests do not change the result, every tts session, i.e. text segment, starts from seed.
+    NOTE every step runs in a context of its own, as a generator can not keep a context variable set across its yields. vllm is not seeded.
+    """
+    context = contextvars.copy_context()
+    context.run(_sampling_seed.set, seed)
+    try:
+        while True:
+            try:
+                i = context.run(next, model_output)
+            except StopIteration:
+                return
+            yield i
+    finally:
+        model_output.close()
 
 
 class CosyVoiceModel:
@@ -43,12 +145,12 @@ class CosyVoiceModel:
         self.token_overlap_len = 20
         # mel fade in out
         self.mel_overlap_len = int(self.token_overlap_len / self.flow.input_frame_rate * 22050 / 256)
-        self.mel_window = np.hamming(2 * self.mel_overlap_len)
+        self.mel_window = torch.hamming_window(2 * self.mel_overlap_len, periodic=False, device=self.device)
         # hift cache
         self.mel_cache_len = 20
         self.source_cache_len = int(self.mel_cache_len * 256)
         # speech fade in out
-        self.speech_window = np.hamming(2 * self.source_cache_len)
+        self.speech_window = torch.hamming_window(2 * self.source_cache_len, periodic=False, device=self.device)
         # rtf and decoding related
         self.stream_scale_factor = 1
         assert self.stream_scale_factor >= 1, 'stream_scale_factor should be greater than 1, change it according to your actual rtf'
@@ -60,6 +162,7 @@ class CosyVoiceModel:
         self.mel_overlap_dict = {}
         self.flow_cache_dict = {}
         self.hift_cache_dict = {}
+        self.session_dict = {}
 
     def load(self, llm_model, flow_model, hift_model):
         self.llm.load_state_dict(torch.load(llm_model, map_location=self.device), strict=True)
@@ -98,7 +201,11 @@ class CosyVoiceModel:
         return {'min_shape': min_shape, 'opt_shape': opt_shape, 'max_shape': max_shape, 'input_names': input_names}
 
     def llm_job(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, uuid):
-        with self.llm_context, torch.cuda.amp.autocast(self.fp16 is True and hasattr(self.llm, 'vllm') is False):
+        start_time, first_token_time = time.time(), None
+        # NOTE llm samples in its own thread, so a seeded session gives it a generator apart from the flow and hift one
+        seed = self.session_dict[uuid]['seed']
+        generator = torch.Generator(self.device).manual_seed(seed) if seed is not None else None
+        with self.llm_context, torch.cuda.amp.autocast(self.fp16 is True and hasattr(self.llm, 'vllm') is False), use_generator(generator):
             if isinstance(text, Generator):
                 assert (self.__class__.__name__ != 'CosyVoiceModel') and not hasattr(self.llm, 'vllm'), 'streaming input text is only implemented for CosyVoice2/3 and do not support vllm!'
                 for i in self.llm.inference_bistream(text=text,
@@ -108,6 +215,12 @@ class CosyVoiceModel:
                                                      prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
                                                      embedding=llm_embedding.to(self.device)):
                     self.tts_speech_token_dict[uuid].append(i)
+                    if first_token_time is None:
+                        first_token_time = time.time()
+                        get_metrics().observe('llm_first_token_seconds', first_token_time - start_time)
+                    # NOTE tts sets llm_end_dict when its consumer stops early
+                    if self.llm_end_dict[uuid] is True:
+                        break
             else:
                 for i in self.llm.inference(text=text.to(self.device),
                                             text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
@@ -118,14 +231,24 @@ class CosyVoiceModel:
                                             embedding=llm_embedding.to(self.device),
                                             uuid=uuid):
                     self.tts_speech_token_dict[uuid].append(i)
+                    if first_token_time is None:
+                        first_token_time = time.time()
+                        get_metrics().observe('llm_first_token_seconds', first_token_time - start_time)
+                    if self.llm_end_dict[uuid] is True:
+                        break
         self.llm_end_dict[uuid] = True
+        token_num = len(self.tts_speech_token_dict[uuid])
+        get_metrics().inc('llm_tokens_total', token_num)
+        if token_num > 1:
+            get_metrics().observe('llm_tokens_per_second', (token_num - 1) / max(time.time() - first_token_time, 1e-6))
 
     def vc_job(self, source_speech_token, uuid):
         self.tts_speech_token_dict[uuid] = source_speech_token.flatten().tolist()
         self.llm_end_dict[uuid] = True
 
     def token2wav(self, token, prompt_token, prompt_feat, embedding, uuid, finalize=False, speed=1.0):
-        with torch.cuda.amp.autocast(self.fp16):
+        generator = self.session_generator(uuid)
+        with torch.cuda.amp.autocast(self.fp16), get_metrics().timer('flow_chunk_seconds', self.device), get_profiler().span('flow'), use_generator(generator):
             tts_mel, self.flow_cache_dict[uuid] = self.flow.inference(token=token.to(self.device, dtype=torch.int32),
                                                                       token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
                                                                       prompt_token=prompt_token.to(self.device),
@@ -143,12 +266,13 @@ class CosyVoiceModel:
             hift_cache_mel, hift_cache_source = self.hift_cache_dict[uuid]['mel'], self.hift_cache_dict[uuid]['source']
             tts_mel = torch.concat([hift_cache_mel, tts_mel], dim=2)
         else:
-            hift_cache_source = torch.zeros(1, 1, 0)
+            hift_cache_source = torch.zeros(1, 1, 0, device=self.device)
         # keep overlap mel and hift cache
         if finalize is False:
             self.mel_overlap_dict[uuid] = tts_mel[:, :, -self.mel_overlap_len:]
             tts_mel = tts_mel[:, :, :-self.mel_overlap_len]
-            tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
+            with get_metrics().timer('hift_chunk_seconds', self.device), get_profiler().span('hift'), use_generator(generator):
+                tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
             if self.hift_cache_dict[uuid] is not None:
                 tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
             self.hift_cache_dict[uuid] = {'mel': tts_mel[:, :, -self.mel_cache_len:],
@@ -159,11 +283,76 @@ class CosyVoiceModel:
             if speed != 1.0:
                 assert self.hift_cache_dict[uuid] is None, 'speed change only support non-stream inference mode'
                 tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
-            tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
+            with get_metrics().timer('hift_chunk_seconds', self.device), get_profiler().span('hift'), use_generator(generator):
+                tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
             if self.hift_cache_dict[uuid] is not None:
                 tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
         return tts_speech
 
+    def session_generator(self, uuid):
+        """torch.Generator of flow and hift noise of session uuid, None if it is not seeded."""
+        session = self.session_dict.get(uuid)
+        return session['generator'] if session is not None else None
+
+    def session_output(self, uuid, model_output):
+        """Yield model_output of session uuid, which counts as idle until its consumer asks for the next chunk.
+
+        raise SessionReaped if the session is released by reap_sessions meanwhile.
+        """
+        with self.lock:
+            self.session_dict[uuid]['idle_since'] = time.time()
+        yield model_output
+        with self.lock:
+            if uuid not in self.session_dict:
+                raise SessionReaped('session {} is reaped after its consumer was idle for too long'.format(uuid))
+            self.session_dict[uuid]['idle_since'] = None
+
+    def end_session(self, uuid):
+        """Stop llm job of session uuid without waiting for it, callable from any thread, tts releases the session afterwards."""
+        with self.lock:
+            if uuid in self.session_dict:
+                self.llm_end_dict[uuid] = True
+
+    def release_session(self, uuid):
+        """Stop llm job of session uuid and free its state, called at the end of tts and by reap_sessions, only the first call counts."""
+        with self.lock:
+            session = self.session_dict.pop(uuid, None)
+            if session is None:
+                return
+            self.llm_end_dict[uuid] = True
+        session['thread'].join()
+        with self.lock:
+            for k in SESSION_CACHES + ['llm_end']:
+                getattr(self, '{}_dict'.format(k), {}).pop(uuid, None)
+
+    def reap_sessions(self, ttl: float):
+        """Release sessions whose consumer has held a chunk for more than ttl seconds without asking for the next one or closing the generator.
+
+        return reaped session uuids, a reaped generator raises SessionReaped if its consumer comes back.
+        """
+        now = time.time()
+        with self.lock:
+            orphaned = [k for k, v in self.session_dict.items() if v['idle_since'] is not None and now - v['idle_since'] > ttl]
+        for k in orphaned:
+            logging.warning('reap session {} idle for more than {}s'.format(k, ttl))
+            self.release_session(k)
+        return orphaned
+
+    def session_stats(self):
+        """Live sessions, bytes held per cache type in total and per session, and age of the oldest session."""
+        now = time.time()
+        with self.lock:
+            sessions = {}
+            for k, v in self.session_dict.items():
+                nbytes = {i: session_nbytes(getattr(self, '{}_dict'.format(i)).get(k)) for i in SESSION_CACHES if hasattr(self, '{}_dict'.format(i))}
+                sessions[k] = {'age_seconds': now - v['start_time'], 'idle_seconds': now - v['idle_since'] if v['idle_since'] is not None else 0.0, 'bytes': nbytes}
+        total = {}
+        for v in sessions.values():
+            for k, n in v['bytes'].items():
+                total[k] = total.get(k, 0) + n
+        return {'sessions': len(sessions), 'oldest_seconds': max([v['age_seconds'] for v in sessions.values()], default=0.0),
+                'bytes': total, 'per_session': sessions}
+
     def tts(self, text=torch.zeros(1, 0, dtype=torch.int32), flow_embedding=torch.zeros(0, 192), llm_embedding=torch.zeros(0, 192),
             prompt_text=torch.zeros(1, 0, dtype=torch.int32),
             llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
@@ -171,64 +360,71 @@ class CosyVoiceModel:
             prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0, **kwargs):
         # this_uuid is used to track variables related to this inference thread
         this_uuid = str(uuid.uuid1())
-        with self.lock:
-            self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = [], False
-            self.hift_cache_dict[this_uuid] = None
-            self.mel_overlap_dict[this_uuid] = torch.zeros(1, 80, 0)
-            self.flow_cache_dict[this_uuid] = torch.zeros(1, 80, 0, 2)
         if source_speech_token.shape[1] == 0:
-            p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid))
+            p = threading.Thread(target=bind_trace(self.llm_job), args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid))
         else:
             p = threading.Thread(target=self.vc_job, args=(source_speech_token, this_uuid))
-        p.start()
-        if stream is True:
-            token_hop_len = self.token_min_hop_len
-            while True:
-                time.sleep(0.1)
-                if len(self.tts_speech_token_dict[this_uuid]) >= token_hop_len + self.token_overlap_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_hop_len + self.token_overlap_len]) \
-                        .unsqueeze(dim=0)
-                    this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                                     prompt_token=flow_prompt_speech_token,
-                                                     prompt_feat=prompt_speech_feat,
-                                                     embedding=flow_embedding,
-                                                     uuid=this_uuid,
-                                                     finalize=False)
-                    yield {'tts_speech': this_tts_speech.cpu()}
-                    with self.lock:
-                        self.tts_speech_token_dict[this_uuid] = self.tts_speech_token_dict[this_uuid][token_hop_len:]
-                    # increase token_hop_len for better speech quality
-                    token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) < token_hop_len + self.token_overlap_len:
-                    break
-            p.join()
-            # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             uuid=this_uuid,
-                                             finalize=True)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        else:
-            # deal with all tokens
-            p.join()
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             uuid=this_uuid,
-                                             finalize=True,
-                                             speed=speed)
-            yield {'tts_speech': this_tts_speech.cpu()}
         with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
-            self.mel_overlap_dict.pop(this_uuid)
-            self.hift_cache_dict.pop(this_uuid)
-            self.flow_cache_dict.pop(this_uuid)
+            self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = [], False
+            self.hift_cache_dict[this_uuid] = None
+            self.mel_overlap_dict[this_uuid] = torch.zeros(1, 80, 0, device=self.device)
+            self.flow_cache_dict[this_uuid] = torch.zeros(1, 80, 0, 2, device=self.device)
+            seed = _sampling_seed.get()
+            self.session_dict[this_uuid] = {'start_time': time.time(), 'idle_since': None, 'thread': p, 'seed': seed,
+                                            'generator': torch.Generator(self.device).manual_seed(seed) if seed is not None else None}
+        scope = current_cancel_scope()
+        scope.add(self, this_uuid)
+        p.start()
+        try:
+            if stream is True:
+                token_hop_len = self.token_min_hop_len
+                while True:
+                    time.sleep(0.1)
+                    scope.check()
+                    if len(self.tts_speech_token_dict[this_uuid]) >= token_hop_len + self.token_overlap_len:
+                        this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_hop_len + self.token_overlap_len]) \
+                            .unsqueeze(dim=0)
+                        this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                         prompt_token=flow_prompt_speech_token,
+                                                         prompt_feat=prompt_speech_feat,
+                                                         embedding=flow_embedding,
+                                                         uuid=this_uuid,
+                                                         finalize=False)
+                        yield from self.session_output(this_uuid, {'tts_speech': this_tts_speech.cpu()})
+                        with self.lock:
+                            self.tts_speech_token_dict[this_uuid] = self.tts_speech_token_dict[this_uuid][token_hop_len:]
+                        # increase token_hop_len for better speech quality
+                        token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
+                    if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) < token_hop_len + self.token_overlap_len:
+                        break
+                p.join()
+                scope.check()
+                # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
+                this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 uuid=this_uuid,
+                                                 finalize=True)
+                yield from self.session_output(this_uuid, {'tts_speech': this_tts_speech.cpu()})
+            else:
+                # deal with all tokens
+                p.join()
+                scope.check()
+                this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 uuid=this_uuid,
+                                                 finalize=True,
+                                                 speed=speed)
+                yield from self.session_output(this_uuid, {'tts_speech': this_tts_speech.cpu()})
+        finally:
+            # NOTE consumer may close this generator early, e.g. client cancelled, stop llm_job before releasing session
+            scope.remove(this_uuid)
+            self.release_session(this_uuid)
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
             torch.cuda.current_stream().synchronize()
@@ -252,14 +448,16 @@ class CosyVoice2Model(CosyVoiceModel):
         self.mel_cache_len = 8
         self.source_cache_len = int(self.mel_cache_len * 480)
         # speech fade in out
-        self.speech_window = np.hamming(2 * self.source_cache_len)
+        self.speech_window = torch.hamming_window(2 * self.source_cache_len, periodic=False, device=self.device)
         # rtf and decoding related
         self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if torch.cuda.is_available() else nullcontext()
         self.lock = threading.Lock()
         # dict used to store session related variable
         self.tts_speech_token_dict = {}
         self.llm_end_dict = {}
+        self.flow_cache_dict = {}
         self.hift_cache_dict = {}
+        self.session_dict = {}
 
     def load_jit(self, flow_encoder_model):
         flow_encoder = torch.jit.load(flow_encoder_model, map_location=self.device)
@@ -277,26 +475,29 @@ class CosyVoice2Model(CosyVoiceModel):
         del self.llm.llm.model.model.layers
 
     def token2wav(self, token, prompt_token, prompt_feat, embedding, token_offset, uuid, stream=False, finalize=False, speed=1.0):
-        with torch.cuda.amp.autocast(self.fp16):
-            tts_mel, _ = self.flow.inference(token=token.to(self.device, dtype=torch.int32),
-                                             token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
-                                             prompt_token=prompt_token.to(self.device),
-                                             prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
-                                             prompt_feat=prompt_feat.to(self.device),
-                                             prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
-                                             embedding=embedding.to(self.device),
-                                             streaming=stream,
-                                             finalize=finalize)
+        generator = self.session_generator(uuid)
+        with torch.cuda.amp.autocast(self.fp16), get_metrics().timer('flow_chunk_seconds', self.device), get_profiler().span('flow'), use_generator(generator):
+            tts_mel, self.flow_cache_dict[uuid] = self.flow.inference(token=token.to(self.device, dtype=torch.int32),
+                                                                      token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
+                                                                      prompt_token=prompt_token.to(self.device),
+                                                                      prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
+                                                                      prompt_feat=prompt_feat.to(self.device),
+                                                                      prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
+                                                                      embedding=embedding.to(self.device),
+                                                                      streaming=stream,
+                                                                      finalize=finalize,
+                                                                      flow_cache=self.flow_cache_dict[uuid])
         tts_mel = tts_mel[:, :, token_offset * self.flow.token_mel_ratio:]
         # append hift cache
         if self.hift_cache_dict[uuid] is not None:
             hift_cache_mel, hift_cache_source = self.hift_cache_dict[uuid]['mel'], self.hift_cache_dict[uuid]['source']
             tts_mel = torch.concat([hift_cache_mel, tts_mel], dim=2)
         else:
-            hift_cache_source = torch.zeros(1, 1, 0)
+            hift_cache_source = torch.zeros(1, 1, 0, device=self.device)
         # keep overlap mel and hift cache
         if finalize is False:
-            tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
+            with get_metrics().timer('hift_chunk_seconds', self.device), get_profiler().span('hift'), use_generator(generator):
+                tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
             if self.hift_cache_dict[uuid] is not None:
                 tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
             self.hift_cache_dict[uuid] = {'mel': tts_mel[:, :, -self.mel_cache_len:],
@@ -307,7 +508,8 @@ class CosyVoice2Model(CosyVoiceModel):
             if speed != 1.0:
                 assert self.hift_cache_dict[uuid] is None, 'speed change only support non-stream inference mode'
                 tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
-            tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
+            with get_metrics().timer('hift_chunk_seconds', self.device), get_profiler().span('hift'), use_generator(generator):
+                tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
             if self.hift_cache_dict[uuid] is not None:
                 tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
         return tts_speech
@@ -319,62 +521,73 @@ class CosyVoice2Model(CosyVoiceModel):
             prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0, **kwargs):
         # this_uuid is used to track variables related to this inference thread
         this_uuid = str(uuid.uuid1())
-        with self.lock:
-            self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = [], False
-            self.hift_cache_dict[this_uuid] = None
         if source_speech_token.shape[1] == 0:
-            p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid))
+            p = threading.Thread(target=bind_trace(self.llm_job), args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid))
         else:
             p = threading.Thread(target=self.vc_job, args=(source_speech_token, this_uuid))
-        p.start()
-        if stream is True:
-            token_offset = 0
-            prompt_token_pad = int(np.ceil(flow_prompt_speech_token.shape[1] / self.token_hop_len) * self.token_hop_len - flow_prompt_speech_token.shape[1])
-            while True:
-                time.sleep(0.1)
-                this_token_hop_len = self.token_hop_len + prompt_token_pad if token_offset == 0 else self.token_hop_len
-                if len(self.tts_speech_token_dict[this_uuid]) - token_offset >= this_token_hop_len + self.flow.pre_lookahead_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_offset + this_token_hop_len + self.flow.pre_lookahead_len]).unsqueeze(dim=0)
-                    this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                                     prompt_token=flow_prompt_speech_token,
-                                                     prompt_feat=prompt_speech_feat,
-                                                     embedding=flow_embedding,
-                                                     token_offset=token_offset,
-                                                     uuid=this_uuid,
-                                                     stream=stream,
-                                                     finalize=False)
-                    token_offset += this_token_hop_len
-                    yield {'tts_speech': this_tts_speech.cpu()}
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) - token_offset < this_token_hop_len + self.flow.pre_lookahead_len:
-                    break
-            p.join()
-            # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             token_offset=token_offset,
-                                             uuid=this_uuid,
-                                             finalize=True)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        else:
-            # deal with all tokens
-            p.join()
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             token_offset=0,
-                                             uuid=this_uuid,
-                                             finalize=True,
-                                             speed=speed)
-            yield {'tts_speech': this_tts_speech.cpu()}
         with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
-            self.hift_cache_dict.pop(this_uuid)
+            self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = [], False
+            self.flow_cache_dict[this_uuid] = {}
+            self.hift_cache_dict[this_uuid] = None
+            seed = _sampling_seed.get()
+            self.session_dict[this_uuid] = {'start_time': time.time(), 'idle_since': None, 'thread': p, 'seed': seed,
+                                            'generator': torch.Generator(self.device).manual_seed(seed) if seed is not None else None}
+        scope = current_cancel_scope()
+        scope.add(self, this_uuid)
+        p.start()
+        try:
+            if stream is True:
+                token_offset = 0
+                prompt_token_pad = int(np.ceil(flow_prompt_speech_token.shape[1] / self.token_hop_len) * self.token_hop_len - flow_prompt_speech_token.shape[1])
+                while True:
+                    time.sleep(0.1)
+                    scope.check()
+                    this_token_hop_len = self.token_hop_len + prompt_token_pad if token_offset == 0 else self.token_hop_len
+                    if len(self.tts_speech_token_dict[this_uuid]) - token_offset >= this_token_hop_len + self.flow.pre_lookahead_len:
+                        this_tts_speech_token = self.tts_speech_token_dict[this_uuid][:token_offset + this_token_hop_len + self.flow.pre_lookahead_len]
+                        this_tts_speech_token = torch.tensor(this_tts_speech_token).unsqueeze(dim=0)
+                        this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                         prompt_token=flow_prompt_speech_token,
+                                                         prompt_feat=prompt_speech_feat,
+                                                         embedding=flow_embedding,
+                                                         token_offset=token_offset,
+                                                         uuid=this_uuid,
+                                                         stream=stream,
+                                                         finalize=False)
+                        token_offset += this_token_hop_len
+                        yield from self.session_output(this_uuid, {'tts_speech': this_tts_speech.cpu()})
+                    if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) - token_offset < this_token_hop_len + self.flow.pre_lookahead_len:
+                        break
+                p.join()
+                scope.check()
+                # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
+                this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 token_offset=token_offset,
+                                                 uuid=this_uuid,
+                                                 finalize=True)
+                yield from self.session_output(this_uuid, {'tts_speech': this_tts_speech.cpu()})
+            else:
+                # deal with all tokens
+                p.join()
+                scope.check()
+                this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 token_offset=0,
+                                                 uuid=this_uuid,
+                                                 finalize=True,
+                                                 speed=speed)
+                yield from self.session_output(this_uuid, {'tts_speech': this_tts_speech.cpu()})
+        finally:
+            # NOTE consumer may close this generator early, e.g. client cancelled, stop llm_job before releasing session
+            scope.remove(this_uuid)
+            self.release_session(this_uuid)
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
             torch.cuda.current_stream().synchronize()
@@ -400,19 +613,23 @@ class CosyVoice3Model(CosyVoice2Model):
         # dict used to store session related variable
         self.tts_speech_token_dict = {}
         self.llm_end_dict = {}
+        self.flow_cache_dict = {}
         self.hift_cache_dict = {}
+        self.session_dict = {}
 
     def token2wav(self, token, prompt_token, prompt_feat, embedding, token_offset, uuid, stream=False, finalize=False, speed=1.0):
+        generator = self.session_generator(uuid)
         with torch.cuda.amp.autocast(self.fp16):
-            tts_mel, _ = self.flow.inference(token=token.to(self.device, dtype=torch.int32),
-                                             token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
-                                             prompt_token=prompt_token.to(self.device),
-                                             prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
-                                             prompt_feat=prompt_feat.to(self.device),
-                                             prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
-                                             embedding=embedding.to(self.device),
-                                             streaming=stream,
-                                             finalize=finalize)
+            with get_metrics().timer('flow_chunk_seconds', self.device), get_profiler().span('flow'), use_generator(generator):
+                tts_mel, _ = self.flow.inference(token=token.to(self.device, dtype=torch.int32),
+                                                 token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
+                                                 prompt_token=prompt_token.to(self.device),
+                                                 prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
+                                                 prompt_feat=prompt_feat.to(self.device),
+                                                 prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
+                                                 embedding=embedding.to(self.device),
+                                                 streaming=stream,
+                                                 finalize=finalize)
             tts_mel = tts_mel[:, :, token_offset * self.flow.token_mel_ratio:]
             # append mel cache
             if self.hift_cache_dict[uuid] is not None:
@@ -424,7 +641,8 @@ class CosyVoice3Model(CosyVoice2Model):
             if speed != 1.0:
                 assert token_offset == 0 and finalize is True, 'speed change only support non-stream inference mode'
                 tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
-            tts_speech, _ = self.hift.inference(speech_feat=tts_mel, finalize=finalize)
+            with get_metrics().timer('hift_chunk_seconds', self.device), get_profiler().span('hift'), use_generator(generator):
+                tts_speech, _ = self.hift.inference(speech_feat=tts_mel, finalize=finalize)
             tts_speech = tts_speech[:, self.hift_cache_dict[uuid]['speech_offset']:]
             self.hift_cache_dict[uuid]['speech_offset'] += tts_speech.shape[1]
         return tts_speech
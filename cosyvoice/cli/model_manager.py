@@ -0,0 +1,234 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import gc
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+import torch
+from cosyvoice.cli.cosyvoice import AutoModel
+from cosyvoice.cli.stub_model import StubCosyVoice
+from cosyvoice.cli.speaker_store import SpeakerStore
+from cosyvoice.cli.result_cache import ResultCache, render_cache_metrics
+from cosyvoice.cli.worker_pool import WorkerPool
+from cosyvoice.utils.metrics import render_samples
+
+
+def model_memory(cosyvoice):
+    """Bytes of llm/flow/hift parameters and buffers, onnx sessions of frontend are shared and not counted."""
+    memory = 0
+    for module in [cosyvoice.model.llm, cosyvoice.model.flow, cosyvoice.model.hift]:
+        memory += sum([i.numel() * i.element_size() for i in module.parameters()])
+        memory += sum([i.numel() * i.element_size() for i in module.buffers()])
+    return memory
+
+
+class LoadedModel:
+    def __init__(self, name, cosyvoice, memory):
+        self.name = name
+        self.cosyvoice = cosyvoice
+        self.memory = memory
+        self.refs = 0
+
+
+class ModelManager:
+    """Keep several model_dirs registered by name, load them on demand and evict least recently used idle ones over memory_budget.
+
+    on_load(loaded) is called once a model is loaded, e.g. to attach its speaker store, on_unload(loaded) before it is evicted.
+    tts sessions of resident models whose consumer is idle for more than session_ttl seconds are reaped, 0 means never.
+    NOTE a model in use is never evicted,
+    so memory may exceed budget while every resident model is busy. memory_budget <= 0 means no limit.
+    """
+
+    def __init__(self, memory_budget: int = 0, on_load=None, on_unload=None, load_model=AutoModel, session_ttl: float = 0, **model_kwargs):
+        self.memory_budget = memory_budget
+        self.session_ttl = session_ttl
+        self.load_model = load_model
+        self.on_load = on_load
+        self.on_unload = on_unload
+        self.model_kwargs = model_kwargs
+        self.lock = threading.Lock()
+        self.model_dirs = OrderedDict()
+        self.load_locks = {}
+        self.models = OrderedDict()
+        self.memory = {}
+        self.counter = {'loads': 0, 'evictions': 0, 'reaped_sessions': 0}
+        if session_ttl > 0:
+            threading.Thread(target=self._reap, name='session_reaper', daemon=True).start()
+
+    def __contains__(self, name):
+        return name == '' or name in self.model_dirs
+
+    @property
+    def default(self):
+        return next(iter(self.model_dirs))
+
+    def register(self, name: str, model_dir: str):
+        assert name not in self.model_dirs, 'model {} already registered'.format(name)
+        self.model_dirs[name] = model_dir
+        self.load_locks[name] = threading.Lock()
+
+    def list(self):
+        with self.lock:
+            return [{'name': k, 'model_dir': v, 'resident': k in self.models, 'memory': self.memory.get(k, 0)} for k, v in self.model_dirs.items()]
+
+    def resident(self):
+        with self.lock:
+            return list(self.models.values())
+
+    def acquire(self, name: str = '') -> LoadedModel:
+        """Return loaded model, loading it if not resident, every acquire should be paired with a release."""
+        name = self.default if name == '' else name
+        assert name in self.model_dirs, 'model {} not registered'.format(name)
+        with self.load_locks[name]:
+            with self.lock:
+                if name in self.models:
+                    self.models.move_to_end(name)
+                    self.models[name].refs += 1
+                    return self.models[name]
+            # NOTE load without manager lock, so resident models keep serving, memory of a model is known after its first load
+            self.evict(self.memory.get(name, 0))
+            start_time = time.time()
+            cosyvoice = self.load_model(model_dir=self.model_dirs[name], **self.model_kwargs)
+            loaded = LoadedModel(name, cosyvoice, model_memory(cosyvoice))
+            if self.on_load is not None:
+                self.on_load(loaded)
+            logging.info('load model {} from {} in {:.2f}s, {:.1f}MB'.format(name, self.model_dirs[name], time.time() - start_time, loaded.memory / 1024 ** 2))
+            with self.lock:
+                loaded.refs = 1
+                self.models[name] = loaded
+                self.memory[name] = loaded.memory
+                self.counter['loads'] += 1
+        self.evict()
+        return loaded
+
+    def release(self, loaded: LoadedModel):
+        with self.lock:
+            loaded.refs -= 1
+        self.evict()
+
+    def inference(self, name, func):
+        """Yield from func(loaded), the model is kept resident until the generator is exhausted or closed."""
+        loaded = self.acquire(name)
+        try:
+            yield from func(loaded)
+        finally:
+            self.release(loaded)
+
+    def evict(self, required: int = 0):
+        """Evict idle models in lru order until resident memory plus required fits memory_budget."""
+        if self.memory_budget <= 0:
+            return
+        while True:
+            with self.lock:
+                used = sum([i.memory for i in self.models.values()])
+                if used + required <= self.memory_budget:
+                    return
+                idle = [i for i in self.models.values() if i.refs == 0]
+                if len(idle) == 0:
+                    logging.warning('resident models use {:.1f}MB over budget {:.1f}MB, but all of them are busy'.format(
+                        (used + required) / 1024 ** 2, self.memory_budget / 1024 ** 2))
+                    return
+                loaded = self.models.pop(idle[0].name)
+                self.counter['evictions'] += 1
+            start_time = time.time()
+            if self.on_unload is not None:
+                self.on_unload(loaded)
+            name, memory = loaded.name, loaded.memory
+            del loaded
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            logging.info('evict model {} in {:.2f}s, {:.1f}MB'.format(name, time.time() - start_time, memory / 1024 ** 2))
+
+    def session_stats(self):
+        """Session_stats of every resident model, models served by worker processes or stubs have no sessions in this process."""
+        return {i.name: i.cosyvoice.model.session_stats() for i in self.resident() if hasattr(i.cosyvoice.model, 'session_stats')}
+
+    def _reap(self):
+        while True:
+            time.sleep(max(self.session_ttl / 4, 1))
+            for loaded in self.resident():
+                if hasattr(loaded.cosyvoice.model, 'reap_sessions'):
+                    reaped = loaded.cosyvoice.model.reap_sessions(self.session_ttl)
+                    with self.lock:
+                        self.counter['reaped_sessions'] += len(reaped)
+
+    def render_metrics(self):
+        """Residency, load/evict counters and tts session state in prometheus text format."""
+        sessions = self.session_stats()
+        with self.lock:
+            resident = {(('model', k), ): int(k in self.models) for k in self.model_dirs}
+            memory = {(('model', k), ): self.models[k].memory for k in self.models}
+            counter = dict(self.counter)
+        return ''.join([render_samples('model_resident', 'gauge', 'Whether a registered model is loaded.', resident),
+                        render_samples('model_memory_bytes', 'gauge', 'Parameter and buffer bytes of a resident model.', memory),
+                        render_samples('model_loads_total', 'counter', 'Model loads.', {(): counter['loads']}),
+                        render_samples('model_evictions_total', 'counter', 'Model evictions.', {(): counter['evictions']}),
+                        render_samples('model_sessions', 'gauge', 'Live tts sessions of a resident model.',
+                                       {(('model', k), ): v['sessions'] for k, v in sessions.items()}),
+                        render_samples('model_session_bytes', 'gauge', 'Bytes held by live tts sessions per cache type.',
+                                       {(('model', k), ('cache', c)): n for k, v in sessions.items() for c, n in v['bytes'].items()}),
+                        render_samples('model_oldest_session_seconds', 'gauge', 'Age of the oldest live tts session.',
+                                       {(('model', k), ): v['oldest_seconds'] for k, v in sessions.items()}),
+                        render_samples('model_reaped_sessions_total', 'counter', 'Tts sessions released after their consumer was idle for session_ttl.',
+                                       {(): counter['reaped_sessions']})])
+
+
+class ServerModels(ModelManager):
+    """ModelManager of fastapi and grpc servers, built from their shared command line args.
+
+    registers --model_dir as default and --models as name=model_dir, loads the default one, and attaches speaker store, worker pool
+    and result cache to every loaded model, files of models other than default get model name prefix.
+    concurrency is the number of synthesis threads of the server, split over worker processes of a model.
+    """
+
+    def __init__(self, args, concurrency: int):
+        self.args = args
+        self.concurrency = concurrency
+        super().__init__(int(args.memory_budget_gb * 1024 ** 3), on_load=self.attach, on_unload=self.detach,
+                         load_model=StubCosyVoice if args.stub is True else AutoModel, session_ttl=args.session_ttl, trt_concurrent=concurrency)
+        self.register('default', args.model_dir)
+        for i in args.models:
+            name, model_dir = i.split('=', 1)
+            self.register(name, model_dir)
+        self.release(self.acquire())
+
+    def attach(self, loaded):
+        args = self.args
+        loaded.cosyvoice.verbose = args.verbose
+        spk_store = args.spk_store
+        if spk_store != '' and loaded.name != self.default:
+            spk_store = os.path.join(os.path.dirname(spk_store), '{}.{}'.format(loaded.name, os.path.basename(spk_store)))
+        loaded.speaker_store = SpeakerStore(loaded.cosyvoice, spk_store)
+        # NOTE worker processes load their own copy of the model, the parent one is kept for prompt extraction, cache keys and bistream
+        loaded.worker_pool = None
+        if args.num_procs > 0:
+            loaded.worker_pool = WorkerPool(args.num_procs, loaded.cosyvoice.model_dir, args.threads_per_proc, concurrency=-(-self.concurrency // args.num_procs),
+                                            pin=args.pin_cpus, cosyvoice=loaded.cosyvoice, load_model=self.load_model)
+        cache_dir = os.path.join(args.cache_dir, loaded.name) if args.cache_dir != '' else ''
+        loaded.result_cache = ResultCache(loaded.cosyvoice, args.cache_memory_mb * 1024 ** 2, cache_dir, args.cache_disk_mb * 1024 ** 2,
+                                          backend=loaded.worker_pool)
+
+    def detach(self, loaded):
+        if loaded.worker_pool is not None:
+            loaded.worker_pool.close()
+
+    def render_metrics(self):
+        """Metrics of ModelManager, result caches and worker pools of resident models in prometheus text format."""
+        resident = self.resident()
+        caches = {i.name: i.result_cache for i in resident}
+        workers = ''.join([i.worker_pool.render_metrics() for i in resident if i.worker_pool is not None])
+        return super().render_metrics() + render_cache_metrics(caches) + workers
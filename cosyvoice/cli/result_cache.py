@@ -0,0 +1,215 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import io
+import os
+import time
+import hashlib
+import inspect
+import logging
+import threading
+from collections import OrderedDict
+from typing import Generator
+import torch
+from cosyvoice.cli.model import seeded
+from cosyvoice.utils.metrics import get_metrics, render_samples
+
+
+class ResultCache:
+    """Cache synthesized chunks of seeded requests in front of cosyvoice inference_*, hits are replayed as the same chunk stream.
+
+    key is a hash of model, mode, seed, normalized tts_text segments and every other argument, prompt wav and speaker features by content.
+    memory tier is an lru bounded by memory_bytes, disk tier keeps one file per key in disk_dir/<key[:2]>/, evicted by last access time.
+    NOTE requests are cached only if seed is given, tts_text is not a generator and llm is not vllm, whose sampling is not seeded.
+        seeded tts sessions sample from generators of their own, see seeded, so concurrent requests do not change a cached result.
+    backend, e.g. WorkerPool, runs synthesis in place of cosyvoice if given, except text generator of bistream inference.
+    """
+
+    def __init__(self, cosyvoice, memory_bytes: int = 0, disk_dir: str = '', disk_bytes: int = 10 * 1024 ** 3, backend=None):
+        self.cosyvoice = cosyvoice
+        self.backend = backend
+        self.memory_bytes = memory_bytes
+        self.disk_dir = disk_dir
+        self.disk_bytes = disk_bytes
+        self.lock = threading.Lock()
+        self.memory, self.memory_size = OrderedDict(), 0
+        self.disk, self.disk_size = OrderedDict(), 0
+        self.counter = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'uncacheable': 0}
+        if disk_dir != '':
+            os.makedirs(disk_dir, exist_ok=True)
+            files = []
+            for root, _, names in os.walk(disk_dir):
+                files += [(i[:-3], os.stat(os.path.join(root, i))) for i in names if i.endswith('.pt')]
+            for key, stat in sorted(files, key=lambda x: x[1].st_mtime):
+                self.disk[key] = stat.st_size
+                self.disk_size += stat.st_size
+            logging.info('load {} cached results of {} bytes from {}'.format(len(self.disk), self.disk_size, disk_dir))
+
+    @property
+    def enabled(self):
+        return self.memory_bytes > 0 or self.disk_dir != ''
+
+    def path(self, key):
+        return os.path.join(self.disk_dir, key[:2], '{}.pt'.format(key))
+
+    def update(self, hash, value):
+        if isinstance(value, torch.Tensor):
+            hash.update('{}{}'.format(value.dtype, tuple(value.shape)).encode())
+            value = value.detach().cpu().contiguous().numpy().tobytes()
+        elif isinstance(value, dict):
+            for k in sorted(value.keys()):
+                hash.update(k.encode())
+                self.update(hash, value[k])
+            return
+        elif isinstance(value, (list, tuple)):
+            hash.update('[{}]'.format(len(value)).encode())
+            for i in value:
+                self.update(hash, i)
+            return
+        elif isinstance(value, io.BytesIO):
+            value = value.getvalue()
+        elif not isinstance(value, bytes):
+            value = repr(value).encode()
+        hash.update(len(value).to_bytes(8, 'little'))
+        hash.update(value)
+
+    def key(self, mode, seed, arguments):
+        hash = hashlib.sha256()
+        self.update(hash, [self.cosyvoice.model_dir, self.cosyvoice.sample_rate, mode, seed])
+        for k, v in sorted(arguments.items()):
+            if k == 'tts_text':
+                # NOTE different raw text with the same normalized segments share one entry
+                v = self.cosyvoice.frontend.text_normalize(v, split=True, text_frontend=arguments.get('text_frontend', True))
+            elif k in ['prompt_wav', 'source_wav'] and isinstance(v, str) and v != '':
+                with open(v, 'rb') as f:
+                    v = f.read()
+            elif k in ['spk_id', 'zero_shot_spk_id'] and v != '':
+                # registered speaker may be replaced under the same id, so its features are hashed
+                v = [v, self.cosyvoice.frontend.spk2info[v]]
+            hash.update(k.encode())
+            self.update(hash, v)
+        return hash.hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.counter['memory_hits'] += 1
+                return self.memory[key]
+            on_disk = key in self.disk
+        if on_disk is True:
+            try:
+                chunks = torch.load(self.path(key))
+                os.utime(self.path(key))
+            except Exception:
+                logging.exception('failed to load cached result {}'.format(key))
+                chunks = None
+            with self.lock:
+                if chunks is not None and key in self.disk:
+                    self.disk.move_to_end(key)
+                    self.counter['disk_hits'] += 1
+                    self._put_memory(key, chunks)
+                    return chunks
+                if key in self.disk:
+                    self.disk_size -= self.disk.pop(key)
+        with self.lock:
+            self.counter['misses'] += 1
+        return None
+
+    def _put_memory(self, key, chunks):
+        size = sum([i.numel() * i.element_size() for i in chunks])
+        if size > self.memory_bytes:
+            return
+        if key in self.memory:
+            self.memory_size -= sum([i.numel() * i.element_size() for i in self.memory.pop(key)])
+        self.memory[key] = chunks
+        self.memory_size += size
+        while self.memory_size > self.memory_bytes:
+            self.memory_size -= sum([i.numel() * i.element_size() for i in self.memory.popitem(last=False)[1]])
+
+    def put(self, key, chunks):
+        with self.lock:
+            self._put_memory(key, chunks)
+        if self.disk_dir == '':
+            return
+        # NOTE write then rename outside lock, so readers never see a partial file
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        torch.save(chunks, '{}.{}.tmp'.format(path, threading.get_ident()))
+        os.replace('{}.{}.tmp'.format(path, threading.get_ident()), path)
+        size = os.path.getsize(path)
+        with self.lock:
+            self.disk_size += size - self.disk.pop(key, 0)
+            self.disk[key] = size
+            while self.disk_size > self.disk_bytes and len(self.disk) > 1:
+                evict_key, evict_size = self.disk.popitem(last=False)
+                self.disk_size -= evict_size
+                try:
+                    os.remove(self.path(evict_key))
+                except FileNotFoundError:
+                    pass
+
+    def inference(self, mode, *args, seed=None, **kwargs):
+        """Same as cosyvoice.inference_<mode>(*args, **kwargs), sampling is seeded with seed if given, which makes the request cacheable."""
+        func = getattr(self.cosyvoice, 'inference_{}'.format(mode))
+        arguments = inspect.signature(func).bind(*args, **kwargs)
+        arguments.apply_defaults()
+        arguments = dict(arguments.arguments)
+
+        def synthesize():
+            if self.backend is not None and not isinstance(arguments.get('tts_text'), Generator):
+                return self.backend.inference(mode, *args, seed=seed, **kwargs)
+            return seeded(func(*args, **kwargs), seed) if seed is not None else func(*args, **kwargs)
+        if seed is None or self.enabled is False or isinstance(arguments.get('tts_text'), Generator) or hasattr(self.cosyvoice.model.llm, 'vllm'):
+            if self.enabled is True:
+                with self.lock:
+                    self.counter['uncacheable'] += 1
+            yield from synthesize()
+            return
+        start_time = time.time()
+        key = self.key(mode, seed, arguments)
+        chunks = self.get(key)
+        get_metrics().observe('cache_lookup_seconds', time.time() - start_time)
+        if chunks is not None:
+            for i in chunks:
+                yield {'tts_speech': i}
+            return
+        chunks = []
+        for model_output in synthesize():
+            chunks.append(model_output['tts_speech'])
+            yield model_output
+        # only complete results are cached, an early closed request never reaches here
+        self.put(key, chunks)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.counter['memory_hits'] + self.counter['disk_hits'] + self.counter['misses']
+            return dict(self.counter, hit_rate=(lookups - self.counter['misses']) / lookups if lookups != 0 else 0.0,
+                        memory_entries=len(self.memory), memory_bytes=self.memory_size, disk_entries=len(self.disk), disk_bytes=self.disk_size)
+
+
+def render_cache_metrics(caches: dict):
+    """stats of result caches in prometheus text format, caches maps model name to its ResultCache."""
+    stats = {k: v.stats() for k, v in caches.items()}
+    metrics = []
+    for name, type, help, keys in [('result_cache_hits_total', 'counter', 'Result cache hits.', [('memory_hits', 'memory'), ('disk_hits', 'disk')]),
+                                   ('result_cache_misses_total', 'counter', 'Result cache misses of seeded requests.', [('misses', None)]),
+                                   ('result_cache_uncacheable_total', 'counter', 'Requests without seed or not deterministic.', [('uncacheable', None)]),
+                                   ('result_cache_entries', 'gauge', 'Cached results.', [('memory_entries', 'memory'), ('disk_entries', 'disk')]),
+                                   ('result_cache_bytes', 'gauge', 'Bytes of cached results.', [('memory_bytes', 'memory'), ('disk_bytes', 'disk')])]:
+        samples = {}
+        for model, v in stats.items():
+            for key, tier in keys:
+                samples[(('model', model), ) if tier is None else (('model', model), ('tier', tier))] = v[key]
+        metrics.append(render_samples(name, type, help, samples))
+    return ''.join(metrics)
@@ -0,0 +1,249 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+import heapq
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from cosyvoice.utils.metrics import render_samples
+
+PRIORITIES = {'interactive': 0, 'batch': 1}
+
+
+class DeadlineExceeded(Exception):
+    """Raised to the waiting client when its queued job is shed at deadline."""
+
+
+class Job:
+    def __init__(self, fn, priority, arrival, deadline, on_shed):
+        self.fn = fn
+        self.priority = priority
+        self.arrival = arrival
+        self.deadline = deadline
+        self.on_shed = on_shed
+        self.cancelled = False
+
+
+class Scheduler:
+    """Run blocking inference jobs in max_workers threads, queued jobs are dispatched by priority class then earliest deadline.
+
+    deadline is the latest time a job may start, not a completion time, a job is rejected at submit if its estimated wait already misses
+    the deadline, and shed if it is still queued at its deadline. policy fifo keeps arrival order and never sheds, as a baseline.
+    batch jobs use at most max_batch_workers, so long paragraphs never take the last worker from interactive requests.
+    a batch job is promoted to interactive class aging seconds before its deadline and then competes by deadline, so a steady stream of
+    interactive requests can not starve batch, default aging is the interactive deadline, 0 means strict priority.
+    NOTE service time of every class is an exponential moving average of finished jobs, used to estimate wait.
+    """
+
+    def __init__(self, max_workers: int = 4, max_in_flight: int = 8, deadlines: dict = None, policy: str = 'edf', max_batch_workers: int = None,
+                 aging: float = None):
+        assert max_in_flight >= max_workers, 'max_in_flight {} should not be less than max_workers {}'.format(max_in_flight, max_workers)
+        assert policy in ['edf', 'fifo']
+        self.max_workers = max_workers
+        self.max_in_flight = max_in_flight
+        self.deadlines = {'interactive': 2.0, 'batch': 60.0} if deadlines is None else deadlines
+        self.policy = policy
+        self.max_batch_workers = max(max_workers - 1, 1) if max_batch_workers is None else max_batch_workers
+        self.aging = self.deadlines['interactive'] if aging is None else aging
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='inference')
+        self.condition = threading.Condition()
+        self.queue = []
+        self.seq = 0
+        self.running = {k: 0 for k in PRIORITIES}
+        self.service_time = {k: 0.0 for k in PRIORITIES}
+        self.wait_time = {k: deque(maxlen=1000) for k in PRIORITIES}
+        self.counter = {k: {'admitted': 0, 'rejected': 0, 'shed': 0, 'promoted': 0, 'completed': 0} for k in PRIORITIES}
+        threading.Thread(target=self._dispatch, name='scheduler', daemon=True).start()
+
+    @property
+    def in_flight(self):
+        return len(self.queue) + sum(self.running.values())
+
+    def key(self, priority, deadline, now=None):
+        if self.policy == 'fifo':
+            return (self.seq, )
+        # NOTE a batch job within aging seconds of its deadline sorts as interactive
+        urgent = now is not None and deadline - self.aging <= now
+        return (0 if urgent else PRIORITIES[priority], deadline, self.seq)
+
+    def available(self, priority):
+        if sum(self.running.values()) >= self.max_workers:
+            return False
+        return priority != 'batch' or self.policy == 'fifo' or self.running['batch'] < self.max_batch_workers
+
+    def estimate_wait(self, priority, key):
+        ahead = [job for k, job in self.queue if k < key]
+        if len(ahead) == 0 and self.available(priority):
+            return 0.0
+        # running jobs are assumed half done on average
+        work = sum([self.service_time[job.priority] for job in ahead]) + sum([0.5 * self.service_time[k] * v for k, v in self.running.items()])
+        return work / self.max_workers
+
+    def submit(self, fn, priority: str = 'interactive', deadline: float = None, on_shed=None):
+        """Queue fn, which runs in a worker thread, deadline is seconds from now, return Job, or None if rejected.
+
+        on_shed is called without arguments if the job is dropped from queue at its deadline.
+        """
+        assert priority in PRIORITIES, 'unsupported priority {}, choose from {}'.format(priority, list(PRIORITIES.keys()))
+        with self.condition:
+            now = time.time()
+            deadline = now + (self.deadlines[priority] if deadline is None else deadline)
+            key = self.key(priority, deadline, now)
+            if self.in_flight >= self.max_in_flight or (self.policy == 'edf' and now + self.estimate_wait(priority, key) > deadline):
+                self.counter[priority]['rejected'] += 1
+                return None
+            job = Job(fn, priority, now, deadline, on_shed)
+            heapq.heappush(self.queue, (key, job))
+            self.seq += 1
+            self.counter[priority]['admitted'] += 1
+            self.condition.notify_all()
+            return job
+
+    def cancel(self, job):
+        """Drop job if it is still queued, e.g. client disconnected."""
+        with self.condition:
+            job.cancelled = True
+            self.condition.notify_all()
+
+    def _shed(self, now):
+        queue = []
+        for k, job in self.queue:
+            if job.cancelled is True:
+                continue
+            if self.policy == 'edf' and job.deadline < now:
+                self.counter[job.priority]['shed'] += 1
+                if job.on_shed is not None:
+                    job.on_shed()
+                continue
+            queue.append((k, job))
+        if len(queue) != len(self.queue):
+            heapq.heapify(queue)
+            self.queue = queue
+
+    def _promote(self, now):
+        promoted = False
+        for i, (k, job) in enumerate(self.queue):
+            if self.policy == 'edf' and k[0] != 0 and job.deadline - self.aging <= now:
+                self.queue[i] = ((0, ) + k[1:], job)
+                self.counter[job.priority]['promoted'] += 1
+                promoted = True
+        if promoted is True:
+            heapq.heapify(self.queue)
+
+    def _next(self):
+        """Index of the first queued job in key order which may start now, promoted batch jobs at max_batch_workers do not block others."""
+        if len(self.queue) == 0:
+            return None
+        if self.available(self.queue[0][1].priority):
+            return 0
+        for k, job in sorted(self.queue, key=lambda x: x[0]):
+            if self.available(job.priority):
+                return self.queue.index((k, job))
+        return None
+
+    def _dispatch(self):
+        with self.condition:
+            while True:
+                now = time.time()
+                self._shed(now)
+                self._promote(now)
+                i = self._next()
+                if i is not None:
+                    job = self.queue.pop(i)[1] if i != 0 else heapq.heappop(self.queue)[1]
+                    if i != 0:
+                        heapq.heapify(self.queue)
+                    self.running[job.priority] += 1
+                    self.wait_time[job.priority].append(now - job.arrival)
+                    self.executor.submit(self._run, job)
+                    continue
+                timeout = None
+                if self.policy == 'edf' and len(self.queue) != 0:
+                    # wake at next deadline, or next promotion of a batch job
+                    timeout = max(min([job.deadline - (self.aging if k[0] != 0 else 0) for k, job in self.queue]) - now, 0.001)
+                self.condition.wait(timeout)
+
+    def _run(self, job):
+        start_time = time.time()
+        try:
+            job.fn()
+        except Exception:
+            logging.exception('job failed')
+        finally:
+            with self.condition:
+                self.running[job.priority] -= 1
+                self.counter[job.priority]['completed'] += 1
+                service_time = time.time() - start_time
+                self.service_time[job.priority] = service_time if self.service_time[job.priority] == 0 else \
+                    0.8 * self.service_time[job.priority] + 0.2 * service_time
+                self.condition.notify_all()
+
+    def stats(self):
+        """Queue depth, running jobs, counters, service time and recent wait time percentiles of every priority class."""
+        with self.condition:
+            stats = {}
+            for k in PRIORITIES:
+                wait_time = list(self.wait_time[k])
+                stats[k] = dict(self.counter[k], queued=len([job for _, job in self.queue if job.priority == k]), running=self.running[k],
+                                service_time=self.service_time[k])
+                for q in [50, 90, 99]:
+                    stats[k]['wait_p{}'.format(q)] = float(np.percentile(wait_time, q)) if len(wait_time) != 0 else 0.0
+            return stats
+
+    def render_metrics(self):
+        """stats in prometheus text format, labeled by priority class."""
+        stats = self.stats()
+        metrics = []
+        for k, type, help in [('admitted', 'counter', 'Admitted requests.'), ('rejected', 'counter', 'Requests rejected at submit.'),
+                              ('shed', 'counter', 'Requests dropped from queue at deadline.'),
+                              ('promoted', 'counter', 'Batch requests promoted near deadline.'), ('completed', 'counter', 'Completed requests.'),
+                              ('queued', 'gauge', 'Waiting requests.'), ('running', 'gauge', 'Running requests.'),
+                              ('service_time', 'gauge', 'Moving average of service seconds.'), ('wait_p99', 'gauge', 'p99 of recent queue wait seconds.')]:
+            name = 'scheduler_{}_total'.format(k) if type == 'counter' else 'scheduler_{}'.format(k)
+            metrics.append(render_samples(name, type, help, {(('priority', p), ): stats[p][k] for p in PRIORITIES}))
+        return ''.join(metrics)
+
+
+if __name__ == '__main__':
+    import random
+    # simulate mixed traffic against a stub model, interactive requests take 0.2s, compare deadline misses of interactive requests between fifo
+    # and edf with shedding in a burst of 2s batch paragraphs, and batch starvation of strict priority (aging 0) under heavy interactive load
+    for mix, rate, interactive_share, batch_time, batch_deadline in [('burst', 4, 0.8, 2.0, 10.0), ('interactive heavy', 12, 0.9, 1.0, 3.0)]:
+        for policy, aging in [('fifo', None), ('edf', 0.0), ('edf', None)]:
+            if mix != 'burst' and policy == 'fifo':
+                continue
+            random.seed(0)
+            scheduler = Scheduler(max_workers=2, max_in_flight=32, deadlines={'interactive': 0.5, 'batch': batch_deadline}, policy=policy, aging=aging)
+            start_delay, lock = {k: [] for k in PRIORITIES}, threading.Lock()
+
+            def stub_job(priority, arrival):
+                with lock:
+                    start_delay[priority].append(time.time() - arrival)
+                time.sleep(0.2 if priority == 'interactive' else batch_time)
+            start_time = time.time()
+            while time.time() - start_time < 10:
+                priority = 'interactive' if random.random() < interactive_share else 'batch'
+                arrival = time.time()
+                scheduler.submit(lambda p=priority, a=arrival: stub_job(p, a), priority)
+                time.sleep(random.expovariate(rate))
+            while scheduler.in_flight != 0:
+                time.sleep(0.1)
+            stats = scheduler.stats()
+            for k in PRIORITIES:
+                delay = np.array(start_delay[k])
+                print('{} policy {} aging {} {} admitted {} rejected {} shed {} promoted {} completed {} start delay p50 {:.3f}s p99 {:.3f}s missed deadline {}'.format(
+                    mix, policy, scheduler.aging if policy == 'edf' else '-', k, stats[k]['admitted'], stats[k]['rejected'], stats[k]['shed'],
+                    stats[k]['promoted'], stats[k]['completed'], np.percentile(delay, 50), np.percentile(delay, 99),
+                    int((delay > scheduler.deadlines[k]).sum())))
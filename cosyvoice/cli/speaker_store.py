@@ -0,0 +1,75 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import time
+import uuid
+import threading
+import logging
+import torch
+
+
+class SpeakerStore:
+    """Zero shot speakers registered at runtime, kept in frontend spk2info so requests reuse them by zero_shot_spk_id.
+
+    NOTE only registered speakers are persisted to path, builtin speakers of spk2info.pt are read only.
+    """
+
+    def __init__(self, cosyvoice, path: str = ''):
+        self.cosyvoice = cosyvoice
+        self.path = path
+        self.lock = threading.Lock()
+        self.speakers = {}
+        if path != '' and os.path.exists(path):
+            store = torch.load(path, map_location=cosyvoice.frontend.device)
+            for spk_id, spk in store.items():
+                cosyvoice.frontend.spk2info[spk_id] = spk['model_input']
+                self.speakers[spk_id] = spk['meta']
+            logging.info('load {} registered speakers from {}'.format(len(store), path))
+
+    def __contains__(self, spk_id):
+        return spk_id in self.speakers
+
+    def list(self):
+        return list(self.speakers.keys())
+
+    def get(self, spk_id):
+        return dict(self.speakers[spk_id], spk_id=spk_id)
+
+    def add(self, prompt_text, prompt_wav, spk_id=''):
+        """Extract prompt features once and register them, return spk_id, a new id is generated if spk_id is empty."""
+        if spk_id == '':
+            spk_id = uuid.uuid4().hex
+        assert spk_id in self.speakers or spk_id not in self.cosyvoice.frontend.spk2info, 'can not overwrite builtin speaker {}'.format(spk_id)
+        # NOTE feature extraction is slow, do not hold lock
+        self.cosyvoice.add_zero_shot_spk(prompt_text, prompt_wav, spk_id)
+        model_input = self.cosyvoice.frontend.spk2info[spk_id]
+        with self.lock:
+            self.speakers[spk_id] = {'prompt_text': prompt_text, 'prompt_speech_token_len': int(model_input['flow_prompt_speech_token_len'].item()),
+                                     'create_time': time.time()}
+            self.save()
+        return spk_id
+
+    def delete(self, spk_id):
+        with self.lock:
+            del self.speakers[spk_id]
+            self.cosyvoice.frontend.spk2info.pop(spk_id, None)
+            self.save()
+
+    def save(self):
+        if self.path == '':
+            return
+        store = {k: {'model_input': self.cosyvoice.frontend.spk2info[k], 'meta': v} for k, v in self.speakers.items()}
+        # write then rename, so a crash never leaves a broken store
+        torch.save(store, '{}.tmp'.format(self.path))
+        os.replace('{}.tmp'.format(self.path), self.path)
@@ -0,0 +1,96 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+from typing import Generator
+import torch
+from cosyvoice.cli.cosyvoice import track_inference
+
+
+class StubFrontEnd:
+    device = 'cpu'
+
+    def __init__(self):
+        self.spk2info = {'中文女': {'llm_embedding': torch.zeros(1, 192), 'flow_embedding': torch.zeros(1, 192)}}
+
+    def text_normalize(self, text, split=True, text_frontend=True):
+        return [text] if split is True else text
+
+
+class StubModel:
+    def __init__(self):
+        self.llm, self.flow, self.hift = torch.nn.Identity(), torch.nn.Identity(), torch.nn.Identity()
+
+
+class StubCosyVoice:
+    """Stand-in of CosyVoice2 without weights, for load tests of the runtimes and dispatch benchmarks.
+
+    every character of tts_text yields seconds_per_char seconds of silence, in chunks of chunk_seconds if stream,
+    a chunk costs rtf times its duration, slept like gpu inference, or spent in gil bound python work like the cpu tts loop if busy.
+    """
+
+    sample_rate = 24000
+    verbose = True
+
+    def __init__(self, model_dir='stub', rtf=0.1, busy=False, seconds_per_char=0.2, chunk_seconds=1.0, **kwargs):
+        self.model_dir = model_dir
+        self.rtf = rtf
+        self.busy = busy
+        self.seconds_per_char = seconds_per_char
+        self.chunk_seconds = chunk_seconds
+        self.model = StubModel()
+        self.frontend = StubFrontEnd()
+
+    def list_available_spks(self):
+        return list(self.frontend.spk2info.keys())
+
+    def add_zero_shot_spk(self, prompt_text, prompt_wav, zero_shot_spk_id):
+        assert zero_shot_spk_id != '', 'do not use empty zero_shot_spk_id'
+        self.frontend.spk2info[zero_shot_spk_id] = {'prompt_text': prompt_text, 'flow_prompt_speech_token_len': torch.tensor([len(prompt_text) * 5])}
+        return True
+
+    def work(self, seconds):
+        if self.busy is False:
+            time.sleep(seconds)
+            return
+        end_time = time.perf_counter() + seconds
+        while time.perf_counter() < end_time:
+            pass
+
+    def synthesize(self, tts_text, stream=False, speed=1.0, text_frontend=True):
+        for text in self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend):
+            if isinstance(text, Generator):
+                text = ''.join(text)
+            speech_len = int(len(text) * self.seconds_per_char / speed * self.sample_rate)
+            chunk_len = int(self.chunk_seconds * self.sample_rate) if stream is True else speech_len
+            for start in range(0, speech_len, max(chunk_len, 1)):
+                n = min(chunk_len, speech_len - start)
+                self.work(self.rtf * n / self.sample_rate)
+                yield {'tts_speech': torch.zeros(1, n)}
+
+    @track_inference
+    def inference_sft(self, tts_text, spk_id, stream=False, speed=1.0, text_frontend=True):
+        assert spk_id in self.frontend.spk2info, 'speaker {} not found'.format(spk_id)
+        yield from self.synthesize(tts_text, stream, speed, text_frontend)
+
+    @track_inference
+    def inference_zero_shot(self, tts_text, prompt_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
+        yield from self.synthesize(tts_text, stream, speed, text_frontend)
+
+    @track_inference
+    def inference_cross_lingual(self, tts_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
+        yield from self.synthesize(tts_text, stream, speed, text_frontend)
+
+    @track_inference
+    def inference_instruct2(self, tts_text, instruct_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
+        yield from self.synthesize(tts_text, stream, speed, text_frontend)
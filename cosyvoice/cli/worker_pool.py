@@ -0,0 +1,260 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import time
+import queue
+import inspect
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from cosyvoice.cli.cosyvoice import AutoModel
+from cosyvoice.cli.model import seeded
+from cosyvoice.utils.metrics import render_samples
+
+
+class RingWriter:
+    """Worker side of a float32 ring buffer in shared memory, the parent advances read_pos once a chunk is copied out."""
+
+    def __init__(self, buffer, read_pos):
+        self.buffer = np.frombuffer(buffer, dtype=np.float32)
+        self.size = len(self.buffer)
+        self.read_pos = read_pos
+        self.write_pos = 0
+
+    def write(self, speech):
+        """Copy speech into ring, wait while the parent has not read enough, return (offset, end) where end is the new write_pos."""
+        n = len(speech)
+        offset = self.write_pos % self.size
+        if offset + n > self.size:
+            # NOTE a chunk is never split, skip the tail of ring and start over
+            self.write_pos += self.size - offset
+            offset = 0
+        while self.write_pos + n - self.read_pos.value > self.size:
+            time.sleep(0.001)
+        self.buffer[offset: offset + n] = speech
+        self.write_pos += n
+        return offset, self.write_pos
+
+
+def worker_main(index, load_model, model_kwargs, num_threads, cpus, concurrency, requests, responses, buffer, read_pos):
+    """Model worker process, runs inference_<mode> of its own model and returns chunks through ring buffer."""
+    torch.set_num_threads(num_threads)
+    if cpus is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    cosyvoice = load_model(**model_kwargs)
+    cosyvoice.verbose = False
+    ring, lock, cancelled = RingWriter(buffer, read_pos), threading.Lock(), set()
+
+    def run(request_id, mode, args, kwargs, seed, speakers):
+        try:
+            cosyvoice.frontend.spk2info.update(speakers)
+            model_output = getattr(cosyvoice, 'inference_{}'.format(mode))(*args, **kwargs)
+            if seed is not None:
+                model_output = seeded(model_output, seed)
+            try:
+                for i in model_output:
+                    if request_id in cancelled:
+                        break
+                    speech = i['tts_speech'].cpu().numpy().astype(np.float32).reshape(-1)
+                    with lock:
+                        if len(speech) > ring.size:
+                            # longer than ring, fall back to pickle
+                            responses.put(('array', request_id, speech))
+                        else:
+                            responses.put(('chunk', request_id, len(speech)) + ring.write(speech))
+            finally:
+                model_output.close()
+            responses.put(('end', request_id))
+        except Exception as e:
+            logging.exception('worker {} inference failed'.format(index))
+            responses.put(('error', request_id, repr(e)))
+        finally:
+            cancelled.discard(request_id)
+
+    responses.put(('ready', None, cosyvoice.sample_rate))
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='worker{}'.format(index))
+    while True:
+        message = requests.get()
+        if message is None:
+            break
+        if message[0] == 'cancel':
+            cancelled.add(message[1])
+        else:
+            executor.submit(run, *message[1:])
+    executor.shutdown(wait=True)
+    responses.put(None)
+
+
+class WorkerPool:
+    """Shard inference over num_workers processes, each with its own model and torch threads, to get around the gil of a single process.
+
+    requests go to the worker with the least requests in flight, chunks come back through a shared memory ring buffer per worker
+    instead of pickled tensors. cosyvoice is the model of the parent process, its registered speakers are sent along with requests.
+    NOTE text generator of bistream inference can not be sent to another process, run it in the parent process instead.
+    """
+
+    def __init__(self, num_workers: int, model_dir: str = '', num_threads: int = 0, concurrency: int = 1, ring_mb: int = 16, pin: bool = False,
+                 cosyvoice=None, load_model=AutoModel, **model_kwargs):
+        cores = os.cpu_count()
+        num_threads = max(cores // num_workers, 1) if num_threads <= 0 else num_threads
+        context = multiprocessing.get_context('spawn')
+        self.num_workers = num_workers
+        self.cosyvoice = cosyvoice
+        self.lock = threading.Lock()
+        self.load = [0] * num_workers
+        self.counter = [0] * num_workers
+        self.waiting, self.seq = {}, 0
+        self.requests, self.responses, self.buffers, self.read_pos, self.processes = [], [], [], [], []
+        for i in range(num_workers):
+            buffer = context.RawArray('f', ring_mb * 1024 ** 2 // 4)
+            cpus = set([(i * num_threads + j) % cores for j in range(num_threads)]) if pin is True else None
+            self.requests.append(context.Queue())
+            self.responses.append(context.Queue())
+            self.buffers.append(np.frombuffer(buffer, dtype=np.float32))
+            self.read_pos.append(context.RawValue('q', 0))
+            process = context.Process(target=worker_main, name='model_worker{}'.format(i), daemon=True,
+                                      args=(i, load_model, dict(model_kwargs, model_dir=model_dir), num_threads, cpus, concurrency,
+                                            self.requests[i], self.responses[i], buffer, self.read_pos[i]))
+            process.start()
+            self.processes.append(process)
+        start_time = time.time()
+        for i in range(num_workers):
+            message = self.responses[i].get()
+            assert message is not None and message[0] == 'ready', 'worker {} failed to start'.format(i)
+            self.sample_rate = message[2]
+            threading.Thread(target=self._read, args=(i, ), name='worker_reader{}'.format(i), daemon=True).start()
+        logging.info('start {} model workers with {} threads each in {:.2f}s'.format(num_workers, num_threads, time.time() - start_time))
+
+    def _read(self, index):
+        """Copy chunks out of ring buffer of worker index and hand them to waiting requests."""
+        while True:
+            message = self.responses[index].get()
+            if message is None:
+                break
+            kind, request_id = message[0], message[1]
+            if kind == 'chunk':
+                n, offset, end = message[2:]
+                speech = torch.from_numpy(self.buffers[index][offset: offset + n].copy())
+                self.read_pos[index].value = end
+                message = ('chunk', speech)
+            elif kind == 'array':
+                message = ('chunk', torch.from_numpy(message[2]))
+            else:
+                message = (kind, ) + message[2:]
+            with self.lock:
+                waiting = self.waiting.get(request_id)
+            if waiting is not None:
+                waiting.put(message)
+
+    def inference(self, mode, *args, seed=None, **kwargs):
+        """Same as cosyvoice.inference_<mode>(*args, **kwargs) but run in the least loaded worker, sampling is seeded with seed if given."""
+        speakers = {}
+        if self.cosyvoice is not None:
+            arguments = inspect.signature(getattr(self.cosyvoice, 'inference_{}'.format(mode))).bind(*args, **kwargs).arguments
+            for k in ['spk_id', 'zero_shot_spk_id']:
+                if arguments.get(k, '') in self.cosyvoice.frontend.spk2info:
+                    speakers[arguments[k]] = self.cosyvoice.frontend.spk2info[arguments[k]]
+        with self.lock:
+            index = min(range(self.num_workers), key=lambda i: self.load[i])
+            self.load[index] += 1
+            self.counter[index] += 1
+            request_id, self.seq = self.seq, self.seq + 1
+            waiting = self.waiting[request_id] = queue.Queue()
+        self.requests[index].put(('run', request_id, mode, args, kwargs, seed, speakers))
+        finished = False
+        try:
+            while True:
+                try:
+                    message = waiting.get(timeout=1)
+                except queue.Empty:
+                    if self.processes[index].is_alive() is False:
+                        finished = True
+                        raise RuntimeError('worker {} exited with code {}'.format(index, self.processes[index].exitcode))
+                    continue
+                if message[0] == 'chunk':
+                    yield {'tts_speech': message[1].unsqueeze(dim=0)}
+                    continue
+                finished = True
+                if message[0] == 'error':
+                    raise RuntimeError('worker {} inference failed, {}'.format(index, message[1]))
+                break
+        finally:
+            # NOTE closed early by consumer, worker stops at its next chunk
+            if finished is False:
+                self.requests[index].put(('cancel', request_id))
+            with self.lock:
+                self.waiting.pop(request_id)
+                self.load[index] -= 1
+
+    def close(self):
+        for i in range(self.num_workers):
+            self.requests[i].put(None)
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+
+    def stats(self):
+        with self.lock:
+            return [{'in_flight': self.load[i], 'requests': self.counter[i], 'alive': self.processes[i].is_alive()} for i in range(self.num_workers)]
+
+    def render_metrics(self):
+        """In flight and total requests of every worker in prometheus text format."""
+        stats = self.stats()
+        return ''.join([render_samples('worker_in_flight', 'gauge', 'Requests in flight of a model worker process.',
+                                       {(('worker', i), ): v['in_flight'] for i, v in enumerate(stats)}),
+                        render_samples('worker_requests_total', 'counter', 'Requests dispatched to a model worker process.',
+                                       {(('worker', i), ): v['requests'] for i, v in enumerate(stats)})])
+
+
+if __name__ == '__main__':
+    import argparse
+    from functools import partial
+    from cosyvoice.cli.stub_model import StubCosyVoice
+    # throughput of in process threads (workers 0) against N = 1...cores worker processes under the same concurrency
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, default='', help='empty means StubCosyVoice, which holds the gil like the tts loop on cpu')
+    parser.add_argument('--spk_id', type=str, default='中文女')
+    parser.add_argument('--tts_text', type=str, default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。')
+    parser.add_argument('--num_requests', type=int, default=32)
+    parser.add_argument('--concurrency', type=int, default=0, help='0 means 2 * cores')
+    args = parser.parse_args()
+    cores = os.cpu_count()
+    concurrency = 2 * cores if args.concurrency == 0 else args.concurrency
+    load_model = AutoModel if args.model_dir != '' else partial(StubCosyVoice, busy=True)
+    for num_workers in range(0, cores + 1):
+        if num_workers == 0:
+            model = load_model(model_dir=args.model_dir)
+            model.verbose = False
+
+            def inference(mode, *args, **kwargs):
+                return getattr(model, 'inference_{}'.format(mode))(*args, **kwargs)
+        else:
+            model = WorkerPool(num_workers, args.model_dir, concurrency=concurrency, load_model=load_model)
+            inference = model.inference
+
+        def request(_):
+            return sum([i['tts_speech'].shape[1] for i in inference('sft', args.tts_text, args.spk_id, stream=True)]) / model.sample_rate
+        list(ThreadPoolExecutor(1).map(request, range(1)))
+        start_time = time.time()
+        with ThreadPoolExecutor(concurrency) as executor:
+            speech_len = sum(executor.map(request, range(args.num_requests)))
+        cost = time.time() - start_time
+        print('workers {} requests {} concurrency {} cost {:.2f}s {:.2f} requests/s speech {:.1f}s, {:.2f}x realtime'.format(
+            num_workers, args.num_requests, concurrency, cost, args.num_requests / cost, speech_len, speech_len / cost))
+        if num_workers != 0:
+            model.close()
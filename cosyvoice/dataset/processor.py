@@ -13,7 +13,11 @@
 # limitations under the License.
 import logging
 import random
+import math
+import bisect
 
+import numpy as np
+import pyarrow as pa
 import pyarrow.parquet as pq
 from io import BytesIO
 import torch
@@ -24,14 +28,58 @@ import pyworld as pw
 
 
 AUDIO_FORMAT_SETS = {'flac', 'mp3', 'm4a', 'ogg', 'opus', 'wav', 'wma'}
+# columns of tools/make_parquet_list.py read by the pipeline, wav path and spk are never used after opener
+PARQUET_COLUMNS = ['utt', 'audio_data', 'text', 'instruct', 'utt_embedding', 'spk_embedding', 'speech_token', 'reject_speech_token']
+# audio metadata of tools/make_parquet_list.py or tools/backfill_parquet_metadata.py, filter rejects on it before decoding
+METADATA_COLUMNS = ['duration', 'sample_rate', 'num_samples', 'speech_token_len']
+PARQUET_COLUMNS += METADATA_COLUMNS
 
 
-def parquet_opener(data, mode='train', tts_data={}):
+def arrow_column_values(column):
+    """ Values of an arrow array without pandas, binary cells are zero-copy
+        memoryviews of the arrow data buffer, list cells are zero-copy numpy
+        views like the numpy arrays pandas gives, other cells are python objects.
+    """
+    if pa.types.is_binary(column.type) or pa.types.is_large_binary(column.type):
+        buffers = column.buffers()
+        offsets = np.frombuffer(buffers[1], dtype=np.int64 if pa.types.is_large_binary(column.type) else np.int32)
+        offsets = offsets[column.offset: column.offset + len(column) + 1].tolist()
+        data = memoryview(buffers[2]) if buffers[2] is not None else memoryview(b'')
+        values = [data[offsets[i]: offsets[i + 1]] for i in range(len(column))]
+    elif pa.types.is_list(column.type) or pa.types.is_large_list(column.type):
+        flat = column.values.to_numpy(zero_copy_only=False)
+        offsets = column.offsets.to_numpy().tolist()
+        values = [flat[offsets[i]: offsets[i + 1]] for i in range(len(column))]
+    else:
+        return column.to_pylist()
+    if column.null_count != 0:
+        values = [v if valid is True else None for v, valid in zip(values, column.is_valid().to_pylist())]
+    return values
+
+
+def parquet_rows(parquet_file, columns=None, batch_size=64):
+    """ Rows of parquet_file as dicts, read column-wise by arrow_column_values
+    """
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+        values = [arrow_column_values(batch.column(i)) for i in range(batch.num_columns)]
+        for row in zip(*values):
+            yield dict(zip(batch.schema.names, row))
+
+
+def parquet_opener(data, mode='train', tts_data={}, columns=PARQUET_COLUMNS, batch_size=64, feat_suffix=''):
     """ Give url or local file, return file descriptor
         Inplace operation.
 
+        Record batches are read column-wise with only columns that exist in
+        the file, audio_data is a memoryview into the arrow buffer, it can be
+        read by BytesIO but not pickled, filter drops it after decoding.
+
         Args:
             data(Iterable[str]): url or local file list
+            columns(List[str]): columns to read, None means all columns
+            feat_suffix(str): if not empty, also read rows of feature
+                sidecar shard url + feat_suffix written by
+                tools/extract_acoustic_feature.py, see load_feature
 
         Returns:
             Iterable[{src, stream}]
@@ -40,16 +88,22 @@ def parquet_opener(data, mode='train', tts_data={}):
         assert 'src' in sample
         url = sample['src']
         try:
-            for df in pq.ParquetFile(url).iter_batches(batch_size=64):
-                df = df.to_pandas()
-                for i in range(len(df)):
-                    sample.update(dict(df.loc[i]))
-                    if mode == 'train':
-                        # NOTE do not return sample directly, must initialize a new dict
-                        yield {**sample}
-                    else:
-                        for index, text in enumerate(tts_data[df.loc[i, 'utt']]):
-                            yield {**sample, 'tts_index': index, 'tts_text': text}
+            parquet_file = pq.ParquetFile(url)
+            names = parquet_file.schema_arrow.names if columns is None else [i for i in columns if i in parquet_file.schema_arrow.names]
+            # NOTE sidecar has a row of every row of url in the same order, with null features of utts dropped by extraction
+            feat_rows = parquet_rows(pq.ParquetFile(url + feat_suffix), None, batch_size) if feat_suffix != '' else None
+            for row in parquet_rows(parquet_file, names, batch_size):
+                if feat_rows is not None:
+                    feat_row = next(feat_rows)
+                    assert feat_row['utt'] == row['utt'], 'sidecar of {} does not match, extract feature again'.format(url)
+                    row.update(feat_row)
+                # NOTE do not return sample directly, must initialize a new dict
+                row = {**sample, **row}
+                if mode == 'train':
+                    yield row
+                else:
+                    for index, text in enumerate(tts_data[row['utt']]):
+                        yield {**row, 'tts_index': index, 'tts_text': text}
         except Exception as ex:
             logging.warning('Failed to open {}, ex info {}'.format(url, ex))
 
@@ -83,6 +137,20 @@ def filter(data,
             Iterable[{key, wav, label, sample_rate}]
     """
     for sample in data:
+        # NOTE token and metadata checks go first, a rejected utt is never decoded
+        if len(sample['text_token']) < token_min_length:
+            continue
+        if len(sample['text_token']) > token_max_length:
+            continue
+        if len(sample['speech_token']) == 0:
+            continue
+        if 'reject_speech_token' in sample and len(sample['reject_speech_token']) == 0:
+            continue
+        # num_samples is 0 if the header of audio_data does not tell, e.g. some mp3
+        if sample.get('num_samples', 0) > 0:
+            num_frames = sample['num_samples'] / sample['sample_rate'] * 100
+            if num_frames < min_length or num_frames > max_length:
+                continue
         sample['speech'], sample['sample_rate'] = torchaudio.load(BytesIO(sample['audio_data']))
         sample['speech'] = sample['speech'].mean(dim=0, keepdim=True)
         del sample['audio_data']
@@ -92,14 +160,6 @@ def filter(data,
             continue
         if num_frames > max_length:
             continue
-        if len(sample['text_token']) < token_min_length:
-            continue
-        if len(sample['text_token']) > token_max_length:
-            continue
-        if len(sample['speech_token']) == 0:
-            continue
-        if 'reject_speech_token' in sample and len(sample['reject_speech_token']) == 0:
-            continue
         if num_frames != 0:
             if len(sample['text_token']) / num_frames < min_output_input_ratio:
                 continue
@@ -136,23 +196,44 @@ def resample(data, resample_rate=22050, min_sample_rate=16000, mode='train'):
         yield sample
 
 
-def truncate(data, truncate_length=24576, mode='train'):
+def truncate(data, truncate_length=24576, hop_size=0, feat_pad_value=math.log(1e-5), token_mel_ratio=0, mode='train'):
     """ Truncate data.
 
         Args:
             data: Iterable[{key, wav, label, sample_rate}]
             truncate_length: truncate length
+            hop_size: if speech_feat is loaded by load_feature, start at
+                a multiple of hop_size and truncate speech_feat/pitch_feat
+                to the same frames
+            token_mel_ratio: align loaded features and speech_token after
+                truncation like compute_fbank does, load_feature before it
+                should not align them
+            feat_pad_value: speech_feat of zero padded speech, log of the
+                clamp value of mel_spectrogram
 
         Returns:
             Iterable[{key, wav, label, sample_rate}]
     """
     for sample in data:
         waveform = sample['speech']
+        feat = hop_size != 0 and 'speech_feat' in sample
         if waveform.shape[1] > truncate_length:
             start = random.randint(0, waveform.shape[1] - truncate_length)
+            if feat is True:
+                start = start // hop_size * hop_size
+                frames = slice(start // hop_size, (start + truncate_length) // hop_size)
+                sample['speech_feat'] = sample['speech_feat'][frames]
+                sample['pitch_feat'] = sample['pitch_feat'][frames]
             waveform = waveform[:, start: start + truncate_length]
         else:
+            if feat is True:
+                # NOTE pad every feature to its own target, they may differ in length
+                sample['speech_feat'] = F.pad(sample['speech_feat'], (0, 0, 0, truncate_length // hop_size - sample['speech_feat'].shape[0]),
+                                              value=feat_pad_value)
+                sample['pitch_feat'] = F.pad(sample['pitch_feat'], (0, truncate_length // hop_size - sample['pitch_feat'].shape[0]))
             waveform = torch.concat([waveform, torch.zeros(1, truncate_length - waveform.shape[1])], dim=1)
+        if feat is True and token_mel_ratio != 0:
+            align_speech_token(sample, token_mel_ratio)
         sample['speech'] = waveform
         yield sample
 
@@ -175,16 +256,34 @@ def compute_fbank(data,
         assert 'utt' in sample
         assert 'text_token' in sample
         waveform = sample['speech']
-        feat = feat_extractor(waveform).squeeze(dim=0).transpose(0, 1)
+        sample['speech_feat'] = feat_extractor(waveform).squeeze(dim=0).transpose(0, 1)
         if token_mel_ratio != 0:
-            # trim to align speech_token and speech_feat
-            token_len = int(min(feat.shape[0] / token_mel_ratio, sample["speech_token"].shape[0]))
-            feat = feat[:token_mel_ratio * token_len]
-            sample["speech_token"] = sample["speech_token"][:token_len]
-        sample['speech_feat'] = feat
+            align_speech_token(sample, token_mel_ratio)
         yield sample
 
 
+def align_speech_token(sample, token_mel_ratio):
+    """ Trim speech_feat, pitch_feat if any and speech_token of sample to align them
+    """
+    token_len = int(min(sample['speech_feat'].shape[0] / token_mel_ratio, sample["speech_token"].shape[0]))
+    sample['speech_feat'] = sample['speech_feat'][:token_mel_ratio * token_len]
+    if sample.get('pitch_feat') is not None:
+        sample['pitch_feat'] = sample['pitch_feat'][:token_mel_ratio * token_len]
+    sample["speech_token"] = sample["speech_token"][:token_len]
+
+
+def extract_f0(waveform, sample_rate, hop_size, num_frames):
+    """ f0 of waveform by pyworld, interpolated to num_frames of speech_feat
+    """
+    frame_period = hop_size * 1000 / sample_rate
+    waveform = waveform.squeeze(dim=0).numpy().astype('double')
+    _f0, t = pw.harvest(waveform, sample_rate, frame_period=frame_period)
+    if sum(_f0 != 0) < 5:  # this happens when the algorithm fails
+        _f0, t = pw.dio(waveform, sample_rate, frame_period=frame_period)  # if harvest fails, try dio
+    f0 = pw.stonemask(waveform, _f0, t, sample_rate)
+    return F.interpolate(torch.from_numpy(f0).view(1, 1, -1), size=num_frames, mode='linear').view(-1)
+
+
 def compute_f0(data, sample_rate, hop_size, mode='train'):
     """ Extract f0
 
@@ -194,19 +293,42 @@ def compute_f0(data, sample_rate, hop_size, mode='train'):
         Returns:
             Iterable[{key, feat, label}]
     """
-    frame_period = hop_size * 1000 / sample_rate
     for sample in data:
         assert 'sample_rate' in sample
         assert 'speech' in sample
         assert 'utt' in sample
         assert 'text_token' in sample
-        waveform = sample['speech']
-        _f0, t = pw.harvest(waveform.squeeze(dim=0).numpy().astype('double'), sample_rate, frame_period=frame_period)
-        if sum(_f0 != 0) < 5:  # this happens when the algorithm fails
-            _f0, t = pw.dio(waveform.squeeze(dim=0).numpy().astype('double'), sample_rate, frame_period=frame_period)  # if harvest fails, try dio
-        f0 = pw.stonemask(waveform.squeeze(dim=0).numpy().astype('double'), _f0, t, sample_rate)
-        f0 = F.interpolate(torch.from_numpy(f0).view(1, 1, -1), size=sample['speech_feat'].shape[0], mode='linear').view(-1)
-        sample['pitch_feat'] = f0
+        sample['pitch_feat'] = extract_f0(sample['speech'], sample_rate, hop_size, sample['speech_feat'].shape[0])
+        yield sample
+
+
+def load_feature(data, sample_rate, hop_size, token_mel_ratio=0, mode='train'):
+    """ Load speech_feat/pitch_feat of tools/extract_acoustic_feature.py
+        instead of compute_fbank/compute_f0, need parquet_opener with
+        feat_suffix. Put it before truncate, which truncates loaded
+        features if its hop_size is set, then set token_mel_ratio of
+        truncate instead of this one, so features are aligned after
+        truncation as in the online pipeline.
+
+        Args:
+            data: Iterable[{key, wav, label, sample_rate}]
+
+        Returns:
+            Iterable[{key, feat, label}]
+    """
+    for sample in data:
+        assert 'speech_feat' in sample, 'no feature sidecar of utt {}, set feat_suffix of parquet_opener'.format(sample['utt'])
+        # utts dropped by resample of feature extraction
+        if sample['speech_feat'] is None:
+            continue
+        assert sample['feat_sample_rate'] == sample_rate and sample['feat_hop_size'] == hop_size, \
+            'feature of {} is extracted at sample rate {} hop size {}, not {} {}'.format(
+                sample['utt'], sample['feat_sample_rate'], sample['feat_hop_size'], sample_rate, hop_size)
+        sample['speech_feat'] = torch.from_numpy(np.array(sample['speech_feat'])).view(-1, sample['speech_feat_dim'])
+        if sample.get('pitch_feat') is not None:
+            sample['pitch_feat'] = torch.from_numpy(np.array(sample['pitch_feat']))
+        if token_mel_ratio != 0:
+            align_speech_token(sample, token_mel_ratio)
         yield sample
 
 
@@ -321,6 +443,31 @@ def static_batch(data, batch_size=16):
         yield buf
 
 
+def sample_cost(sample, cost='speech_feat'):
+    """ Padded length a sample costs the model, speech_feat frames for
+        flow/hift, or lm input of sos, text, task_id and speech tokens for llm
+    """
+    if cost == 'speech_feat':
+        return sample['speech_feat'].size(0)
+    elif cost == 'lm':
+        return len(sample['text_token']) + len(sample['speech_token']) + 2
+    else:
+        logging.fatal('Unsupported batch cost {}'.format(cost))
+
+
+def update_padding_stats(stats, buf, costs):
+    return {'batches': stats['batches'] + 1, 'samples': stats['samples'] + len(buf),
+            'real': stats['real'] + sum(costs), 'padded': stats['padded'] + max(costs, default=0) * len(costs)}
+
+
+def log_padding_efficiency(name, sample, stats):
+    """ Log real / padded cost of batches a worker yielded in an epoch
+    """
+    if stats['batches'] != 0:
+        logging.info('{} of rank {} worker {}: {} batches, {} samples, padding efficiency {:.2%}'.format(
+            name, sample.get('rank', 0), sample.get('worker_id', 0), stats['batches'], stats['samples'], stats['real'] / stats['padded']))
+
+
 def dynamic_batch(data, max_frames_in_batch=12000, mode='train'):
     """ Dynamic batch the data until the total frames in batch
         reach `max_frames_in_batch`
@@ -334,6 +481,7 @@ def dynamic_batch(data, max_frames_in_batch=12000, mode='train'):
     """
     buf = []
     longest_frames = 0
+    stats, sample = {'batches': 0, 'samples': 0, 'real': 0, 'padded': 0}, {}
     for sample in data:
         assert 'speech_feat' in sample
         assert isinstance(sample['speech_feat'], torch.Tensor)
@@ -341,31 +489,93 @@ def dynamic_batch(data, max_frames_in_batch=12000, mode='train'):
         longest_frames = max(longest_frames, new_sample_frames)
         frames_after_padding = longest_frames * (len(buf) + 1)
         if frames_after_padding > max_frames_in_batch:
+            stats = update_padding_stats(stats, buf, [i['speech_feat'].size(0) for i in buf])
             yield buf
             buf = [sample]
             longest_frames = new_sample_frames
         else:
             buf.append(sample)
     if len(buf) > 0:
+        stats = update_padding_stats(stats, buf, [i['speech_feat'].size(0) for i in buf])
         yield buf
+    log_padding_efficiency('dynamic batch', sample, stats)
+
+
+def bucket_batch(data, bucket_boundaries, max_frames_in_batch=12000, bucket_cost='speech_feat', mode='train'):
+    """ Put every sample into the bucket of its cost by bucket_boundaries,
+        a bucket is yielded as a batch once its padded cost would exceed
+        `max_frames_in_batch`, so utts of a batch have similar length no
+        matter where sort buffer boundaries are
 
+        Args:
+            data: Iterable[{key, feat, label}]
+            bucket_boundaries: ascending upper bounds of bucket cost,
+                costs over the last one go to an extra bucket, None means
+                boundaries growing by 5% from 10 up to max_frames_in_batch
+            max_frames_in_batch: padded cost budget of one batch, in speech_feat
+                frames or lm tokens by bucket_cost
+            bucket_cost: 'speech_feat' or 'lm', see sample_cost
 
-def batch(data, batch_type='static', batch_size=16, max_frames_in_batch=12000, mode='train'):
-    """ Wrapper for static/dynamic batch
+        Returns:
+            Iterable[List[{key, feat, label}]]
+    """
+    if bucket_boundaries is None:
+        bucket_boundaries = sorted(set([int(10 * 1.05 ** i) for i in range(int(math.log(max_frames_in_batch / 10, 1.05)) + 1)]))
+    assert list(bucket_boundaries) == sorted(bucket_boundaries), 'bucket_boundaries must be ascending'
+    buckets = [[] for _ in range(len(bucket_boundaries) + 1)]
+    costs = [[] for _ in range(len(bucket_boundaries) + 1)]
+    stats, sample = {'batches': 0, 'samples': 0, 'real': 0, 'padded': 0}, {}
+    for sample in data:
+        cost = sample_cost(sample, bucket_cost)
+        i = bisect.bisect_left(bucket_boundaries, cost)
+        if len(buckets[i]) != 0 and max(max(costs[i]), cost) * (len(buckets[i]) + 1) > max_frames_in_batch:
+            stats = update_padding_stats(stats, buckets[i], costs[i])
+            yield buckets[i]
+            buckets[i], costs[i] = [], []
+        buckets[i].append(sample)
+        costs[i].append(cost)
+    for i in range(len(buckets)):
+        if len(buckets[i]) > 0:
+            stats = update_padding_stats(stats, buckets[i], costs[i])
+            yield buckets[i]
+    log_padding_efficiency('bucket batch', sample, stats)
+
+
+def batch(data, batch_type='static', batch_size=16, max_frames_in_batch=12000, bucket_boundaries=None, bucket_cost='speech_feat', mode='train'):
+    """ Wrapper for static/dynamic/bucket batch
     """
     if batch_type == 'static':
         return static_batch(data, batch_size)
     elif batch_type == 'dynamic':
         return dynamic_batch(data, max_frames_in_batch)
+    elif batch_type == 'bucket':
+        return bucket_batch(data, bucket_boundaries, max_frames_in_batch, bucket_cost)
     else:
         logging.fatal('Unsupported batch type {}'.format(batch_type))
 
 
-def padding(data, use_spk_embedding, mode='train', gan=False, dpo=False):
+def pack_rows(lengths, pack_length):
+    """ Row of every length by first fit decreasing, rows hold up to
+        pack_length unless a single length is longer
+    """
+    rows, pack_row = [], [0] * len(lengths)
+    for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        row = next((j for j in range(len(rows)) if rows[j] + lengths[i] <= pack_length), len(rows))
+        if row == len(rows):
+            rows.append(0)
+        rows[row] += lengths[i]
+        pack_row[i] = row
+    return pack_row
+
+
+def padding(data, use_spk_embedding, mode='train', gan=False, dpo=False, pack_length=0):
     """ Padding the data into training data
 
         Args:
             data: Iterable[List[{key, feat, label}]]
+            pack_length: if not 0, add pack_row, the row of every sample
+                when Qwen2LM packs lm inputs of samples into rows of up
+                to pack_length tokens instead of one padded row each
 
         Returns:
             Iterable[Tuple(keys, feats, labels, feats lengths, label lengths)]
@@ -440,4 +650,60 @@ def padding(data, use_spk_embedding, mode='train', gan=False, dpo=False):
             batch["embedding"] = batch["spk_embedding"]
         else:
             batch["embedding"] = batch["utt_embedding"]
+        if pack_length != 0:
+            assert dpo is False, 'dpo does not support packed sequences'
+            # lm input of Qwen2LM is sos, text, task_id and speech, bistream sequence has the same length
+            batch['pack_row'] = torch.tensor(pack_rows((text_token_len + speech_token_len + 2).tolist(), pack_length), dtype=torch.int64)
         yield batch
+
+
+if __name__ == '__main__':
+    import os
+    import time
+    import argparse
+    import tempfile
+    import pandas as pd
+    from functools import partial
+    # samples/s of one data loader worker reading parquet shards, pandas opener before arrow opener against parquet_opener
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_list', type=str, default='', help='shards of tools/make_parquet_list.py, empty means a random shard')
+    parser.add_argument('--num_utts', type=int, default=2000, help='utts of the random shard')
+    parser.add_argument('--audio_bytes', type=int, default=200000, help='audio_data bytes of every utt of the random shard')
+    args = parser.parse_args()
+
+    def pandas_opener(data, mode='train'):
+        for sample in data:
+            for df in pq.ParquetFile(sample['src']).iter_batches(batch_size=64):
+                df = df.to_pandas()
+                for i in range(len(df)):
+                    sample.update(dict(df.loc[i]))
+                    yield {**sample}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.data_list != '':
+            with open(args.data_list) as f:
+                srcs = [i.strip() for i in f if i.strip() != '']
+        else:
+            rng = np.random.default_rng(0)
+            df = pd.DataFrame()
+            df['utt'] = ['utt{}'.format(i) for i in range(args.num_utts)]
+            df['wav'] = ['/data/utt{}.wav'.format(i) for i in range(args.num_utts)]
+            df['audio_data'] = [rng.bytes(args.audio_bytes) for _ in range(args.num_utts)]
+            df['text'] = ['random text of utt {}'.format(i) for i in range(args.num_utts)]
+            df['spk'] = ['spk{}'.format(i % 10) for i in range(args.num_utts)]
+            df['utt_embedding'] = [rng.standard_normal(192).tolist() for _ in range(args.num_utts)]
+            df['spk_embedding'] = [rng.standard_normal(192).tolist() for _ in range(args.num_utts)]
+            df['speech_token'] = [rng.integers(0, 6561, rng.integers(50, 500)).tolist() for _ in range(args.num_utts)]
+            srcs = [os.path.join(tmp_dir, 'parquet_000000000.tar')]
+            df.to_parquet(srcs[0])
+        for name, opener in [('pandas', pandas_opener), ('arrow all columns', partial(parquet_opener, columns=None)), ('arrow', parquet_opener)]:
+            start_time = time.perf_counter()
+            num_samples = 0
+            for sample in opener([{'src': i} for i in srcs]):
+                num_samples += 1
+            cost = time.perf_counter() - start_time
+            print('{} {} samples {:.3f}s {:.0f} samples/s'.format(name, num_samples, cost, num_samples / cost))
+        expected, actual = next(pandas_opener([{'src': srcs[0]}])), next(parquet_opener([{'src': srcs[0]}], columns=None))
+        assert expected.keys() == actual.keys()
+        for k in expected:
+            assert np.array_equal(np.asarray(expected[k]), np.asarray(actual[k])) if k != 'audio_data' else expected[k] == bytes(actual[k]), k
@@ -19,6 +19,7 @@ import torch.nn as nn
 from torch.nn import functional as F
 from omegaconf import DictConfig
 from cosyvoice.utils.mask import make_pad_mask
+from cosyvoice.utils.profiler import get_profiler
 
 
 class MaskedDiffWithXvec(torch.nn.Module):
@@ -120,8 +121,9 @@ class MaskedDiffWithXvec(torch.nn.Module):
         token = self.input_embedding(torch.clamp(token, min=0)) * mask
 
         # text encode
-        h, h_lengths = self.encoder(token, token_len)
-        h = self.encoder_proj(h)
+        with get_profiler().span('flow_encoder'):
+            h, h_lengths = self.encoder(token, token_len)
+            h = self.encoder_proj(h)
         mel_len1, mel_len2 = prompt_feat.shape[1], int(token_len2 / self.input_frame_rate * 22050 / 256)
         h, h_lengths = self.length_regulator.inference(h[:, :token_len1], h[:, token_len1:], mel_len1, mel_len2, self.input_frame_rate)
 
@@ -236,7 +238,8 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat_len,
                   embedding,
                   streaming,
-                  finalize):
+                  finalize,
+                  flow_cache=None):
         assert token.shape[0] == 1
         # xvec projection
         embedding = F.normalize(embedding, dim=1)
@@ -249,12 +252,20 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
 
         # text encode
         if finalize is True:
-            h, h_lengths = self.encoder(token, token_len, streaming=streaming)
+            context = token[:, token.shape[1]:]
         else:
             token, context = token[:, :-self.pre_lookahead_len], token[:, -self.pre_lookahead_len:]
-            h, h_lengths = self.encoder(token, token_len, context=context, streaming=streaming)
+        with get_profiler().span('flow_encoder'):
+            if streaming is True and flow_cache is not None and hasattr(self.encoder, 'forward_chunk'):
+                # NOTE only encode new tokens, history encoder output does not change in streaming mode
+                offset = flow_cache.get('offset', 0)
+                h, encoder_cache = self.encoder.forward_chunk(token[:, offset:], context=context, cache=flow_cache.get('encoder_cache', {}))
+                h = torch.concat([flow_cache['h'], self.encoder_proj(h)], dim=1) if offset != 0 else self.encoder_proj(h)
+                flow_cache = {'offset': token.shape[1], 'encoder_cache': encoder_cache, 'h': h}
+            else:
+                h, h_lengths = self.encoder(token, token_len, context=context, streaming=streaming)
+                h = self.encoder_proj(h)
         mel_len1, mel_len2 = prompt_feat.shape[1], h.shape[1] - prompt_feat.shape[1]
-        h = self.encoder_proj(h)
 
         # get conditions
         conds = torch.zeros([1, mel_len1 + mel_len2, self.output_size], device=token.device).to(h.dtype)
@@ -272,7 +283,7 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
         )
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
-        return feat.float(), None
+        return feat.float(), flow_cache
 
 
 class CausalMaskedDiffWithDiT(torch.nn.Module):
@@ -377,11 +388,12 @@ class CausalMaskedDiffWithDiT(torch.nn.Module):
         token = self.input_embedding(torch.clamp(token, min=0)) * mask
 
         # text encode
-        if finalize is True:
-            h = self.pre_lookahead_layer(token)
-        else:
-            h = self.pre_lookahead_layer(token[:, :-self.pre_lookahead_len], context=token[:, -self.pre_lookahead_len:])
-        h = h.repeat_interleave(self.token_mel_ratio, dim=1)
+        with get_profiler().span('flow_encoder'):
+            if finalize is True:
+                h = self.pre_lookahead_layer(token)
+            else:
+                h = self.pre_lookahead_layer(token[:, :-self.pre_lookahead_len], context=token[:, -self.pre_lookahead_len:])
+            h = h.repeat_interleave(self.token_mel_ratio, dim=1)
         mel_len1, mel_len2 = prompt_feat.shape[1], h.shape[1] - prompt_feat.shape[1]
 
         # get conditions
@@ -12,10 +12,13 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import bisect
+from collections import Counter
 import torch
 import torch.nn.functional as F
 from matcha.models.components.flow_matching import BASECFM
-from cosyvoice.utils.common import set_all_random_seed
+from cosyvoice.utils.common import set_all_random_seed, randn_like
+from cosyvoice.utils.profiler import get_profiler
 
 
 class ConditionalCFM(BASECFM):
@@ -32,6 +35,35 @@ class ConditionalCFM(BASECFM):
         in_channels = in_channels + (spk_emb_dim if n_spks > 0 else 0)
         # Just change the architecture of the estimator here
         self.estimator = estimator
+        # NOTE pad estimator input to a few fixed lengths, so that shape specialized backend (jit/onnx/trt/torch.compile) can reuse warm shapes
+        self.set_estimator_buckets(cfm_params.get('estimator_bucket_sizes', None))
+
+    def set_estimator_buckets(self, bucket_sizes=None):
+        """Set estimator input bucket lengths, None or empty list disables bucketing.
+
+        Input longer than the largest bucket is not padded and counted as miss (bucket 0).
+        """
+        assert not bucket_sizes or self.estimator.__class__.__name__ != 'ConditionalDecoder', \
+            'ConditionalDecoder uses GroupNorm over time axis, padded input changes its output, do not use estimator bucket!'
+        self.estimator_bucket_sizes = sorted(set(int(i) for i in bucket_sizes)) if bucket_sizes else []
+        self.estimator_bucket_hits = Counter()
+
+    def get_estimator_bucket(self, seq_len):
+        if len(self.estimator_bucket_sizes) == 0:
+            return seq_len
+        index = bisect.bisect_left(self.estimator_bucket_sizes, seq_len)
+        if index == len(self.estimator_bucket_sizes):
+            self.estimator_bucket_hits[0] += 1
+            return seq_len
+        self.estimator_bucket_hits[self.estimator_bucket_sizes[index]] += 1
+        return self.estimator_bucket_sizes[index]
+
+    def estimator_bucket_report(self):
+        total = sum(self.estimator_bucket_hits.values())
+        return {'total': total,
+                'miss': self.estimator_bucket_hits[0],
+                'hits': {k: v for k, v in sorted(self.estimator_bucket_hits.items()) if k != 0},
+                'hit_rate': (total - self.estimator_bucket_hits[0]) / total if total != 0 else 0.0}
 
     @torch.inference_mode()
     def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, cache=torch.zeros(1, 80, 0, 2)):
@@ -53,7 +85,7 @@ class ConditionalCFM(BASECFM):
                 shape: (batch_size, n_feats, mel_timesteps)
         """
 
-        z = torch.randn_like(mu).to(mu.device).to(mu.dtype) * temperature
+        z = randn_like(mu).to(mu.device).to(mu.dtype) * temperature
         cache_size = cache.shape[2]
         # fix prompt and overlap part mu and z
         if cache_size != 0:
@@ -92,30 +124,34 @@ class ConditionalCFM(BASECFM):
 
         # Do not use concat, it may cause memory format changed and trt infer with wrong results!
         # NOTE when flow run in amp mode, x.dtype is float32, which cause nan in trt fp16 inference, so set dtype=spks.dtype
-        x_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=spks.dtype)
-        mask_in = torch.zeros([2, 1, x.size(2)], device=x.device, dtype=spks.dtype)
-        mu_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=spks.dtype)
+        # NOTE padded part of bucket is zero in mask_in, so it does not affect valid part and is removed from estimator output
+        seq_len = x.size(2)
+        bucket_len = self.get_estimator_bucket(seq_len)
+        x_in = torch.zeros([2, 80, bucket_len], device=x.device, dtype=spks.dtype)
+        mask_in = torch.zeros([2, 1, bucket_len], device=x.device, dtype=spks.dtype)
+        mu_in = torch.zeros([2, 80, bucket_len], device=x.device, dtype=spks.dtype)
         t_in = torch.zeros([2], device=x.device, dtype=spks.dtype)
         spks_in = torch.zeros([2, 80], device=x.device, dtype=spks.dtype)
-        cond_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=spks.dtype)
+        cond_in = torch.zeros([2, 80, bucket_len], device=x.device, dtype=spks.dtype)
         for step in range(1, len(t_span)):
-            # Classifier-Free Guidance inference introduced in VoiceBox
-            x_in[:] = x
-            mask_in[:] = mask
-            mu_in[0] = mu
-            t_in[:] = t.unsqueeze(0)
-            spks_in[0] = spks
-            cond_in[0] = cond
-            dphi_dt = self.forward_estimator(
-                x_in, mask_in,
-                mu_in, t_in,
-                spks_in,
-                cond_in,
-                streaming
-            )
-            dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
-            dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt)
-            x = x + dt * dphi_dt
+            with get_profiler().span('flow_ode_step', step=step, seq_len=seq_len, bucket_len=bucket_len):
+                # Classifier-Free Guidance inference introduced in VoiceBox
+                x_in[:, :, :seq_len] = x
+                mask_in[:, :, :seq_len] = mask
+                mu_in[0, :, :seq_len] = mu
+                t_in[:] = t.unsqueeze(0)
+                spks_in[0] = spks
+                cond_in[0, :, :seq_len] = cond
+                dphi_dt = self.forward_estimator(
+                    x_in, mask_in,
+                    mu_in, t_in,
+                    spks_in,
+                    cond_in,
+                    streaming
+                )[:, :, :seq_len]
+                dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
+                dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt)
+                x = x + dt * dphi_dt
             t = t + dt
             sol.append(x)
             if step < len(t_span) - 1:
@@ -226,3 +262,31 @@ class CausalConditionalCFM(ConditionalCFM):
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
         return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, streaming=streaming), None
+
+
+if __name__ == '__main__':
+    # compare estimator throughput with/without bucketing under varying streaming input length, with random weight estimator
+    import time
+    from omegaconf import DictConfig
+    from cosyvoice.flow.decoder import CausalConditionalDecoder
+    torch.manual_seed(0)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    cfm_params = DictConfig({'sigma_min': 1e-06, 'solver': 'euler', 't_scheduler': 'cosine', 'training_cfg_rate': 0.2, 'inference_cfg_rate': 0.7, 'reg_loss_type': 'l1'})
+    estimator = CausalConditionalDecoder(in_channels=320, out_channels=80, channels=[256], n_blocks=1, num_mid_blocks=2, num_heads=4, act_fn='gelu', static_chunk_size=50)
+    model = CausalConditionalCFM(240, cfm_params, spk_emb_dim=80, estimator=estimator).to(device).eval()
+    model.estimator = torch.compile(model.estimator, dynamic=False)
+    # prompt length plus chunk position, 50 mel frames per chunk
+    seq_lens = [prompt_len + 50 * (i + 1) for prompt_len in [73, 150] for i in range(4)]
+    spks = torch.rand(1, 80).to(device)
+    for bucket_sizes in [None, [128, 256, 384]]:
+        model.set_estimator_buckets(bucket_sizes)
+        for name in ['cold', 'warm']:
+            start_time, frames = time.time(), 0
+            for seq_len in seq_lens:
+                mu, cond = torch.rand(1, 80, seq_len).to(device), torch.rand(1, 80, seq_len).to(device)
+                mask = torch.ones(1, 1, seq_len).to(device)
+                model(mu, mask, n_timesteps=10, spks=spks, cond=cond, streaming=True)
+                frames += seq_len
+            print('bucket_sizes {} {} pass frames/s {:.1f}'.format(bucket_sizes, name, frames / (time.time() - start_time)))
+        if bucket_sizes is not None:
+            print(model.estimator_bucket_report())
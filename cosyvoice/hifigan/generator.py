@@ -14,7 +14,8 @@
 
 """HIFI-GAN"""
 
-from typing import Dict, Optional, List
+from typing import Dict, Optional, List, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
 import numpy as np
 from scipy.signal import get_window
 import torch
@@ -32,6 +33,8 @@ from cosyvoice.transformer.convolution import CausalConv1d, CausalConv1dDownSamp
 from cosyvoice.transformer.activation import Snake
 from cosyvoice.utils.common import get_padding
 from cosyvoice.utils.common import init_weights
+from cosyvoice.utils.common import rand, randn_like
+from cosyvoice.utils.mask import make_pad_mask
 
 
 """hifigan based generator implementation.
@@ -168,7 +171,7 @@ class SineGen(torch.nn.Module):
 
         theta_mat = 2 * np.pi * (torch.cumsum(F_mat, dim=-1) % 1)
         u_dist = Uniform(low=-np.pi, high=np.pi)
-        phase_vec = u_dist.sample(sample_shape=(f0.size(0), self.harmonic_num + 1, 1)).to(F_mat.device)
+        phase_vec = (u_dist.low + rand(f0.size(0), self.harmonic_num + 1, 1) * (u_dist.high - u_dist.low)).to(F_mat.device)
         phase_vec[:, 0, :] = 0
 
         # generate sine waveforms
@@ -181,7 +184,7 @@ class SineGen(torch.nn.Module):
         #        std = self.sine_amp/3 -> max value ~ self.sine_amp
         # .       for voiced regions is self.noise_std
         noise_amp = uv * self.noise_std + (1 - uv) * self.sine_amp / 3
-        noise = noise_amp * torch.randn_like(sine_waves)
+        noise = noise_amp * randn_like(sine_waves)
 
         # first: set the unvoiced part to 0 by uv
         # then: additive noise
@@ -242,7 +245,7 @@ class SineGen2(torch.nn.Module):
         if self.training is False and self.causal is True:
             rad_values[:, 0, :] = rad_values[:, 0, :] + self.rand_ini.to(rad_values.device)
         else:
-            rand_ini = torch.rand(f0_values.shape[0], f0_values.shape[2], device=f0_values.device)
+            rand_ini = rand(f0_values.shape[0], f0_values.shape[2], device=f0_values.device)
             rand_ini[:, 0] = 0
             rad_values[:, 0, :] = rad_values[:, 0, :] + rand_ini
 
@@ -309,7 +312,7 @@ class SineGen2(torch.nn.Module):
         if self.training is False and self.causal is True:
             noise = noise_amp * self.sine_waves[:, :sine_waves.shape[1]].to(sine_waves.device)
         else:
-            noise = noise_amp * torch.randn_like(sine_waves)
+            noise = noise_amp * randn_like(sine_waves)
 
         # first: set the unvoiced part to 0 by uv
         # then: additive noise
@@ -371,7 +374,7 @@ class SourceModuleHnNSF(torch.nn.Module):
         if self.training is False and self.causal is True:
             noise = self.uv[:, :uv.shape[1]] * self.sine_amp / 3
         else:
-            noise = torch.randn_like(uv) * self.sine_amp / 3
+            noise = randn_like(uv) * self.sine_amp / 3
         return sine_merge, noise, uv
 
 
@@ -568,6 +571,28 @@ class HiFTGenerator(nn.Module):
         generated_speech = self.decode(x=speech_feat, s=s)
         return generated_speech, s
 
+    def predict_f0(self, speech_feat: torch.Tensor) -> torch.Tensor:
+        return self.f0_predictor(speech_feat)
+
+    @torch.inference_mode()
+    def batch_inference(self, speech_feat: torch.Tensor, speech_feat_len: torch.Tensor) -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
+        """Vocode padded mel [B, 80, T] with lengths [B] in one pass, return per item trimmed speech [1, T_i * upsample_scale] and source.
+
+        NOTE padded frames are zeroed, so right context of the last valid frame matches single item inference.
+            CausalHiFTGenerator only differs from single item inference in the last mel frame of each item,
+            HiFTGenerator uses non-causal convs and may differ in the last few frames.
+        """
+        speech_feat = speech_feat.masked_fill(make_pad_mask(speech_feat_len, speech_feat.shape[2]).unsqueeze(1), 0)
+        # mel->f0
+        f0 = self.predict_f0(speech_feat)
+        # f0->source
+        s = self.f0_upsamp(f0[:, None]).transpose(1, 2)  # bs,n,t
+        s, _, _ = self.m_source(s)
+        s = s.transpose(1, 2)
+        generated_speech = self.decode(x=speech_feat, s=s)
+        speech_len = (speech_feat_len * int(self.f0_upsamp.scale_factor)).tolist()
+        return [generated_speech[i:i + 1, :speech_len[i]] for i in range(len(speech_len))], [s[i:i + 1, :, :speech_len[i]] for i in range(len(speech_len))]
+
 
 class CausalHiFTGenerator(HiFTGenerator):
     """
@@ -594,6 +619,7 @@ class CausalHiFTGenerator(HiFTGenerator):
             audio_limit: float = 0.99,
             conv_pre_look_right: int = 4,
             f0_predictor: torch.nn.Module = None,
+            f0_policy: str = 'cpu',
     ):
         torch.nn.Module.__init__(self)
 
@@ -668,16 +694,30 @@ class CausalHiFTGenerator(HiFTGenerator):
         self.stft_window = torch.from_numpy(get_window("hann", istft_params["n_fft"], fftbins=True).astype(np.float32))
         self.conv_pre_look_right = conv_pre_look_right
         self.f0_predictor = f0_predictor
+        self.set_f0_policy(f0_policy)
+
+    def set_f0_policy(self, f0_policy: str = 'cpu'):
+        """Set where f0_predictor runs in inference.
+
+        cpu: float32 on cpu, speech_feat is copied to cpu and back in every call
+        cpu_fp64: float64 on cpu, most precise, slowest
+        cpu_async: float32 on cpu in a background worker, overlapped with conv_pre and the first ups layer on model device
+        device: same device as speech_feat, no copy, but f0 is less precise on fp16/tf32 device
+        NOTE chunk latency of the policies was only measured on cpu, where they differ by noise, gain of cpu_async/device on gpu is unverified,
+        measure it with the __main__ block of this file. CosyVoice3(f0_policy=...) sets it at load time.
+        """
+        assert f0_policy in ['cpu', 'cpu_fp64', 'cpu_async', 'device'], 'unsupported f0_policy {}'.format(f0_policy)
+        self.f0_policy = f0_policy
+        # NOTE shut down the worker of a previous cpu_async policy, or every policy switch leaks a thread
+        if getattr(self, 'f0_executor', None) is not None:
+            self.f0_executor.shutdown(wait=True)
+        self.f0_executor = None
 
     def decode(self, x: torch.Tensor, s: torch.Tensor = torch.zeros(1, 1, 0), finalize: bool = True) -> torch.Tensor:
-        s_stft_real, s_stft_imag = self._stft(s.squeeze(1))
         if finalize is True:
             x = self.conv_pre(x)
         else:
             x = self.conv_pre(x[:, :, :-self.conv_pre_look_right], x[:, :, -self.conv_pre_look_right:])
-            s_stft_real = s_stft_real[:, :, :-int(np.prod(self.upsample_rates) * self.conv_pre_look_right)]
-            s_stft_imag = s_stft_imag[:, :, :-int(np.prod(self.upsample_rates) * self.conv_pre_look_right)]
-        s_stft = torch.cat([s_stft_real, s_stft_imag], dim=1)
 
         for i in range(self.num_upsamples):
             x = F.leaky_relu(x, self.lrelu_slope)
@@ -686,6 +726,10 @@ class CausalHiFTGenerator(HiFTGenerator):
             if i == self.num_upsamples - 1:
                 x = self.reflection_pad(x)
 
+            # NOTE s may be a Future from f0_executor, wait for it as late as possible
+            if i == 0:
+                s_stft = self._source_stft(s.result() if isinstance(s, Future) else s, finalize=finalize)
+
             # fusion
             si = self.source_downs[i](s_stft)
             si = self.source_resblocks[i](si)
@@ -710,20 +754,44 @@ class CausalHiFTGenerator(HiFTGenerator):
         x = torch.clamp(x, -self.audio_limit, self.audio_limit)
         return x
 
+    def _source_stft(self, s: torch.Tensor, finalize: bool = True) -> torch.Tensor:
+        s_stft_real, s_stft_imag = self._stft(s.squeeze(1))
+        if finalize is False:
+            s_stft_real = s_stft_real[:, :, :-int(np.prod(self.upsample_rates) * self.conv_pre_look_right)]
+            s_stft_imag = s_stft_imag[:, :, :-int(np.prod(self.upsample_rates) * self.conv_pre_look_right)]
+        return torch.cat([s_stft_real, s_stft_imag], dim=1)
+
+    def predict_f0(self, speech_feat: torch.Tensor, finalize: bool = True) -> torch.Tensor:
+        if self.f0_policy == 'device':
+            self.f0_predictor.to(speech_feat.device, speech_feat.dtype)
+            return self.f0_predictor(speech_feat, finalize=finalize)
+        # NOTE f0_predictor precision is crucial for causal inference, hift.to(device) also moves f0_predictor, so move it back to cpu
+        dtype = torch.float64 if self.f0_policy == 'cpu_fp64' else torch.float32
+        self.f0_predictor.to('cpu', dtype)
+        return self.f0_predictor(speech_feat.to('cpu', dtype), finalize=finalize).to(speech_feat)
+
     @torch.inference_mode()
-    def inference(self, speech_feat: torch.Tensor, finalize: bool = True) -> torch.Tensor:
-        # mel->f0 NOTE f0_predictor precision is crucial for causal inference, move self.f0_predictor to cpu if necessary
-        self.f0_predictor.to('cpu')
-        f0 = self.f0_predictor(speech_feat.cpu(), finalize=finalize).to(speech_feat)
+    def source(self, speech_feat: torch.Tensor, finalize: bool = True) -> torch.Tensor:
+        # mel->f0
+        f0 = self.predict_f0(speech_feat, finalize=finalize)
         # f0->source
         s = self.f0_upsamp(f0[:, None]).transpose(1, 2)  # bs,n,t
         s, _, _ = self.m_source(s)
-        s = s.transpose(1, 2)
+        return s.transpose(1, 2)
+
+    @torch.inference_mode()
+    def inference(self, speech_feat: torch.Tensor, finalize: bool = True) -> torch.Tensor:
+        if self.f0_policy == 'cpu_async':
+            if self.f0_executor is None:
+                self.f0_executor = ThreadPoolExecutor(max_workers=1)
+            s = self.f0_executor.submit(self.source, speech_feat, finalize)
+        else:
+            s = self.source(speech_feat, finalize=finalize)
         if finalize is True:
             generated_speech = self.decode(x=speech_feat, s=s, finalize=finalize)
         else:
             generated_speech = self.decode(x=speech_feat[:, :, :-self.f0_predictor.condnet[0].causal_padding], s=s, finalize=finalize)
-        return generated_speech, s
+        return generated_speech, s.result() if isinstance(s, Future) else s
 
 
 if __name__ == '__main__':
@@ -736,11 +804,43 @@ if __name__ == '__main__':
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
     model.to(device)
     model.eval()
+    import time
     max_len, chunk_size, context_size = 300, 30, 8
     mel = torch.rand(1, 80, max_len).to(device)
+    # NOTE use cpu_fp64 offline result as ground truth, compare streaming result and chunk latency of every f0_policy
+    model.set_f0_policy('cpu_fp64')
     pred_gt, _ = model.inference(mel)
-    for i in range(0, max_len, chunk_size):
-        finalize = True if i + chunk_size + context_size >= max_len else False
-        pred_chunk, _ = model.inference(mel[:, :, : i + chunk_size + context_size], finalize=finalize)
-        pred_chunk = pred_chunk[:, i * 480:]
-        print((pred_gt[:, i * 480:i * 480 + pred_chunk.shape[1]] - pred_chunk).abs().max().item())
+    # NOTE device right after cpu_fp64, which leaves f0_predictor in float64, and cpu_async before cpu, whose switch shuts down the worker
+    for f0_policy in ['cpu_fp64', 'device', 'cpu_async', 'cpu']:
+        model.set_f0_policy(f0_policy)
+        diff, chunk_time = [], []
+        for i in range(0, max_len, chunk_size):
+            finalize = True if i + chunk_size + context_size >= max_len else False
+            if device == 'cuda':
+                torch.cuda.synchronize()
+            start_time = time.time()
+            pred_chunk, _ = model.inference(mel[:, :, : i + chunk_size + context_size], finalize=finalize)
+            if device == 'cuda':
+                torch.cuda.synchronize()
+            chunk_time.append(time.time() - start_time)
+            pred_chunk = pred_chunk[:, i * 480:]
+            diff.append((pred_gt[:, i * 480:i * 480 + pred_chunk.shape[1]] - pred_chunk).abs().max().item())
+        print('f0_policy {} max diff {} mean chunk latency {:.2f}ms'.format(f0_policy, max(diff), sum(chunk_time) / len(chunk_time) * 1000))
+    model.set_f0_policy('cpu')
+
+    # batch inference of variable length mel, compare with single item inference and measure samples/s
+    for batch_size in [1, 4, 16]:
+        mel_len = torch.randint(100, max_len + 1, (batch_size,), device=device)
+        mel_len[0] = max_len
+        mel = torch.rand(batch_size, 80, max_len).to(device)
+        start_time = time.time()
+        pred_single = [model.inference(mel[i:i + 1, :, :mel_len[i]])[0] for i in range(batch_size)]
+        single_time = time.time() - start_time
+        start_time = time.time()
+        pred_batch, _ = model.batch_inference(mel, mel_len)
+        batch_time = time.time() - start_time
+        # NOTE source stft and istft see padded frames, so the last mel frame of each item may differ
+        upsample_scale = int(model.f0_upsamp.scale_factor)
+        diff = max([(pred_single[i][:, :-upsample_scale] - pred_batch[i][:, :-upsample_scale]).abs().max().item() for i in range(batch_size)])
+        num_samples = sum([i.shape[1] for i in pred_batch])
+        print('batch_size {} max diff {} single {:.0f} samples/s batch {:.0f} samples/s'.format(batch_size, diff, num_samples / single_time, num_samples / batch_time))
@@ -28,6 +28,7 @@ from cosyvoice.transformer.label_smoothing_loss import LabelSmoothingLoss
 from cosyvoice.utils.common import th_accuracy
 from cosyvoice.utils.file_utils import logging
 from cosyvoice.utils.mask import make_pad_mask
+from cosyvoice.utils.profiler import get_profiler
 
 
 class TransformerLM(torch.nn.Module):
@@ -108,6 +109,7 @@ class TransformerLM(torch.nn.Module):
             audio: (B, T, N) or (B, T)
             audio_lengths: (B,)
         """
+        assert 'pack_row' not in batch, 'packed sequences need qwen2 llm, set pack_length of padding to 0'
         text_token = batch['text_token'].to(device)
         text_token_len = batch['text_token_len'].to(device)
         speech_token = batch['speech_token'].to(device)
@@ -212,12 +214,13 @@ class TransformerLM(torch.nn.Module):
         offset = 0
         att_cache, cnn_cache = torch.zeros((0, 0, 0, 0), device=lm_input.device), torch.zeros((0, 0, 0, 0), device=lm_input.device)
         for i in range(max_len):
-            y_pred, att_cache, cnn_cache = self.llm.forward_chunk(lm_input, offset=offset, required_cache_size=-1,
-                                                                  att_cache=att_cache, cnn_cache=cnn_cache,
-                                                                  att_mask=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]),
-                                                                                                 device=lm_input.device)).to(torch.bool))
-            logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
-            top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False)
+            with get_profiler().span('llm_prefill' if i == 0 else 'llm_step'):
+                y_pred, att_cache, cnn_cache = self.llm.forward_chunk(lm_input, offset=offset, required_cache_size=-1,
+                                                                      att_cache=att_cache, cnn_cache=cnn_cache,
+                                                                      att_mask=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]),
+                                                                                                     device=lm_input.device)).to(torch.bool))
+                logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
+                top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False)
             if top_ids == self.eos_token:
                 break
             # in stream mode, yield token one by one
@@ -243,6 +246,26 @@ class Qwen2Encoder(torch.nn.Module):
         )
         return outs.hidden_states[-1], masks.unsqueeze(1)
 
+    def forward_packed(self, xs: torch.Tensor, seq_ids: torch.Tensor):
+        """xs packs several sequences into every row, seq_ids numbers them from 1 in a row and is 0 at padding,
+        attention is causal within a sequence and positions restart at 0 at the start of every sequence."""
+        T = xs.size(1)
+        index = torch.arange(T, device=xs.device).unsqueeze(dim=0)
+        start = torch.ones_like(seq_ids, dtype=torch.bool)
+        start[:, 1:] = seq_ids[:, 1:] != seq_ids[:, :-1]
+        position_ids = index - torch.where(start, index, 0).cummax(dim=1).values
+        # NOTE 4D mask is additive, padding attends to earlier padding so that no row is fully masked
+        masks = (seq_ids.unsqueeze(dim=2) == seq_ids.unsqueeze(dim=1)) & torch.ones(T, T, dtype=torch.bool, device=xs.device).tril()
+        attention_mask = torch.zeros(masks.shape, dtype=xs.dtype, device=xs.device).masked_fill(~masks, torch.finfo(xs.dtype).min)
+        outs = self.model(
+            inputs_embeds=xs,
+            attention_mask=attention_mask.unsqueeze(dim=1),
+            position_ids=position_ids,
+            output_hidden_states=True,
+            return_dict=True,
+        )
+        return outs.hidden_states[-1], (seq_ids != 0).unsqueeze(1)
+
     def forward_one_step(self, xs, masks, cache=None):
         input_masks = masks[:, -1, :]
         outs = self.model(
@@ -301,7 +324,8 @@ class Qwen2LM(TransformerLM):
         self.stop_token_ids = [speech_token_size + i for i in range(3)]
         self.vllm_output_queue = {}
 
-    def prepare_lm_input_target(self, sos_emb, text_token, text_token_emb, text_token_len, task_id_emb, speech_token, speech_token_emb, speech_token_len):
+    def prepare_lm_input_target(self, sos_emb, text_token, text_token_emb, text_token_len, task_id_emb, speech_token, speech_token_emb, speech_token_len,
+                                pack_row=None):
         lm_target, lm_input = [], []
         text_token = unpad_sequence(text_token, text_token_len.cpu(), batch_first=True)
         speech_token = unpad_sequence(speech_token, speech_token_len.cpu(), batch_first=True)
@@ -337,11 +361,38 @@ class Qwen2LM(TransformerLM):
                 this_lm_input = torch.concat([sos_emb.squeeze(dim=0), text_token_emb[i], task_id_emb.squeeze(dim=0), speech_token_emb[i]], dim=0)
             lm_target.append(this_lm_target)
             lm_input.append(this_lm_input)
+        if pack_row is not None:
+            return self.pack_lm_input_target(lm_target, lm_input, pack_row)
         lm_input_len = torch.tensor([i.size(0) for i in lm_input], dtype=torch.int32)
         lm_input = pad_sequence(lm_input, batch_first=True, padding_value=IGNORE_ID)
         lm_target = pad_sequence(lm_target, batch_first=True, padding_value=IGNORE_ID)
         return lm_target, lm_input, lm_input_len
 
+    def pack_lm_input_target(self, lm_target, lm_input, pack_row):
+        """Concat lm_target/lm_input of samples with the same pack_row into one row, return them padded with seq_ids of Qwen2Encoder.forward_packed."""
+        pack_lm_target, pack_lm_input, seq_ids = [], [], []
+        for row in range(int(pack_row.max().item()) + 1):
+            index = (pack_row == row).nonzero().view(-1).tolist()
+            pack_lm_target.append(torch.concat([lm_target[i] for i in index], dim=0))
+            pack_lm_input.append(torch.concat([lm_input[i] for i in index], dim=0))
+            seq_ids.append(torch.concat([torch.full((lm_input[i].size(0),), j + 1, dtype=torch.int32) for j, i in enumerate(index)], dim=0))
+        pack_lm_input = pad_sequence(pack_lm_input, batch_first=True, padding_value=IGNORE_ID)
+        pack_lm_target = pad_sequence(pack_lm_target, batch_first=True, padding_value=IGNORE_ID)
+        seq_ids = pad_sequence(seq_ids, batch_first=True, padding_value=0)
+        return pack_lm_target, pack_lm_input, seq_ids
+
+    def run_lm(self, lm_input, lm_input_len, pack_row, device):
+        """Run llm on padded lm_input of lm_input_len, or on packed lm_input if pack_row, where lm_input_len is seq_ids."""
+        if pack_row is None:
+            return self.llm(lm_input, lm_input_len.to(device))
+        return self.llm.forward_packed(lm_input, lm_input_len.to(device))
+
+    def pack_loss(self, loss, pack_row, lm_target):
+        """Loss of a packed batch equal to the loss of the padded batch, which is divided by batch size if not length normalized."""
+        if pack_row is None or self.criterion_ce.normalize_length is True:
+            return loss
+        return loss * lm_target.size(0) / pack_row.size(0)
+
     def forward(
             self,
             batch: dict,
@@ -353,11 +404,13 @@ class Qwen2LM(TransformerLM):
             text_lengths: (B,)
             audio: (B, T, N) or (B, T)
             audio_lengths: (B,)
+            pack_row: (B,) optional, row of every sample in packed sequences, see processor.padding
         """
         text_token = batch['text_token'].to(device)
         text_token_len = batch['text_token_len'].to(device)
         speech_token = batch['speech_token'].to(device)
         speech_token_len = batch['speech_token_len'].to(device)
+        pack_row = batch.get('pack_row')
 
         # 1. encode text_token
         text_token_emb = self.llm.model.model.embed_tokens(text_token)
@@ -371,13 +424,13 @@ class Qwen2LM(TransformerLM):
 
         # 3. prepare llm_input/target
         lm_target, lm_input, lm_input_len = self.prepare_lm_input_target(sos_emb, text_token, text_token_emb, text_token_len, task_id_emb,
-                                                                         speech_token, speech_token_emb, speech_token_len)
+                                                                         speech_token, speech_token_emb, speech_token_len, pack_row)
         lm_target = lm_target.to(device)
 
         # 4. run lm forward
-        lm_output, lm_output_mask = self.llm(lm_input, lm_input_len.to(device))
+        lm_output, lm_output_mask = self.run_lm(lm_input, lm_input_len, pack_row, device)
         logits = self.llm_decoder(lm_output)
-        loss = self.criterion_ce(logits, lm_target.to(device))
+        loss = self.pack_loss(self.criterion_ce(logits, lm_target.to(device)), pack_row, lm_target)
         acc = th_accuracy(logits.view(-1, self.speech_token_size + 3), lm_target, ignore_label=IGNORE_ID)
         return {'loss': loss, 'acc': acc}
 
@@ -386,6 +439,7 @@ class Qwen2LM(TransformerLM):
             batch: dict,
             device: torch.device,
     ) -> Dict[str, Optional[torch.Tensor]]:
+        assert 'pack_row' not in batch, 'dpo does not support packed sequences, set pack_length of padding to 0'
         text_token = batch['text_token'].to(device)
         text_token_len = batch['text_token_len'].to(device)
         speech_token = batch['speech_token'].to(device)
@@ -484,7 +538,8 @@ class Qwen2LM(TransformerLM):
             while True:
                 with self.lock:
                     if self.vllm_output_queue[uuid].empty() is True:
-                        request_outputs: List[RequestOutput] = self.vllm.step()
+                        with get_profiler().span('llm_step'):
+                            request_outputs: List[RequestOutput] = self.vllm.step()
                         for request_output in request_outputs:
                             top_ids = list(request_output.outputs[0].token_ids)[-1]
                             self.vllm_output_queue[request_output.request_id].put(top_ids)
@@ -504,11 +559,12 @@ class Qwen2LM(TransformerLM):
             out_tokens = []
             cache = None
             for i in range(max_len):
-                y_pred, cache = self.llm.forward_one_step(lm_input,
-                                                          masks=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]), device=lm_input.device)).to(torch.bool),
-                                                          cache=cache)
-                logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
-                top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False)
+                with get_profiler().span('llm_prefill' if i == 0 else 'llm_step'):
+                    y_pred, cache = self.llm.forward_one_step(lm_input,
+                                                              masks=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]), device=lm_input.device)).to(torch.bool),
+                                                              cache=cache)
+                    logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
+                    top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False)
                 if top_ids in self.stop_token_ids:
                     break
                 # in stream mode, yield token one by one
@@ -575,10 +631,12 @@ class Qwen2LM(TransformerLM):
                         continue
                 while True:
                     seq_len = lm_input.shape[1] if cache is None else lm_input.shape[1] + cache[0][0].size(2)
-                    y_pred, cache = self.llm.forward_one_step(lm_input,
-                                                              masks=torch.tril(torch.ones((1, seq_len, seq_len), device=lm_input.device)).to(torch.bool),
-                                                              cache=cache)
-                    logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
+                    # NOTE every text piece is prefilled along with the first step after it
+                    with get_profiler().span('llm_prefill' if lm_input.shape[1] != 1 else 'llm_step'):
+                        y_pred, cache = self.llm.forward_one_step(lm_input,
+                                                                  masks=torch.tril(torch.ones((1, seq_len, seq_len), device=lm_input.device)).to(torch.bool),
+                                                                  cache=cache)
+                        logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
                     if next_fill_index != -1 and len(out_tokens) == next_fill_index:
                         top_ids = self.fill_token
                         next_fill_index += (self.mix_ratio[1] + 1)
@@ -601,11 +659,12 @@ class Qwen2LM(TransformerLM):
         logging.info('no more text token, decode until met eos')
         while True:
             seq_len = lm_input.shape[1] if cache is None else lm_input.shape[1] + cache[0][0].size(2)
-            y_pred, cache = self.llm.forward_one_step(lm_input,
-                                                      masks=torch.tril(torch.ones((1, seq_len, seq_len), device=lm_input.device)).to(torch.bool),
-                                                      cache=cache)
-            logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
-            top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=False)
+            with get_profiler().span('llm_prefill' if lm_input.shape[1] != 1 else 'llm_step'):
+                y_pred, cache = self.llm.forward_one_step(lm_input,
+                                                          masks=torch.tril(torch.ones((1, seq_len, seq_len), device=lm_input.device)).to(torch.bool),
+                                                          cache=cache)
+                logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
+                top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=False)
             out_tokens.append(top_ids)
             if top_ids >= self.speech_token_size:
                 if top_ids == self.eos_token:
@@ -678,6 +737,7 @@ class CosyVoice3LM(Qwen2LM):
         # NOTE should append instruct_token to sequence, not implemented yet
         instruct_token = batch['instruct_token'].to(device)
         instruct_token_len = batch['instruct_token_len'].to(device)
+        pack_row = batch.get('pack_row')
 
         # 1. encode text_token
         text_token_emb = self.llm.model.model.embed_tokens(text_token)
@@ -691,13 +751,13 @@ class CosyVoice3LM(Qwen2LM):
 
         # 3. prepare llm_input/target
         lm_target, lm_input, lm_input_len = self.prepare_lm_input_target(sos_emb, text_token, text_token_emb, text_token_len, task_id_emb,
-                                                                         speech_token, speech_token_emb, speech_token_len)
+                                                                         speech_token, speech_token_emb, speech_token_len, pack_row)
         lm_target = lm_target.to(device)
 
         # 4. run lm forward
-        lm_output, lm_output_mask = self.llm(lm_input, lm_input_len.to(device))
+        lm_output, lm_output_mask = self.run_lm(lm_input, lm_input_len, pack_row, device)
         logits = self.llm_decoder(lm_output)
-        loss = self.criterion_ce(logits, lm_target.to(device))
+        loss = self.pack_loss(self.criterion_ce(logits, lm_target.to(device)), pack_row, lm_target)
         acc = th_accuracy(logits.view(-1, self.speech_token_size + 200), lm_target, ignore_label=IGNORE_ID)
         return {'loss': loss, 'acc': acc}
 
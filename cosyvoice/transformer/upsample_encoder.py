@@ -15,7 +15,7 @@
 # limitations under the License.
 # Modified from ESPnet(https://github.com/espnet/espnet)
 """Encoder definition."""
-from typing import Tuple
+from typing import Dict, Tuple
 
 import torch
 from torch import nn
@@ -32,6 +32,7 @@ from cosyvoice.utils.class_utils import (
 )
 from cosyvoice.utils.mask import make_pad_mask
 from cosyvoice.utils.mask import add_optional_chunk_mask
+from cosyvoice.utils.mask import subsequent_chunk_mask
 
 
 class Upsample1D(nn.Module):
@@ -62,6 +63,21 @@ class Upsample1D(nn.Module):
         outputs = self.conv(outputs)
         return outputs, input_lengths * self.stride
 
+    def forward_chunk(self, inputs: torch.Tensor, cache: torch.Tensor = torch.zeros(0, 0, 0)) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        inputs: (batch_size, channels, seq_len), new frames of current chunk
+        cache: (batch_size, channels, stride * 2), last upsampled frames of previous chunk,
+            (0, 0, 0) means first chunk
+        """
+        outputs = F.interpolate(inputs, scale_factor=float(self.stride), mode="nearest")
+        if cache.size(2) == 0:
+            outputs = F.pad(outputs, (self.stride * 2, 0), value=0.0)
+        else:
+            outputs = torch.concat([cache, outputs], dim=2)
+        new_cache = outputs[:, :, -self.stride * 2:]
+        outputs = self.conv(outputs)
+        return outputs, new_cache
+
 
 class PreLookaheadLayer(nn.Module):
     def __init__(self, in_channels: int, channels: int, pre_lookahead_len: int = 1):
@@ -102,6 +118,21 @@ class PreLookaheadLayer(nn.Module):
         outputs = outputs + inputs
         return outputs
 
+    def forward_chunk(self, inputs: torch.Tensor, context: torch.Tensor = torch.zeros(0, 0, 0),
+                      cache: torch.Tensor = torch.zeros(0, 0, 0)) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        inputs: (batch_size, seq_len, channels), new frames of current chunk
+        cache: (batch_size, conv2.kernel_size - 1, channels), last input frames of previous chunk,
+            (0, 0, 0) means first chunk
+        """
+        cache_size = cache.size(1)
+        if cache_size != 0:
+            inputs = torch.concat([cache, inputs], dim=1)
+        new_cache = inputs[:, -(self.conv2.kernel_size[0] - 1):]
+        # NOTE output of cached frames lacks its own left context, drop it
+        outputs = self.forward(inputs, context=context)[:, cache_size:]
+        return outputs, new_cache
+
 
 class UpsampleConformerEncoder(torch.nn.Module):
 
@@ -306,6 +337,85 @@ class UpsampleConformerEncoder(torch.nn.Module):
         # for cross attention with decoder later
         return xs, masks
 
+    def forward_chunk(
+        self,
+        xs: torch.Tensor,
+        context: torch.Tensor = torch.zeros(0, 0, 0),
+        cache: Dict[str, torch.Tensor] = {},
+    ) -> Tuple[torch.Tensor, Dict[str, torch.Tensor]]:
+        """ Forward only new frames of a streaming input, with output equal to
+            streaming forward over the whole input.
+
+        Args:
+            xs (torch.Tensor): new input frames (b=1, time, D), history frames
+                must be a multiple of static_chunk_size
+            context (torch.Tensor): pre lookahead frames (b=1, pre_lookahead_len, D),
+                empty context means last chunk
+            cache (Dict[str, torch.Tensor]): cache returned by previous chunk,
+                empty dict means first chunk
+                pre_lookahead: (b=1, pre_lookahead cache_t, D)
+                att_cache: (elayers, head, cache_t1, d_k * 2)
+                cnn_cache: (elayers, b=1, D, cache_t2)
+                up_cache: (b=1, D, up_layer.stride * 2)
+                up_att_cache: (up_elayers, head, cache_t1 * up_layer.stride, d_k * 2)
+                up_cnn_cache: (up_elayers, b=1, D, cache_t2)
+        Returns:
+            torch.Tensor: output of new frames (b=1, time * up_layer.stride, D)
+            Dict[str, torch.Tensor]: cache for next chunk
+        """
+        assert xs.size(0) == 1
+        assert self.static_chunk_size > 0, 'forward_chunk only supports static chunk streaming encoder'
+        att_cache = cache.get('att_cache', torch.zeros(0, 0, 0, 0))
+        offset = att_cache.size(2)
+        assert offset % self.static_chunk_size == 0, 'history frames {} should be a multiple of static_chunk_size {}'.format(offset, self.static_chunk_size)
+        masks = torch.ones(1, 1, xs.size(1), device=xs.device, dtype=torch.bool)
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+        xs, _, _ = self.embed(xs, masks, offset=offset)
+        if context.size(1) != 0:
+            assert self.training is False, 'you have passed context, make sure that you are running inference mode'
+            context_masks = torch.ones(1, 1, context.size(1)).to(masks)
+            context, _, _ = self.embed(context, context_masks, offset=offset + xs.size(1))
+        # lookahead + conformer encoder
+        xs, pre_lookahead_cache = self.pre_lookahead_layer.forward_chunk(xs, context=context, cache=cache.get('pre_lookahead_cache', torch.zeros(0, 0, 0)))
+        xs, att_cache, cnn_cache = self.forward_layers_chunk(self.encoders, self.embed, xs, self.static_chunk_size,
+                                                             att_cache, cache.get('cnn_cache', torch.zeros(0, 0, 0, 0)))
+
+        # upsample + conformer encoder
+        xs, up_cache = self.up_layer.forward_chunk(xs.transpose(1, 2).contiguous(), cache=cache.get('up_cache', torch.zeros(0, 0, 0)))
+        xs = xs.transpose(1, 2).contiguous()
+        masks = torch.ones(1, 1, xs.size(1), device=xs.device, dtype=torch.bool)
+        xs, _, _ = self.up_embed(xs, masks, offset=offset * self.up_layer.stride)
+        xs, up_att_cache, up_cnn_cache = self.forward_layers_chunk(self.up_encoders, self.up_embed, xs, self.static_chunk_size * self.up_layer.stride,
+                                                                   cache.get('up_att_cache', torch.zeros(0, 0, 0, 0)),
+                                                                   cache.get('up_cnn_cache', torch.zeros(0, 0, 0, 0)))
+
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+        return xs, {'pre_lookahead_cache': pre_lookahead_cache, 'att_cache': att_cache, 'cnn_cache': cnn_cache,
+                    'up_cache': up_cache, 'up_att_cache': up_att_cache, 'up_cnn_cache': up_cnn_cache}
+
+    def forward_layers_chunk(self, layers: torch.nn.ModuleList, embed: torch.nn.Module, xs: torch.Tensor, chunk_size: int,
+                             att_cache: torch.Tensor, cnn_cache: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        elayers, cache_t1 = att_cache.size(0), att_cache.size(2)
+        attention_key_size = cache_t1 + xs.size(1)
+        # NOTE new frames attend to all cached keys, so relative pos_emb covers the whole attention_key_size,
+        # rel_shift in RelPositionMultiHeadedAttention then picks the right relative position for each new frame
+        pos_emb = embed.position_encoding(offset=0, size=attention_key_size)
+        chunk_masks = subsequent_chunk_mask(attention_key_size, chunk_size, -1, xs.device)[cache_t1:].unsqueeze(0)
+        r_att_cache = []
+        r_cnn_cache = []
+        for i, layer in enumerate(layers):
+            xs, _, new_att_cache, new_cnn_cache = layer(
+                xs,
+                chunk_masks,
+                pos_emb,
+                att_cache=att_cache[i:i + 1] if elayers > 0 else att_cache,
+                cnn_cache=cnn_cache[i] if cnn_cache.size(0) > 0 else cnn_cache)
+            r_att_cache.append(new_att_cache)
+            r_cnn_cache.append(new_cnn_cache.unsqueeze(0))
+        return xs, torch.cat(r_att_cache, dim=0), torch.cat(r_cnn_cache, dim=0)
+
     def forward_layers(self, xs: torch.Tensor, chunk_masks: torch.Tensor,
                        pos_emb: torch.Tensor,
                        mask_pad: torch.Tensor) -> torch.Tensor:
@@ -319,3 +429,26 @@ class UpsampleConformerEncoder(torch.nn.Module):
         for layer in self.up_encoders:
             xs, chunk_masks, _, _ = layer(xs, chunk_masks, pos_emb, mask_pad)
         return xs
+
+
+if __name__ == '__main__':
+    # check forward_chunk against streaming forward over the whole input, with random weight encoder
+    encoder = UpsampleConformerEncoder(input_size=512, output_size=512, attention_heads=8, linear_units=2048, num_blocks=6, input_layer='linear',
+                                       pos_enc_layer_type='rel_pos_espnet', selfattention_layer_type='rel_selfattn', use_cnn_module=False,
+                                       macaron_style=False, static_chunk_size=25)
+    encoder.eval()
+    chunk_size, context_size = encoder.static_chunk_size, encoder.pre_lookahead_layer.pre_lookahead_len
+    max_len = 10 * chunk_size + 7
+    xs = torch.rand(1, max_len, 512)
+    with torch.inference_mode():
+        cache, offset, pred_chunk = {}, 0, []
+        for i in range(chunk_size, max_len + chunk_size, chunk_size):
+            finalize = True if i + context_size >= max_len else False
+            i = max_len if finalize is True else i
+            pred_gt, _ = encoder(xs[:, :i], torch.tensor([i]), context=xs[:, i:i + context_size], streaming=True)
+            h, cache = encoder.forward_chunk(xs[:, offset:i], context=xs[:, i:i + context_size], cache=cache)
+            pred_chunk.append(h)
+            offset = i
+            print((pred_gt - torch.concat(pred_chunk, dim=1)).abs().max().item())
+            if finalize is True:
+                break
@@ -0,0 +1,213 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Incremental encoders which turn streaming tts_speech chunks into one continuous audio byte stream."""
+
+import io
+import struct
+import numpy as np
+import soundfile as sf
+import torch
+import torchaudio
+
+
+class AudioEncoder:
+    """Encode float tts_speech chunks [1, T] in [-1, 1], every call returns the bytes ready to send, flush returns the tail."""
+
+    media_type = 'application/octet-stream'
+
+    def __init__(self, sample_rate: int, target_sample_rate: int = None):
+        self.sample_rate = sample_rate
+        self.target_sample_rate = sample_rate if target_sample_rate is None else target_sample_rate
+
+    def resample(self, tts_speech: torch.Tensor) -> np.ndarray:
+        # NOTE chunks are resampled independently, which is cheap but may leave tiny discontinuities at chunk boundaries
+        if self.target_sample_rate != self.sample_rate:
+            tts_speech = torchaudio.functional.resample(tts_speech, self.sample_rate, self.target_sample_rate)
+        return tts_speech.squeeze(dim=0).numpy()
+
+    def encode(self, tts_speech: torch.Tensor) -> bytes:
+        raise NotImplementedError
+
+    def flush(self) -> bytes:
+        return b''
+
+
+class PcmEncoder(AudioEncoder):
+    """Raw int16 little endian pcm, same as the original server output."""
+
+    def encode(self, tts_speech):
+        return (self.resample(tts_speech) * (2 ** 15)).astype(np.int16).tobytes()
+
+
+class WavEncoder(PcmEncoder):
+    """int16 pcm with a streaming wav header, data size is unknown so it is set to 0xFFFFFFFF, players read until eof."""
+
+    media_type = 'audio/wav'
+
+    def __init__(self, sample_rate, target_sample_rate=None):
+        super().__init__(sample_rate, target_sample_rate)
+        self.header_sent = False
+
+    def header(self):
+        return struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 0xFFFFFFFF, b'WAVE', b'fmt ', 16, 1, 1,
+                           self.target_sample_rate, self.target_sample_rate * 2, 2, 16, b'data', 0xFFFFFFFF)
+
+    def encode(self, tts_speech):
+        tts_audio = super().encode(tts_speech)
+        if self.header_sent is False:
+            self.header_sent = True
+            tts_audio = self.header() + tts_audio
+        return tts_audio
+
+    def flush(self):
+        # empty stream still gets a valid header
+        return b'' if self.header_sent is True else self.encode(torch.zeros(1, 0))
+
+
+class MulawEncoder(AudioEncoder):
+    """8 bit G.711 mu-law, resampled to 8k by default for telephony."""
+
+    media_type = 'audio/basic'
+
+    def __init__(self, sample_rate, target_sample_rate=8000):
+        super().__init__(sample_rate, target_sample_rate)
+
+    @staticmethod
+    def linear_to_mulaw(pcm: np.ndarray) -> np.ndarray:
+        # same as the g711 reference, int16 is reduced to 14 bit before companding
+        pcm = pcm.astype(np.int32) >> 2
+        mask = np.where(pcm < 0, 0x7F, 0xFF)
+        pcm = np.minimum(np.abs(pcm), 8159) + 0x21
+        segment = np.searchsorted(np.array([0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF, 0x1FFF]), pcm)
+        mulaw = np.where(segment >= 8, 0x7F, (segment << 4) | ((pcm >> (segment + 1)) & 0x0F))
+        return (mulaw ^ mask).astype(np.uint8)
+
+    def encode(self, tts_speech):
+        pcm = np.clip(self.resample(tts_speech) * (2 ** 15), -2 ** 15, 2 ** 15 - 1)
+        return self.linear_to_mulaw(pcm).tobytes()
+
+
+class SoundFileEncoder(AudioEncoder):
+    """Compressed stream written by libsndfile into memory, every call returns the newly written bytes.
+
+    NOTE libsndfile writes mp3 frames at once, but ogg opus pages only about every second.
+    """
+
+    def __init__(self, sample_rate, target_sample_rate=None, **kwargs):
+        super().__init__(sample_rate, target_sample_rate)
+        self.buffer = io.BytesIO()
+        self.file = sf.SoundFile(self.buffer, mode='w', samplerate=self.target_sample_rate, channels=1, **kwargs)
+        self.offset = 0
+
+    def read(self):
+        with self.buffer.getbuffer() as view:
+            tts_audio = bytes(view[self.offset:])
+        self.offset += len(tts_audio)
+        return tts_audio
+
+    def encode(self, tts_speech):
+        self.file.write(self.resample(tts_speech))
+        self.file.flush()
+        return self.read()
+
+    def flush(self):
+        self.file.close()
+        return self.read()
+
+
+class Mp3Encoder(SoundFileEncoder):
+    """Constant bitrate mp3, about 64kbps, so decoders without xing tag still know the stream length.
+
+    NOTE lame reserves the first frame for xing tag and fills it on close, which is too late for a stream,
+        so the zero filled placeholder frame is dropped, it ends at the next frame sync word.
+    """
+
+    media_type = 'audio/mpeg'
+
+    def __init__(self, sample_rate, target_sample_rate=None, compression_level=0.6):
+        super().__init__(sample_rate, target_sample_rate, format='MP3', subtype='MPEG_LAYER_III',
+                         bitrate_mode='CONSTANT', compression_level=compression_level)
+        self.pending = b''
+
+    def read(self):
+        tts_audio = super().read()
+        if self.pending is None:
+            return tts_audio
+        self.pending += tts_audio
+        for i in range(4, len(self.pending) - 1):
+            if self.pending[i] == 0xFF and self.pending[i + 1] & 0xE0 == 0xE0:
+                tts_audio, self.pending = self.pending[i:], None
+                return tts_audio
+        return b''
+
+
+class OpusEncoder(SoundFileEncoder):
+    """Ogg opus, opus only supports 8k/12k/16k/24k/48k, so 22050 is resampled to 24k."""
+
+    media_type = 'audio/ogg'
+
+    def __init__(self, sample_rate, target_sample_rate=None):
+        if target_sample_rate is None:
+            target_sample_rate = sample_rate if sample_rate in [8000, 12000, 16000, 24000, 48000] else 24000
+        super().__init__(sample_rate, target_sample_rate, format='OGG', subtype='OPUS')
+
+
+AUDIO_ENCODERS = {
+    'pcm': PcmEncoder,
+    'wav': WavEncoder,
+    'mp3': Mp3Encoder,
+    'opus': OpusEncoder,
+    'mulaw': MulawEncoder,
+}
+
+
+def get_audio_encoder(format: str, sample_rate: int) -> AudioEncoder:
+    assert format in AUDIO_ENCODERS, 'unsupported audio format {}, choose from {}'.format(format, list(AUDIO_ENCODERS.keys()))
+    return AUDIO_ENCODERS[format](sample_rate)
+
+
+def encode_audio(model_output, encoder: AudioEncoder, flush: bool = True):
+    """Encode model output chunks with encoder, empty bytes are skipped as compressed encoders may buffer.
+
+    flush is False if encoder is shared by several model outputs of one stream, e.g. sentences of a websocket, the caller flushes it.
+    """
+    for i in model_output:
+        tts_audio = encoder.encode(i['tts_speech'])
+        if len(tts_audio) != 0:
+            yield tts_audio
+    if flush is False:
+        return
+    tts_audio = encoder.flush()
+    if len(tts_audio) != 0:
+        yield tts_audio
+
+
+if __name__ == '__main__':
+    import time
+    # encode 10s speech-like audio in 0.5s chunks, report encoding speed and bitrate of every format
+    for sample_rate in [22050, 24000]:
+        t = torch.arange(sample_rate * 10) / sample_rate
+        speech = (0.3 * torch.sin(2 * np.pi * 220 * t) * torch.sin(2 * np.pi * 3 * t) + 0.01 * torch.randn_like(t)).unsqueeze(dim=0)
+        chunks = [{'tts_speech': i} for i in speech.split(sample_rate // 2, dim=1)]
+        for format in AUDIO_ENCODERS:
+            encoder, tts_audio, first_chunk = get_audio_encoder(format, sample_rate), [], None
+            start_time = time.time()
+            for i, chunk in enumerate(chunks):
+                tts_audio.append(encoder.encode(chunk['tts_speech']))
+                if first_chunk is None and len(tts_audio[-1]) != 0:
+                    first_chunk = i + 1
+            tts_audio.append(encoder.flush())
+            encode_time = time.time() - start_time
+            print('sample_rate {} format {} realtime factor {:.5f} {:.1f} kbps first bytes after {} chunks'.format(
+                sample_rate, format, encode_time / 10, sum([len(i) for i in tts_audio]) * 8 / 10 / 1000, first_chunk))
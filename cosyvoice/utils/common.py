@@ -18,6 +18,8 @@
 
 import queue
 import random
+import contextvars
+from contextlib import contextmanager
 from typing import List
 
 import numpy as np
@@ -157,24 +159,62 @@ def nucleus_sampling(weighted_scores, top_p=0.8, top_k=25):
             break
     prob = torch.tensor(prob).to(weighted_scores)
     indices = torch.tensor(indices, dtype=torch.long).to(weighted_scores.device)
-    top_ids = indices[prob.multinomial(1, replacement=True)].item()
+    top_ids = indices[multinomial(prob)].item()
     return top_ids
 
 
 def random_sampling(weighted_scores, decoded_tokens, sampling):
-    top_ids = weighted_scores.softmax(dim=0).multinomial(1, replacement=True).item()
+    top_ids = multinomial(weighted_scores.softmax(dim=0)).item()
     return top_ids
 
 
+@torch.inference_mode()
 def fade_in_out(fade_in_mel, fade_out_mel, window):
-    device = fade_in_mel.device
-    fade_in_mel, fade_out_mel = fade_in_mel.cpu(), fade_out_mel.cpu()
+    """Crossfade head of fade_in_mel with tail of fade_out_mel in place, on fade_in_mel device.
+
+    NOTE window should be a tensor cached on fade_in_mel device, numpy window is also accepted but copied in every call.
+    """
+    if not isinstance(window, torch.Tensor):
+        window = torch.from_numpy(window)
+    window = window.to(fade_in_mel.device, fade_in_mel.dtype)
     mel_overlap_len = int(window.shape[0] / 2)
-    if fade_in_mel.device == torch.device('cpu'):
-        fade_in_mel = fade_in_mel.clone()
-    fade_in_mel[..., :mel_overlap_len] = fade_in_mel[..., :mel_overlap_len] * window[:mel_overlap_len] + \
-        fade_out_mel[..., -mel_overlap_len:] * window[mel_overlap_len:]
-    return fade_in_mel.to(device)
+    fade_in_mel[..., :mel_overlap_len].mul_(window[:mel_overlap_len]).addcmul_(fade_out_mel[..., -mel_overlap_len:], window[mel_overlap_len:])
+    return fade_in_mel
+
+
+# torch.Generator which sampling and noise of inference in this context draw from, None means the global rng
+_generator = contextvars.ContextVar('generator', default=None)
+
+
+@contextmanager
+def use_generator(generator):
+    """Draw llm sampling and flow/hift noise in this context from generator, e.g. of a seeded tts session, instead of the global rng."""
+    token = _generator.set(generator)
+    try:
+        yield
+    finally:
+        _generator.reset(token)
+
+
+def multinomial(prob):
+    generator = _generator.get()
+    if generator is None:
+        return prob.multinomial(1, replacement=True)
+    return prob.to(generator.device).multinomial(1, replacement=True, generator=generator).to(prob.device)
+
+
+def rand(*size, device=None):
+    generator = _generator.get()
+    if generator is None:
+        return torch.rand(*size, device=device)
+    return torch.rand(*size, generator=generator, device=generator.device).to(device)
+
+
+def randn_like(x):
+    generator = _generator.get()
+    if generator is None:
+        return torch.randn_like(x)
+    return torch.randn(x.shape, generator=generator, device=generator.device, dtype=x.dtype).to(x.device)
 
 
 def set_all_random_seed(seed):
@@ -16,6 +16,7 @@
 
 import os
 import json
+from io import BytesIO
 import torch
 import torchaudio
 import logging
@@ -42,6 +43,9 @@ def read_json_lists(list_file):
 
 
 def load_wav(wav, target_sr, min_sr=16000):
+    # NOTE frontend loads the same prompt wav several times, rewind file-like wav, e.g. io.BytesIO from server request
+    if hasattr(wav, 'seek'):
+        wav.seek(0)
     speech, sample_rate = torchaudio.load(wav, backend='soundfile')
     speech = speech.mean(dim=0, keepdim=True)
     if sample_rate != target_sr:
@@ -50,6 +54,12 @@ def load_wav(wav, target_sr, min_sr=16000):
     return speech
 
 
+def audio_metadata(audio_data):
+    """Duration, sample rate and samples per channel of encoded audio bytes read from its header, without decoding."""
+    info = torchaudio.info(BytesIO(audio_data))
+    return {'duration': info.num_frames / info.sample_rate, 'sample_rate': info.sample_rate, 'num_samples': info.num_frames}
+
+
 def convert_onnx_to_trt(trt_model, trt_kwargs, onnx_model, fp16):
     import tensorrt as trt
     logging.info("Converting onnx to trt...")
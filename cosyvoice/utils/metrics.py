@@ -0,0 +1,160 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Per-stage latency and throughput metrics, no-op unless a server installs PrometheusMetrics with set_metrics."""
+
+import time
+import bisect
+import threading
+from contextlib import nullcontext
+import torch
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+RTF_BUCKETS = [0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.0, 5.0]
+TOKEN_RATE_BUCKETS = [5, 10, 25, 50, 100, 200, 400, 800, 1600]
+
+# name: (type, help, buckets)
+METRICS = {
+    'text_normalize_seconds': ('histogram', 'Text normalization time of a text or prompt.', LATENCY_BUCKETS),
+    'prompt_extract_seconds': ('histogram', 'Prompt speech token, speech feat and speaker embedding extraction time.', LATENCY_BUCKETS),
+    'llm_first_token_seconds': ('histogram', 'Time from llm start to first speech token, i.e. prefill, includes text wait in bistream mode.', LATENCY_BUCKETS),
+    'llm_tokens_per_second': ('histogram', 'Speech token decoding speed of a text segment after the first token.', TOKEN_RATE_BUCKETS),
+    'llm_tokens_total': ('counter', 'Speech tokens generated by llm.', None),
+    'flow_chunk_seconds': ('histogram', 'Flow matching time of a chunk.', LATENCY_BUCKETS),
+    'hift_chunk_seconds': ('histogram', 'Vocoder time of a chunk.', LATENCY_BUCKETS),
+    'first_chunk_seconds': ('histogram', 'Time from request start to its first speech chunk.', LATENCY_BUCKETS),
+    'rtf': ('histogram', 'Real time factor of a finished request, time spent by the consumer between chunks excluded.', RTF_BUCKETS),
+    'cache_lookup_seconds': ('histogram', 'Result cache key hashing and lookup time of a seeded request.', LATENCY_BUCKETS),
+    'requests_total': ('counter', 'Finished inference requests.', None),
+    'speech_seconds_total': ('counter', 'Seconds of speech generated.', None),
+}
+
+
+class Timer:
+    """Observe elapsed seconds of a with block, cuda device is synchronized so async kernels are counted."""
+
+    def __init__(self, metrics, name, device=None):
+        self.metrics = metrics
+        self.name = name
+        # NOTE only the current stream is synchronized, llm runs in its own stream concurrently
+        self.cuda = device is not None and torch.device(device).type == 'cuda'
+
+    def __enter__(self):
+        if self.cuda is True:
+            torch.cuda.current_stream().synchronize()
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        if self.cuda is True:
+            torch.cuda.current_stream().synchronize()
+        self.metrics.observe(self.name, time.perf_counter() - self.start_time)
+
+
+NULL_TIMER = nullcontext()
+
+
+class Metrics:
+    """No-op metrics, every call returns immediately so instrumentation costs nothing by default."""
+
+    enabled = False
+
+    def observe(self, name: str, value: float):
+        pass
+
+    def inc(self, name: str, value: float = 1.0):
+        pass
+
+    def timer(self, name: str, device=None):
+        return NULL_TIMER
+
+    def render(self) -> str:
+        return ''
+
+
+class PrometheusMetrics(Metrics):
+    """In process histograms and counters rendered in prometheus text format, no prometheus_client dependency."""
+
+    enabled = True
+
+    def __init__(self, prefix: str = 'cosyvoice'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.values = {}
+        for name, (type, _, buckets) in METRICS.items():
+            self.values[name] = {'buckets': [0] * (len(buckets) + 1), 'sum': 0.0, 'count': 0} if type == 'histogram' else 0.0
+
+    def observe(self, name, value):
+        buckets = METRICS[name][2]
+        with self.lock:
+            histogram = self.values[name]
+            histogram['buckets'][bisect.bisect_left(buckets, value)] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def inc(self, name, value=1.0):
+        assert METRICS[name][0] == 'counter', '{} is not a counter'.format(name)
+        with self.lock:
+            self.values[name] += value
+
+    def timer(self, name, device=None):
+        return Timer(self, name, device)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for key, (type, help, buckets) in METRICS.items():
+                name, value = '{}_{}'.format(self.prefix, key), self.values[key]
+                lines += ['# HELP {} {}'.format(name, help), '# TYPE {} {}'.format(name, type)]
+                if type == 'counter':
+                    lines.append('{} {}'.format(name, value))
+                    continue
+                count = 0
+                for le, n in zip(buckets + ['+Inf'], value['buckets']):
+                    count += n
+                    lines.append('{}_bucket{{le="{}"}} {}'.format(name, le, count))
+                lines += ['{}_sum {}'.format(name, value['sum']), '{}_count {}'.format(name, value['count'])]
+        return '\n'.join(lines) + '\n'
+
+
+def render_samples(name: str, type: str, help: str, samples: dict, prefix: str = 'cosyvoice') -> str:
+    """Render metrics owned by the caller, e.g. scheduler queue depth, samples maps a tuple of label pairs to value."""
+    name = '{}_{}'.format(prefix, name)
+    lines = ['# HELP {} {}'.format(name, help), '# TYPE {} {}'.format(name, type)]
+    for labels, value in samples.items():
+        labels = ','.join(['{}="{}"'.format(k, v) for k, v in labels])
+        lines.append('{}{{{}}} {}'.format(name, labels, value) if labels != '' else '{} {}'.format(name, value))
+    return '\n'.join(lines) + '\n'
+
+
+_metrics = Metrics()
+
+
+def get_metrics() -> Metrics:
+    return _metrics
+
+
+def set_metrics(metrics: Metrics):
+    global _metrics
+    _metrics = metrics
+
+
+if __name__ == '__main__':
+    # overhead of a timed block, no-op metrics should cost about the same as an empty with block
+    for metrics in [Metrics(), PrometheusMetrics()]:
+        start_time = time.perf_counter()
+        for _ in range(100000):
+            with metrics.timer('flow_chunk_seconds'):
+                pass
+        print('{} {:.3f}us per timed block'.format(metrics.__class__.__name__, (time.perf_counter() - start_time) * 10))
+    print(metrics.render())
@@ -0,0 +1,205 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Named spans on the inference hot path, no-op unless a server or script installs a profiler with set_profiler.
+
+spans: frontend_text_normalize, frontend_text_token, frontend_speech_token, frontend_speech_feat, frontend_spk_embedding,
+llm_prefill, llm_step, flow, flow_encoder, flow_ode_step, hift, and request around a sampled server request.
+ChromeTraceProfiler writes chrome://tracing or perfetto json, TorchProfiler emits torch.profiler record_function ranges.
+"""
+
+import os
+import json
+import time
+import random
+import threading
+import contextvars
+from functools import wraps, partial
+from contextlib import nullcontext, contextmanager
+import torch
+
+NULL_SPAN = nullcontext()
+# trace of the current request, None if the request is not sampled
+NO_REQUEST = object()
+_trace = contextvars.ContextVar('trace', default=NO_REQUEST)
+
+
+class Trace:
+    """Complete events of a request, or of everything outside requests."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.events = []
+        self.threads = {}
+
+    def add(self, name, start_time, end_time, args):
+        thread = threading.current_thread()
+        self.threads[thread.ident] = thread.name
+        # NOTE list append is atomic, llm thread and synthesis thread of a request add events concurrently
+        self.events.append({'name': name, 'ph': 'X', 'ts': start_time * 1e6, 'dur': (end_time - start_time) * 1e6,
+                            'pid': os.getpid(), 'tid': thread.ident, 'args': args})
+
+    def to_json(self):
+        threads = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': k, 'args': {'name': v}} for k, v in list(self.threads.items())]
+        return {'traceEvents': threads + list(self.events), 'displayTimeUnit': 'ms', 'otherData': {'trace': self.name}}
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_json(), f)
+
+
+class Span:
+    def __init__(self, trace, name, args, synchronize):
+        self.trace = trace
+        self.name = name
+        self.args = args
+        self.synchronize = synchronize
+
+    def __enter__(self):
+        if self.synchronize is True:
+            torch.cuda.synchronize()
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        if self.synchronize is True:
+            torch.cuda.synchronize()
+        self.trace.add(self.name, self.start_time, time.perf_counter(), self.args)
+
+
+class Profiler:
+    """No-op profiler, span returns a shared null context so instrumented code costs a method call by default."""
+
+    enabled = False
+
+    def span(self, name: str, **args):
+        return NULL_SPAN
+
+    def request(self, request_id: str, sampled: bool = None):
+        return NULL_SPAN
+
+
+class SamplingProfiler(Profiler):
+    """Spans of a server request count only if the request is sampled, spans outside any request count if outside_requests.
+
+    sample_rate can be changed at runtime, 0 keeps tracing installed but records nothing of requests.
+    NOTE servers set outside_requests to False, or spans of e.g. speaker registration pile up in memory.
+    """
+
+    enabled = True
+
+    def __init__(self, sample_rate: float = 1.0, outside_requests: bool = True):
+        self.sample_rate = sample_rate
+        self.default = Trace('default') if outside_requests is True else None
+
+    def current(self):
+        trace = _trace.get()
+        return self.default if trace is NO_REQUEST else trace
+
+    @contextmanager
+    def request(self, request_id, sampled=None):
+        """Trace spans in this context and in threads bound by bind_trace, if sampled, with probability sample_rate by default."""
+        if sampled is None:
+            sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        trace = Trace(request_id) if sampled is True else None
+        token = _trace.set(trace)
+        try:
+            with self.span('request', request_id=request_id):
+                yield trace
+        finally:
+            _trace.reset(token)
+            if trace is not None:
+                self.finish(trace)
+
+    def finish(self, trace):
+        pass
+
+
+class ChromeTraceProfiler(SamplingProfiler):
+    """Record spans as chrome trace complete events, trace of a sampled request is written to trace_dir/<request_id>.json.
+
+    NOTE cuda kernels run asynchronously, set synchronize to time them in spans, which serializes llm and flow streams.
+    """
+
+    def __init__(self, sample_rate: float = 1.0, outside_requests: bool = True, trace_dir: str = '', synchronize: bool = False):
+        super().__init__(sample_rate, outside_requests)
+        self.trace_dir = trace_dir
+        self.synchronize = synchronize and torch.cuda.is_available()
+        if trace_dir != '':
+            os.makedirs(trace_dir, exist_ok=True)
+
+    def span(self, name, **args):
+        trace = self.current()
+        if trace is None:
+            return NULL_SPAN
+        return Span(trace, name, args, self.synchronize)
+
+    def finish(self, trace):
+        if self.trace_dir != '':
+            trace.dump(os.path.join(self.trace_dir, '{}.json'.format(trace.name)))
+
+    def dump(self, path):
+        """Write spans recorded outside of requests, e.g. by a benchmark script."""
+        assert self.default is not None, 'spans outside of requests are not recorded'
+        self.default.dump(path)
+
+
+class TorchProfiler(SamplingProfiler):
+    """Emit spans as torch.profiler record_function ranges, which show up in an active torch.profiler.profile session.
+
+    NOTE torch.profiler only records the thread it is started in, llm job runs in its own thread, use chrome trace for llm spans.
+    """
+
+    def span(self, name, **args):
+        if self.current() is None:
+            return NULL_SPAN
+        return torch.profiler.record_function(name)
+
+
+_profiler = Profiler()
+
+
+def get_profiler() -> Profiler:
+    return _profiler
+
+
+def set_profiler(profiler: Profiler):
+    global _profiler
+    _profiler = profiler
+
+
+def bind_trace(func):
+    """Run func with the trace of the current request, for threads started by a request, e.g. llm job."""
+    return partial(contextvars.copy_context().run, func)
+
+
+def traced(name):
+    """Run the decorated function in span name."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with _profiler.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+if __name__ == '__main__':
+    # overhead of a span, no-op profiler and unsampled requests should cost about the same as an empty with block
+    for profiler, sampled in [(Profiler(), None), (ChromeTraceProfiler(), False), (ChromeTraceProfiler(), True), (TorchProfiler(), True)]:
+        with profiler.request('benchmark', sampled=sampled):
+            start_time = time.perf_counter()
+            for _ in range(100000):
+                with profiler.span('flow_ode_step'):
+                    pass
+        print('{} sampled {} {:.3f}us per span'.format(profiler.__class__.__name__, sampled, (time.perf_counter() - start_time) * 10))
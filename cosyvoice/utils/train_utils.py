@@ -52,6 +52,8 @@ def init_distributed(args):
 
 def init_dataset_and_dataloader(args, configs, gan, dpo):
     data_pipeline = configs['data_pipeline_gan'] if gan is True else configs['data_pipeline']
+    if args.precomputed_feat is True:
+        data_pipeline = configs['data_pipeline_gan_feat'] if gan is True else configs['data_pipeline_feat']
     train_dataset = Dataset(args.train_data, data_pipeline=data_pipeline, mode='train', gan=gan, dpo=dpo, shuffle=True, partition=True)
     cv_dataset = Dataset(args.cv_data, data_pipeline=data_pipeline, mode='train', gan=gan, dpo=dpo, shuffle=False, partition=False)
 
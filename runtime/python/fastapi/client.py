@@ -19,37 +19,78 @@ import torchaudio
 import numpy as np
 
 
+def prompt_files():
+    # registered speaker needs no prompt upload
+    if args.zero_shot_spk_id != '':
+        return None
+    return [('prompt_wav', ('prompt_wav', open(args.prompt_wav, 'rb'), 'application/octet-stream'))]
+
+
 def main():
     url = "http://{}:{}/inference_{}".format(args.host, args.port, args.mode)
+    if args.register is True:
+        response = requests.request("POST", "http://{}:{}/speakers".format(args.host, args.port),
+                                    data={'spk_id': args.zero_shot_spk_id, 'prompt_text': args.prompt_text, 'model': args.model},
+                                    files=[('prompt_wav', ('prompt_wav', open(args.prompt_wav, 'rb'), 'application/octet-stream'))])
+        args.zero_shot_spk_id = response.json()['spk_id']
+        logging.info('register speaker {}'.format(args.zero_shot_spk_id))
     if args.mode == 'sft':
         payload = {
             'tts_text': args.tts_text,
-            'spk_id': args.spk_id
+            'spk_id': args.spk_id,
+            'format': args.format,
+            'priority': args.priority,
+            'deadline': args.deadline,
+            'seed': args.seed,
+            'model': args.model
         }
         response = requests.request("GET", url, data=payload, stream=True)
     elif args.mode == 'zero_shot':
         payload = {
             'tts_text': args.tts_text,
-            'prompt_text': args.prompt_text
+            'prompt_text': args.prompt_text,
+            'spk_id': args.zero_shot_spk_id,
+            'format': args.format,
+            'priority': args.priority,
+            'deadline': args.deadline,
+            'seed': args.seed,
+            'model': args.model
         }
-        files = [('prompt_wav', ('prompt_wav', open(args.prompt_wav, 'rb'), 'application/octet-stream'))]
+        files = prompt_files()
         response = requests.request("GET", url, data=payload, files=files, stream=True)
     elif args.mode == 'cross_lingual':
         payload = {
             'tts_text': args.tts_text,
+            'spk_id': args.zero_shot_spk_id,
+            'format': args.format,
+            'priority': args.priority,
+            'deadline': args.deadline,
+            'seed': args.seed,
+            'model': args.model
         }
-        files = [('prompt_wav', ('prompt_wav', open(args.prompt_wav, 'rb'), 'application/octet-stream'))]
+        files = prompt_files()
         response = requests.request("GET", url, data=payload, files=files, stream=True)
     else:
         payload = {
             'tts_text': args.tts_text,
             'spk_id': args.spk_id,
-            'instruct_text': args.instruct_text
+            'instruct_text': args.instruct_text,
+            'format': args.format,
+            'priority': args.priority,
+            'deadline': args.deadline,
+            'seed': args.seed,
+            'model': args.model
         }
         response = requests.request("GET", url, data=payload, stream=True)
     tts_audio = b''
     for r in response.iter_content(chunk_size=16000):
         tts_audio += r
+    if args.format != 'pcm':
+        # encoded stream is saved as is, e.g. --format mp3 --tts_wav demo.mp3
+        logging.info('save {} response to {}'.format(args.format, args.tts_wav))
+        with open(args.tts_wav, 'wb') as f:
+            f.write(tts_audio)
+        return
     tts_speech = torch.from_numpy(np.array(np.frombuffer(tts_audio, dtype=np.int16))).unsqueeze(dim=0)
     logging.info('save response to {}'.format(args.tts_wav))
     torchaudio.save(args.tts_wav, tts_speech, target_sr)
@@ -68,12 +109,39 @@ if __name__ == "__main__":
                         default='sft',
                         choices=['sft', 'zero_shot', 'cross_lingual', 'instruct'],
                         help='request mode')
+    parser.add_argument('--format',
+                        default='pcm',
+                        choices=['pcm', 'wav', 'mp3', 'opus', 'mulaw'],
+                        help='response audio format')
+    parser.add_argument('--model',
+                        type=str,
+                        default='',
+                        help='registered model name of server, empty means default model')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=None,
+                        help='sampling seed, seeded requests are reproducible and may be served from server result cache')
+    parser.add_argument('--priority',
+                        default='interactive',
+                        choices=['interactive', 'batch'],
+                        help='request priority class of server scheduler')
+    parser.add_argument('--deadline',
+                        type=float,
+                        default=None,
+                        help='seconds the request may wait in server queue before synthesis starts, not a completion time, default by priority')
     parser.add_argument('--tts_text',
                         type=str,
                         default='你好，我是通义千问语音合成大模型，请问有什么可以帮您的吗？')
     parser.add_argument('--spk_id',
                         type=str,
                         default='中文女')
+    parser.add_argument('--zero_shot_spk_id',
+                        type=str,
+                        default='',
+                        help='registered speaker used instead of prompt_wav')
+    parser.add_argument('--register',
+                        action='store_true',
+                        help='register prompt_wav as zero_shot_spk_id first, a new id is generated if it is empty')
     parser.add_argument('--prompt_text',
                         type=str,
                         default='希望你以后能够做的比我还好呦。')
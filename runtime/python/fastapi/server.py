@@ -13,19 +13,29 @@
 # limitations under the License.
 import os
 import sys
+import io
+import uuid
+import queue
+import base64
 import argparse
+import asyncio
 import logging
+import threading
+from typing import Optional
+from functools import partial
 logging.getLogger('matplotlib').setLevel(logging.WARNING)
-from fastapi import FastAPI, UploadFile, Form, File
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, UploadFile, Form, File, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
-import numpy as np
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append('{}/../../..'.format(ROOT_DIR))
 sys.path.append('{}/../../../third_party/Matcha-TTS'.format(ROOT_DIR))
-from cosyvoice.cli.cosyvoice import CosyVoice, CosyVoice2
-from cosyvoice.utils.file_utils import load_wav
+from cosyvoice.cli.model_manager import ServerModels
+from cosyvoice.cli.scheduler import Scheduler, PRIORITIES, DeadlineExceeded
+from cosyvoice.utils.audio_encoder import AUDIO_ENCODERS, get_audio_encoder, encode_audio
+from cosyvoice.utils.metrics import PrometheusMetrics, get_metrics, set_metrics
+from cosyvoice.utils.profiler import ChromeTraceProfiler, get_profiler, set_profiler
 
 app = FastAPI()
 # set cross region allowance
@@ -37,48 +47,465 @@ app.add_middleware(
     allow_headers=["*"])
 
 
-def generate_data(model_output):
-    for i in model_output:
-        tts_audio = (i['tts_speech'].numpy() * (2 ** 15)).astype(np.int16).tobytes()
-        yield tts_audio
+def audio_encode(format, sample_rate):
+    """Return encode function of InferencePool.submit, a new stateful encoder per request, which runs in the worker thread."""
+    return partial(encode_audio, encoder=get_audio_encoder(format, sample_rate))
 
 
+def check_params(format, priority, model=''):
+    if model not in models:
+        return JSONResponse(status_code=404, content={'detail': 'model {} not registered, choose from {}'.format(model, list(models.model_dirs.keys()))})
+    if format not in AUDIO_ENCODERS:
+        return JSONResponse(status_code=400, content={'detail': 'unsupported format {}, choose from {}'.format(format, list(AUDIO_ENCODERS.keys()))})
+    if priority not in PRIORITIES:
+        return JSONResponse(status_code=400, content={'detail': 'unsupported priority {}, choose from {}'.format(priority, list(PRIORITIES.keys()))})
+    return None
+
+
+class InferencePool:
+    """Run blocking synthesis through Scheduler worker threads, and bridge its chunks back to the event loop through an asyncio.Queue.
+
+    NOTE all workers share one model, which is thread safe as every tts call keeps its own session state.
+    """
+
+    def __init__(self, scheduler: Scheduler, retry_after: int = 1):
+        self.scheduler = scheduler
+        self.retry_after = retry_after
+
+    def busy_response(self, reason='server busy'):
+        return JSONResponse(status_code=503,
+                            content={'detail': '{}, {} requests in flight'.format(reason, self.scheduler.in_flight)},
+                            headers={'Retry-After': str(self.retry_after)})
+
+    def submit(self, job, *args, encode, priority='interactive', deadline=None):
+        """Queue job(*args), which returns a model output generator, return an async generator of its audio bytes, or None if rejected.
+
+        NOTE if the request is shed at its deadline, the async generator raises DeadlineExceeded.
+        """
+        loop = asyncio.get_running_loop()
+        chunk_queue, cancel = asyncio.Queue(), threading.Event()
+
+        def worker():
+            with get_profiler().request(uuid.uuid4().hex):
+                try:
+                    model_output = job(*args)
+                    try:
+                        for i in encode(model_output):
+                            if cancel.is_set():
+                                break
+                            loop.call_soon_threadsafe(chunk_queue.put_nowait, (i, None))
+                    finally:
+                        # NOTE close model output at once, so llm job is stopped and session is released
+                        model_output.close()
+                except Exception as e:
+                    logging.exception('inference failed')
+                    loop.call_soon_threadsafe(chunk_queue.put_nowait, (None, e))
+                finally:
+                    loop.call_soon_threadsafe(chunk_queue.put_nowait, (None, None))
+
+        def on_shed():
+            loop.call_soon_threadsafe(chunk_queue.put_nowait, (None, DeadlineExceeded('request is not started before its deadline')))
+
+        scheduled = self.scheduler.submit(worker, priority, deadline, on_shed)
+        if scheduled is None:
+            return None
+
+        async def stream():
+            try:
+                while True:
+                    tts_audio, e = await chunk_queue.get()
+                    if e is not None:
+                        raise e
+                    if tts_audio is None:
+                        break
+                    yield tts_audio
+            finally:
+                # client disconnected or stream finished, drop queued job or stop worker at next chunk
+                cancel.set()
+                self.scheduler.cancel(scheduled)
+        return stream()
+
+    async def response(self, job, *args, format='pcm', sample_rate=22050, priority='interactive', deadline=None):
+        """Return StreamingResponse once the first chunk is ready, so rejected or shed requests still get 503."""
+        audio = self.submit(job, *args, encode=audio_encode(format, sample_rate), priority=priority, deadline=deadline)
+        if audio is None:
+            return self.busy_response()
+        try:
+            tts_audio = await audio.__anext__()
+        except StopAsyncIteration:
+            tts_audio = b''
+        except DeadlineExceeded:
+            return self.busy_response('request deadline exceeded')
+        except BaseException:
+            await audio.aclose()
+            raise
+
+        async def stream():
+            try:
+                yield tts_audio
+                async for i in audio:
+                    yield i
+            finally:
+                await audio.aclose()
+        return StreamingResponse(stream(), media_type=AUDIO_ENCODERS[format].media_type)
+
+
+async def load_model(model):
+    """Load model in executor if it is not resident, and return it for request checks.
+
+    NOTE it is released at once, job acquires it again in worker thread, which reloads it in the rare case it is evicted in between.
+    """
+    loaded = await asyncio.get_running_loop().run_in_executor(None, models.acquire, model)
+    models.release(loaded)
+    return loaded
+
+
+def sft_job(model, tts_text, spk_id, seed):
+    return models.inference(model, lambda m: m.result_cache.inference('sft', tts_text, spk_id, seed=seed))
+
+
+def prompt_wav_file(prompt_wav):
+    # registered speaker has no prompt wav
+    return io.BytesIO(prompt_wav) if prompt_wav is not None else ''
+
+
+def zero_shot_job(model, tts_text, prompt_text, prompt_wav, spk_id, seed):
+    return models.inference(model, lambda m: m.result_cache.inference('zero_shot', tts_text, prompt_text, prompt_wav_file(prompt_wav), zero_shot_spk_id=spk_id, seed=seed))
+
+
+def cross_lingual_job(model, tts_text, prompt_wav, spk_id, seed):
+    return models.inference(model, lambda m: m.result_cache.inference('cross_lingual', tts_text, prompt_wav_file(prompt_wav), zero_shot_spk_id=spk_id, seed=seed))
+
+
+def instruct_job(model, tts_text, spk_id, instruct_text, seed):
+    return models.inference(model, lambda m: m.result_cache.inference('instruct', tts_text, spk_id, instruct_text, seed=seed))
+
+
+def instruct2_job(model, tts_text, instruct_text, prompt_wav, spk_id, seed):
+    return models.inference(model, lambda m: m.result_cache.inference('instruct2', tts_text, instruct_text, prompt_wav_file(prompt_wav), zero_shot_spk_id=spk_id, seed=seed))
+
+
+def check_prompt(loaded, prompt_wav, spk_id):
+    """Zero shot requests use either an uploaded prompt_wav or a spk_id registered to the model."""
+    if spk_id != '' and spk_id not in loaded.speaker_store:
+        return JSONResponse(status_code=404, content={'detail': 'speaker {} not registered'.format(spk_id)})
+    if spk_id == '' and prompt_wav is None:
+        return JSONResponse(status_code=400, content={'detail': 'prompt_wav or spk_id is required'})
+    return None
+
+
+class SentenceSegmenter:
+    """Split incremental text at sentence end punctuation, sentences shorter than min_len are merged into the next one."""
+
+    punctuation = ['。', '？', '！', '；', '.', '?', '!', ';', '\n']
+
+    def __init__(self, min_len: int = 10):
+        self.min_len = min_len
+        self.sentence_len = 0
+
+    def push(self, text):
+        """Return [(piece, end_of_sentence)] which covers all characters of text."""
+        pieces, start = [], 0
+        for i, c in enumerate(text):
+            self.sentence_len += 1
+            if c in self.punctuation and self.sentence_len >= self.min_len:
+                pieces.append((text[start: i + 1], True))
+                start, self.sentence_len = i + 1, 0
+        if start < len(text):
+            pieces.append((text[start:], False))
+        return pieces
+
+
+def text_generator(text_queue):
+    while True:
+        text = text_queue.get()
+        if text is None:
+            break
+        yield text
+
+
+def ws_job(cosyvoice, setup, spk_id, sentence):
+    """Synthesize one sentence of a websocket, a complete str, or a queue of text pieces ended by None.
+
+    CosyVoice2/3 feed pieces into inference_bistream so llm starts before the sentence is complete,
+    CosyVoice1 does not support bistream, so it gets every complete sentence.
+    """
+    mode = setup.get('mode', 'sft')
+    tts_text = text_generator(sentence) if isinstance(sentence, queue.Queue) else sentence
+    if mode == 'sft':
+        return cosyvoice.inference_sft(tts_text, spk_id, stream=True)
+    elif mode == 'zero_shot':
+        return cosyvoice.inference_zero_shot(tts_text, '', '', zero_shot_spk_id=spk_id, stream=True)
+    elif mode == 'cross_lingual':
+        return cosyvoice.inference_cross_lingual(tts_text, '', zero_shot_spk_id=spk_id, stream=True)
+    elif mode == 'instruct':
+        return cosyvoice.inference_instruct(tts_text, spk_id, setup.get('instruct_text', ''), stream=True)
+    else:
+        return cosyvoice.inference_instruct2(tts_text, setup.get('instruct_text', ''), '', zero_shot_spk_id=spk_id, stream=True)
+
+
+@app.websocket("/ws/tts")
+async def ws_tts(websocket: WebSocket):
+    """Streaming text in, streaming audio out.
+
+    client sends setup json once, e.g. {"mode": "zero_shot", "prompt_text": "...", "prompt_wav": "<base64 wav>", "format": "pcm", "model": ""},
+    or {"mode": "zero_shot", "spk_id": "<registered speaker>"},
+    then {"text": "..."} fragments, then {"event": "end"}.
+    server sends binary audio frames, int16 pcm or consecutive pieces of one ogg opus stream, then {"event": "end"} or {"event": "error", "message": "..."}.
+    NOTE every sentence is one scheduler job with deadline of setup, so an idle connection holds no worker,
+        a bistream sentence holds one while its text is arriving. ogg pages of opus come about every second, so opus frames lag pcm ones.
+    """
+    await websocket.accept()
+    setup = await websocket.receive_json()
+    if setup.get('mode', 'sft') not in ['sft', 'zero_shot', 'cross_lingual', 'instruct', 'instruct2'] or setup.get('format', 'pcm') not in ['pcm', 'opus']:
+        await websocket.send_json({'event': 'error', 'message': 'unsupported mode {} or format {}'.format(setup.get('mode'), setup.get('format'))})
+        await websocket.close()
+        return
+    if setup.get('model', '') not in models:
+        await websocket.send_json({'event': 'error', 'message': 'model {} not registered'.format(setup.get('model'))})
+        await websocket.close()
+        return
+    loaded = await load_model(setup.get('model', ''))
+    mode, spk_id = setup.get('mode', 'sft'), setup.get('spk_id', '')
+    if mode in ['zero_shot', 'cross_lingual', 'instruct2'] and 'prompt_wav' not in setup and spk_id not in loaded.speaker_store:
+        await websocket.send_json({'event': 'error', 'message': 'prompt_wav or registered spk_id is required'})
+        await websocket.close()
+        return
+    loop = asyncio.get_running_loop()
+    # NOTE keep the model resident for the whole connection, sentence jobs run on it
+    loaded = await loop.run_in_executor(None, models.acquire, setup.get('model', ''))
+    cosyvoice = loaded.cosyvoice
+    bistream = cosyvoice.__class__.__name__ != 'CosyVoice'
+    # NOTE extract uploaded prompt once as a temporary zero_shot spk, otherwise spk_id is a registered speaker
+    temporary = mode in ['zero_shot', 'cross_lingual', 'instruct2'] and 'prompt_wav' in setup
+    if temporary is True:
+        spk_id = 'ws_{}'.format(uuid.uuid4().hex)
+    # one encoder per connection, so opus frames continue one ogg stream
+    encoder = get_audio_encoder(setup.get('format', 'pcm'), cosyvoice.sample_rate)
+    segmenter = SentenceSegmenter(min_len=setup.get('min_sentence_len', 10))
+    sentence_queue, text_queue, pending = asyncio.Queue(), None, []
+
+    async def receive_text():
+        """Put every sentence into sentence_queue, a text piece queue for bistream once its first piece arrives, a str otherwise."""
+        nonlocal text_queue, pending
+        try:
+            while True:
+                message = await websocket.receive_json()
+                if message.get('event') == 'end':
+                    break
+                for piece, end_of_sentence in segmenter.push(message.get('text', '')):
+                    if bistream is False:
+                        pending.append(piece)
+                        if end_of_sentence is True:
+                            sentence_queue.put_nowait(''.join(pending))
+                            pending = []
+                        continue
+                    if text_queue is None:
+                        text_queue = queue.Queue()
+                        sentence_queue.put_nowait(text_queue)
+                    text_queue.put(piece)
+                    if end_of_sentence is True:
+                        text_queue.put(None)
+                        text_queue = None
+        finally:
+            # end of text, or client disconnected
+            if text_queue is not None:
+                text_queue.put(None)
+            if len(pending) != 0:
+                sentence_queue.put_nowait(''.join(pending))
+            sentence_queue.put_nowait(None)
+
+    receive_task = asyncio.ensure_future(receive_text())
+    audio = None
+    try:
+        if temporary is True:
+            prompt_text = {'zero_shot': setup.get('prompt_text', ''), 'cross_lingual': '', 'instruct2': setup.get('instruct_text', '')}[mode]
+            await loop.run_in_executor(None, cosyvoice.add_zero_shot_spk, prompt_text, io.BytesIO(base64.b64decode(setup['prompt_wav'])), spk_id)
+        while True:
+            sentence = await sentence_queue.get()
+            if sentence is None:
+                break
+            audio = pool.submit(ws_job, cosyvoice, setup, spk_id, sentence, encode=partial(encode_audio, encoder=encoder, flush=False),
+                                deadline=setup.get('deadline'))
+            if audio is None:
+                await websocket.close(code=1013, reason='server busy, retry after {}s'.format(pool.retry_after))
+                return
+            async for tts_audio in audio:
+                await websocket.send_bytes(tts_audio)
+            audio = None
+        tts_audio = encoder.flush()
+        if len(tts_audio) != 0:
+            await websocket.send_bytes(tts_audio)
+        await receive_task
+        await websocket.send_json({'event': 'end'})
+        await websocket.close()
+    except WebSocketDisconnect:
+        logging.info('websocket disconnected')
+    except Exception as e:
+        logging.exception('websocket tts failed')
+        await websocket.send_json({'event': 'error', 'message': str(e)})
+        await websocket.close()
+    finally:
+        receive_task.cancel()
+        if audio is not None:
+            await audio.aclose()
+        if temporary is True:
+            cosyvoice.frontend.spk2info.pop(spk_id, None)
+        models.release(loaded)
+
+
+@app.post("/speakers")
+async def register_speaker(prompt_wav: UploadFile = File(), prompt_text: str = Form(''), spk_id: str = Form(''), model: str = Form('')):
+    """Extract prompt features once, later zero_shot/cross_lingual/instruct2 requests of the same model pass spk_id instead of prompt_wav."""
+    if model not in models:
+        return JSONResponse(status_code=404, content={'detail': 'model {} not registered'.format(model)})
+    prompt_wav = await prompt_wav.read()
+    loaded = await load_model(model)
+    if spk_id != '' and spk_id not in loaded.speaker_store and spk_id in loaded.cosyvoice.list_available_spks():
+        return JSONResponse(status_code=409, content={'detail': 'can not overwrite builtin speaker {}'.format(spk_id)})
+    spk_id = await asyncio.get_running_loop().run_in_executor(None, loaded.speaker_store.add, prompt_text, io.BytesIO(prompt_wav), spk_id)
+    return loaded.speaker_store.get(spk_id)
+
+
+@app.get("/speakers")
+async def list_speakers(model: str = ''):
+    if model not in models:
+        return JSONResponse(status_code=404, content={'detail': 'model {} not registered'.format(model)})
+    return {'spk_ids': (await load_model(model)).speaker_store.list()}
+
+
+@app.get("/speakers/{spk_id}")
+async def get_speaker(spk_id: str, model: str = ''):
+    if model not in models:
+        return JSONResponse(status_code=404, content={'detail': 'model {} not registered'.format(model)})
+    loaded = await load_model(model)
+    if spk_id not in loaded.speaker_store:
+        return JSONResponse(status_code=404, content={'detail': 'speaker {} not registered'.format(spk_id)})
+    return loaded.speaker_store.get(spk_id)
+
+
+@app.delete("/speakers/{spk_id}")
+async def delete_speaker(spk_id: str, model: str = ''):
+    if model not in models:
+        return JSONResponse(status_code=404, content={'detail': 'model {} not registered'.format(model)})
+    loaded = await load_model(model)
+    if spk_id not in loaded.speaker_store:
+        return JSONResponse(status_code=404, content={'detail': 'speaker {} not registered'.format(spk_id)})
+    await asyncio.get_running_loop().run_in_executor(None, loaded.speaker_store.delete, spk_id)
+    return {'spk_id': spk_id}
+
+
+@app.get("/models")
+async def list_models():
+    """Registered models, whether they are resident and their memory."""
+    return {'models': models.list()}
+
+
+@app.get("/sessions")
+async def session_stats():
+    """Live tts sessions, bytes held per cache type and age of the oldest session of every resident model."""
+    return models.session_stats()
+
+
+@app.get("/scheduler")
+async def scheduler_stats():
+    """Queue depth, counters and wait time percentiles of every priority class."""
+    return pool.scheduler.stats()
+
+
+@app.get("/metrics")
+async def metrics():
+    """Per-stage latency histograms and scheduler state in prometheus text format."""
+    return PlainTextResponse(get_metrics().render() + pool.scheduler.render_metrics() + models.render_metrics(),
+                             media_type='text/plain; version=0.0.4')
+
+
+@app.get("/profiler")
+@app.post("/profiler")
+async def profiler(sample_rate: Optional[float] = Form(None)):
+    """Trace sample rate, which is changed at runtime if given, 0 stops tracing requests."""
+    profiler = get_profiler()
+    if profiler.enabled is False:
+        return JSONResponse(status_code=400, content={'detail': 'tracing is disabled, start server with --trace_dir'})
+    if sample_rate is not None:
+        if sample_rate < 0 or sample_rate > 1:
+            return JSONResponse(status_code=400, content={'detail': 'sample_rate should be in [0, 1]'})
+        profiler.sample_rate = sample_rate
+    return {'sample_rate': profiler.sample_rate, 'trace_dir': profiler.trace_dir}
+
+
+# NOTE priority is interactive or batch, deadline is seconds a request may wait in queue, a start-by time, not a completion time,
+# started synthesis runs to the end, default deadline is --interactive_deadline or --batch_deadline of its priority
 @app.get("/inference_sft")
 @app.post("/inference_sft")
-async def inference_sft(tts_text: str = Form(), spk_id: str = Form()):
-    model_output = cosyvoice.inference_sft(tts_text, spk_id)
-    return StreamingResponse(generate_data(model_output))
+async def inference_sft(tts_text: str = Form(), spk_id: str = Form(), format: str = Form('pcm'),
+                        priority: str = Form('interactive'), deadline: Optional[float] = Form(None), seed: Optional[int] = Form(None), model: str = Form('')):
+    error = check_params(format, priority, model)
+    if error is not None:
+        return error
+    loaded = await load_model(model)
+    return await pool.response(sft_job, model, tts_text, spk_id, seed,
+                               format=format, sample_rate=loaded.cosyvoice.sample_rate, priority=priority, deadline=deadline)
 
 
 @app.get("/inference_zero_shot")
 @app.post("/inference_zero_shot")
-async def inference_zero_shot(tts_text: str = Form(), prompt_text: str = Form(), prompt_wav: UploadFile = File()):
-    prompt_speech_16k = load_wav(prompt_wav.file, 16000)
-    model_output = cosyvoice.inference_zero_shot(tts_text, prompt_text, prompt_speech_16k)
-    return StreamingResponse(generate_data(model_output))
+async def inference_zero_shot(tts_text: str = Form(), prompt_text: str = Form(''), prompt_wav: UploadFile = File(None), spk_id: str = Form(''), format: str = Form('pcm'),
+                              priority: str = Form('interactive'), deadline: Optional[float] = Form(None), seed: Optional[int] = Form(None), model: str = Form('')):
+    error = check_params(format, priority, model)
+    if error is not None:
+        return error
+    loaded = await load_model(model)
+    error = check_prompt(loaded, prompt_wav, spk_id)
+    if error is not None:
+        return error
+    prompt_wav = await prompt_wav.read() if prompt_wav is not None else None
+    return await pool.response(zero_shot_job, model, tts_text, prompt_text, prompt_wav, spk_id, seed,
+                               format=format, sample_rate=loaded.cosyvoice.sample_rate, priority=priority, deadline=deadline)
 
 
 @app.get("/inference_cross_lingual")
 @app.post("/inference_cross_lingual")
-async def inference_cross_lingual(tts_text: str = Form(), prompt_wav: UploadFile = File()):
-    prompt_speech_16k = load_wav(prompt_wav.file, 16000)
-    model_output = cosyvoice.inference_cross_lingual(tts_text, prompt_speech_16k)
-    return StreamingResponse(generate_data(model_output))
+async def inference_cross_lingual(tts_text: str = Form(), prompt_wav: UploadFile = File(None), spk_id: str = Form(''), format: str = Form('pcm'),
+                                  priority: str = Form('interactive'), deadline: Optional[float] = Form(None), seed: Optional[int] = Form(None), model: str = Form('')):
+    error = check_params(format, priority, model)
+    if error is not None:
+        return error
+    loaded = await load_model(model)
+    error = check_prompt(loaded, prompt_wav, spk_id)
+    if error is not None:
+        return error
+    prompt_wav = await prompt_wav.read() if prompt_wav is not None else None
+    return await pool.response(cross_lingual_job, model, tts_text, prompt_wav, spk_id, seed,
+                               format=format, sample_rate=loaded.cosyvoice.sample_rate, priority=priority, deadline=deadline)
 
 
 @app.get("/inference_instruct")
 @app.post("/inference_instruct")
-async def inference_instruct(tts_text: str = Form(), spk_id: str = Form(), instruct_text: str = Form()):
-    model_output = cosyvoice.inference_instruct(tts_text, spk_id, instruct_text)
-    return StreamingResponse(generate_data(model_output))
+async def inference_instruct(tts_text: str = Form(), spk_id: str = Form(), instruct_text: str = Form(), format: str = Form('pcm'),
+                             priority: str = Form('interactive'), deadline: Optional[float] = Form(None), seed: Optional[int] = Form(None), model: str = Form('')):
+    error = check_params(format, priority, model)
+    if error is not None:
+        return error
+    loaded = await load_model(model)
+    return await pool.response(instruct_job, model, tts_text, spk_id, instruct_text, seed,
+                               format=format, sample_rate=loaded.cosyvoice.sample_rate, priority=priority, deadline=deadline)
 
 
 @app.get("/inference_instruct2")
 @app.post("/inference_instruct2")
-async def inference_instruct2(tts_text: str = Form(), instruct_text: str = Form(), prompt_wav: UploadFile = File()):
-    prompt_speech_16k = load_wav(prompt_wav.file, 16000)
-    model_output = cosyvoice.inference_instruct2(tts_text, instruct_text, prompt_speech_16k)
-    return StreamingResponse(generate_data(model_output))
+async def inference_instruct2(tts_text: str = Form(), instruct_text: str = Form(), prompt_wav: UploadFile = File(None), spk_id: str = Form(''), format: str = Form('pcm'),
+                              priority: str = Form('interactive'), deadline: Optional[float] = Form(None), seed: Optional[int] = Form(None), model: str = Form('')):
+    error = check_params(format, priority, model)
+    if error is not None:
+        return error
+    loaded = await load_model(model)
+    error = check_prompt(loaded, prompt_wav, spk_id)
+    if error is not None:
+        return error
+    prompt_wav = await prompt_wav.read() if prompt_wav is not None else None
+    return await pool.response(instruct2_job, model, tts_text, instruct_text, prompt_wav, spk_id, seed,
+                               format=format, sample_rate=loaded.cosyvoice.sample_rate, priority=priority, deadline=deadline)
 
 
 if __name__ == '__main__':
@@ -89,13 +516,99 @@ if __name__ == '__main__':
     parser.add_argument('--model_dir',
                         type=str,
                         default='iic/CosyVoice-300M',
-                        help='local path or modelscope repo id')
+                        help='local path or modelscope repo id of default model, loaded at startup')
+    parser.add_argument('--models',
+                        type=str,
+                        nargs='*',
+                        default=[],
+                        help='extra models as name=model_dir, routed by model parameter and loaded on first request')
+    parser.add_argument('--memory_budget_gb',
+                        type=float,
+                        default=0,
+                        help='memory of resident models, least recently used idle models are evicted, 0 means no limit')
+    parser.add_argument('--session_ttl',
+                        type=float,
+                        default=600,
+                        help='release tts sessions whose consumer is idle for more than session_ttl seconds without closing them, 0 means never')
+    parser.add_argument('--max_workers',
+                        type=int,
+                        default=4,
+                        help='number of concurrent synthesis threads')
+    parser.add_argument('--stub',
+                        action='store_true',
+                        help='serve StubCosyVoice, which yields silence at rtf 0.1, for load tests without pretrained models')
+    parser.add_argument('--num_procs',
+                        type=int,
+                        default=0,
+                        help='model worker processes per model, requests go to the least loaded one, 0 means synthesis in server process')
+    parser.add_argument('--threads_per_proc',
+                        type=int,
+                        default=0,
+                        help='torch threads of a model worker process, 0 means cores / num_procs')
+    parser.add_argument('--pin_cpus',
+                        action='store_true',
+                        help='pin every model worker process to its own cores')
+    parser.add_argument('--max_in_flight',
+                        type=int,
+                        default=8,
+                        help='max running and waiting requests, extra requests get 503')
+    parser.add_argument('--max_batch_workers',
+                        type=int,
+                        default=None,
+                        help='max synthesis threads of batch priority requests, default max_workers - 1')
+    parser.add_argument('--interactive_deadline',
+                        type=float,
+                        default=2.0,
+                        help='default seconds an interactive request may wait in queue')
+    parser.add_argument('--batch_deadline',
+                        type=float,
+                        default=60.0,
+                        help='default seconds a batch request may wait in queue')
+    parser.add_argument('--aging',
+                        type=float,
+                        default=None,
+                        help='seconds before its deadline a queued batch request is promoted to interactive, default interactive_deadline, 0 means strict priority')
+    parser.add_argument('--retry_after',
+                        type=int,
+                        default=1,
+                        help='Retry-After seconds of 503 response')
+    parser.add_argument('--spk_store',
+                        type=str,
+                        default='speakers.pt',
+                        help='file of registered speakers, empty means not persisted')
+    parser.add_argument('--cache_memory_mb',
+                        type=int,
+                        default=0,
+                        help='memory of synthesized result cache, only requests with seed are cached, 0 means disabled')
+    parser.add_argument('--cache_dir',
+                        type=str,
+                        default='',
+                        help='directory of on-disk result cache, empty means disabled')
+    parser.add_argument('--cache_disk_mb',
+                        type=int,
+                        default=10240,
+                        help='max size of on-disk result cache, least recently used results are evicted')
+    parser.add_argument('--disable_metrics',
+                        action='store_true',
+                        help='do not record per-stage metrics, /metrics only reports scheduler state')
+    parser.add_argument('--trace_dir',
+                        type=str,
+                        default='',
+                        help='write chrome trace of sampled requests to trace_dir/<request_id>.json, empty means tracing is disabled')
+    parser.add_argument('--trace_sample_rate',
+                        type=float,
+                        default=0.01,
+                        help='fraction of requests traced, changed at runtime by POST /profiler, spans in model worker processes are not traced')
+    parser.add_argument('--verbose',
+                        action='store_true',
+                        help='log every chunk and show tqdm progress, which costs a few ms per chunk')
     args = parser.parse_args()
-    try:
-        cosyvoice = CosyVoice(args.model_dir)
-    except Exception:
-        try:
-            cosyvoice = CosyVoice2(args.model_dir)
-        except Exception:
-            raise TypeError('no valid model_type!')
+    if args.disable_metrics is False:
+        set_metrics(PrometheusMetrics())
+    if args.trace_dir != '':
+        set_profiler(ChromeTraceProfiler(args.trace_sample_rate, outside_requests=False, trace_dir=args.trace_dir))
+    models = ServerModels(args, args.max_workers)
+    scheduler = Scheduler(args.max_workers, args.max_in_flight, deadlines={'interactive': args.interactive_deadline, 'batch': args.batch_deadline},
+                          max_batch_workers=args.max_batch_workers, aging=args.aging)
+    pool = InferencePool(scheduler, args.retry_after)
     uvicorn.run(app, host="0.0.0.0", port=args.port)
@@ -0,0 +1,126 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import io
+import json
+import time
+import base64
+import asyncio
+import argparse
+import logging
+import websockets
+import numpy as np
+import soundfile as sf
+
+
+async def send_text(websocket, start_time):
+    """Send tts_text in deltas of delta_len characters, like a chat llm output."""
+    for i in range(0, len(args.tts_text), args.delta_len):
+        await websocket.send(json.dumps({'text': args.tts_text[i: i + args.delta_len]}))
+        await asyncio.sleep(args.delta_interval)
+    await websocket.send(json.dumps({'event': 'end'}))
+    logging.info('finish sending text at {:.3f}s'.format(time.time() - start_time))
+
+
+async def main():
+    setup = {'mode': args.mode, 'format': args.format, 'spk_id': args.spk_id, 'prompt_text': args.prompt_text, 'instruct_text': args.instruct_text}
+    if args.mode in ['zero_shot', 'cross_lingual', 'instruct2']:
+        if args.zero_shot_spk_id != '':
+            # registered speaker, no prompt upload
+            setup['spk_id'] = args.zero_shot_spk_id
+        else:
+            setup['prompt_wav'] = base64.b64encode(open(args.prompt_wav, 'rb').read()).decode()
+    async with websockets.connect('ws://{}:{}/ws/tts'.format(args.host, args.port), max_size=None) as websocket:
+        await websocket.send(json.dumps(setup))
+        start_time = time.time()
+        send_task = asyncio.ensure_future(send_text(websocket, start_time))
+        tts_speech, opus, sample_rate = [], b'', args.sample_rate
+        async for message in websocket:
+            if isinstance(message, str):
+                message = json.loads(message)
+                if message['event'] == 'error':
+                    logging.error('server error {}'.format(message['message']))
+                break
+            if len(tts_speech) == 0 and len(opus) == 0:
+                logging.info('time to first audio {:.3f}s'.format(time.time() - start_time))
+            if args.format == 'pcm':
+                tts_speech.append(np.frombuffer(message, dtype=np.int16).astype(np.float32) / (2 ** 15))
+            else:
+                # opus frames are consecutive pieces of one ogg stream
+                opus += message
+        await send_task
+        logging.info('total time {:.3f}s'.format(time.time() - start_time))
+    if len(opus) != 0:
+        speech, sample_rate = sf.read(io.BytesIO(opus), dtype='float32')
+        tts_speech.append(speech)
+    if len(tts_speech) != 0:
+        tts_speech = np.concatenate(tts_speech)
+        logging.info('save {:.3f}s audio to {}'.format(len(tts_speech) / sample_rate, args.tts_wav))
+        sf.write(args.tts_wav, tts_speech, sample_rate)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host',
+                        type=str,
+                        default='0.0.0.0')
+    parser.add_argument('--port',
+                        type=int,
+                        default='50000')
+    parser.add_argument('--mode',
+                        default='sft',
+                        choices=['sft', 'zero_shot', 'cross_lingual', 'instruct', 'instruct2'],
+                        help='request mode')
+    parser.add_argument('--format',
+                        default='pcm',
+                        choices=['pcm', 'opus'],
+                        help='audio frame format')
+    parser.add_argument('--sample_rate',
+                        type=int,
+                        default=22050,
+                        help='server model sample rate, used for pcm format')
+    parser.add_argument('--delta_len',
+                        type=int,
+                        default=4,
+                        help='characters per text fragment')
+    parser.add_argument('--delta_interval',
+                        type=float,
+                        default=0.05,
+                        help='seconds between text fragments')
+    parser.add_argument('--tts_text',
+                        type=str,
+                        default='你好，我是通义千问语音合成大模型，请问有什么可以帮您的吗？')
+    parser.add_argument('--spk_id',
+                        type=str,
+                        default='中文女')
+    parser.add_argument('--zero_shot_spk_id',
+                        type=str,
+                        default='',
+                        help='registered speaker used instead of prompt_wav')
+    parser.add_argument('--prompt_text',
+                        type=str,
+                        default='希望你以后能够做的比我还好呦。')
+    parser.add_argument('--prompt_wav',
+                        type=str,
+                        default='../../../asset/zero_shot_prompt.wav')
+    parser.add_argument('--instruct_text',
+                        type=str,
+                        default='Theo \'Crimson\', is a fiery, passionate rebel leader. \
+                                 Fights with fervor for justice, but struggles with impulsiveness.')
+    parser.add_argument('--tts_wav',
+                        type=str,
+                        default='demo.wav')
+    args = parser.parse_args()
+    asyncio.run(main())
@@ -18,6 +18,7 @@ sys.path.append('{}/../../..'.format(ROOT_DIR))
 sys.path.append('{}/../../../third_party/Matcha-TTS'.format(ROOT_DIR))
 import logging
 import argparse
+import time
 import torchaudio
 import cosyvoice_pb2
 import cosyvoice_pb2_grpc
@@ -27,9 +28,30 @@ import numpy as np
 from cosyvoice.utils.file_utils import load_wav
 
 
+def stream_requests(request, start_time):
+    """Send setup without tts_text, then send tts_text in deltas of delta_len characters, like a chat llm output."""
+    tts_text = getattr(request, request.WhichOneof('RequestPayload')).tts_text
+    getattr(request, request.WhichOneof('RequestPayload')).tts_text = ''
+    yield cosyvoice_pb2.StreamRequest(setup=request)
+    for i in range(0, len(tts_text), args.delta_len):
+        time.sleep(args.delta_interval)
+        yield cosyvoice_pb2.StreamRequest(tts_text=tts_text[i: i + args.delta_len])
+    logging.info('finish sending text at {:.3f}s'.format(time.time() - start_time))
+
+
+def prompt_audio():
+    prompt_speech = load_wav(args.prompt_wav, 16000)
+    return (prompt_speech.numpy() * (2**15)).astype(np.int16).tobytes()
+
+
 def main():
     with grpc.insecure_channel("{}:{}".format(args.host, args.port)) as channel:
         stub = cosyvoice_pb2_grpc.CosyVoiceStub(channel)
+        if args.register is True:
+            speaker_info = stub.RegisterSpeaker(cosyvoice_pb2.RegisterSpeakerRequest(spk_id=args.zero_shot_spk_id, prompt_text=args.prompt_text,
+                                                                                     prompt_audio=prompt_audio(), model=args.model))
+            logging.info('register speaker {}'.format(speaker_info.spk_id))
+            args.zero_shot_spk_id = speaker_info.spk_id
         request = cosyvoice_pb2.Request()
         if args.mode == 'sft':
             logging.info('send sft request')
@@ -42,16 +64,30 @@ def main():
             zero_shot_request = cosyvoice_pb2.zeroshotRequest()
             zero_shot_request.tts_text = args.tts_text
             zero_shot_request.prompt_text = args.prompt_text
-            prompt_speech = load_wav(args.prompt_wav, 16000)
-            zero_shot_request.prompt_audio = (prompt_speech.numpy() * (2**15)).astype(np.int16).tobytes()
+            if args.zero_shot_spk_id != '':
+                zero_shot_request.spk_id = args.zero_shot_spk_id
+            else:
+                zero_shot_request.prompt_audio = prompt_audio()
             request.zero_shot_request.CopyFrom(zero_shot_request)
         elif args.mode == 'cross_lingual':
             logging.info('send cross_lingual request')
             cross_lingual_request = cosyvoice_pb2.crosslingualRequest()
             cross_lingual_request.tts_text = args.tts_text
-            prompt_speech = load_wav(args.prompt_wav, 16000)
-            cross_lingual_request.prompt_audio = (prompt_speech.numpy() * (2**15)).astype(np.int16).tobytes()
+            if args.zero_shot_spk_id != '':
+                cross_lingual_request.spk_id = args.zero_shot_spk_id
+            else:
+                cross_lingual_request.prompt_audio = prompt_audio()
             request.cross_lingual_request.CopyFrom(cross_lingual_request)
+        elif args.mode == 'instruct2':
+            logging.info('send instruct2 request')
+            instruct2_request = cosyvoice_pb2.instruct2Request()
+            instruct2_request.tts_text = args.tts_text
+            instruct2_request.instruct_text = args.instruct_text
+            if args.zero_shot_spk_id != '':
+                instruct2_request.spk_id = args.zero_shot_spk_id
+            else:
+                instruct2_request.prompt_audio = prompt_audio()
+            request.instruct2_request.CopyFrom(instruct2_request)
         else:
             logging.info('send instruct request')
             instruct_request = cosyvoice_pb2.instructRequest()
@@ -59,11 +95,30 @@ def main():
             instruct_request.spk_id = args.spk_id
             instruct_request.instruct_text = args.instruct_text
             request.instruct_request.CopyFrom(instruct_request)
+        request.stream = args.stream
+        request.format = args.format
+        request.priority = args.priority
+        request.model = args.model
+        if args.seed is not None:
+            request.seed = args.seed
 
-        response = stub.Inference(request)
+        start_time = time.time()
+        if args.bistream is True:
+            response = stub.StreamInference(stream_requests(request, start_time), timeout=args.timeout)
+        else:
+            response = stub.Inference(request, timeout=args.timeout)
         tts_audio = b''
         for r in response:
+            if tts_audio == b'':
+                logging.info('first audio latency {:.3f}s'.format(time.time() - start_time))
             tts_audio += r.tts_audio
+        logging.info('total latency {:.3f}s'.format(time.time() - start_time))
+        if args.format != 'pcm':
+            # encoded stream is saved as is, e.g. --format mp3 --tts_wav demo.mp3
+            logging.info('save {} response to {}'.format(args.format, args.tts_wav))
+            with open(args.tts_wav, 'wb') as f:
+                f.write(tts_audio)
+            return
         tts_speech = torch.from_numpy(np.array(np.frombuffer(tts_audio, dtype=np.int16))).unsqueeze(dim=0)
         logging.info('save response to {}'.format(args.tts_wav))
         torchaudio.save(args.tts_wav, tts_speech, target_sr)
@@ -80,14 +135,55 @@ if __name__ == "__main__":
                         default='50000')
     parser.add_argument('--mode',
                         default='sft',
-                        choices=['sft', 'zero_shot', 'cross_lingual', 'instruct'],
+                        choices=['sft', 'zero_shot', 'cross_lingual', 'instruct', 'instruct2'],
                         help='request mode')
+    parser.add_argument('--format',
+                        default='pcm',
+                        choices=['pcm', 'wav', 'mp3', 'opus', 'mulaw'],
+                        help='response audio format')
+    parser.add_argument('--model',
+                        type=str,
+                        default='',
+                        help='registered model name of server, empty means default model')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=None,
+                        help='sampling seed, seeded requests are reproducible and may be served from server result cache')
+    parser.add_argument('--priority',
+                        default='',
+                        choices=['', 'interactive', 'batch'],
+                        help='request priority, empty means interactive if stream else batch')
+    parser.add_argument('--stream',
+                        action='store_true',
+                        help='streaming output')
+    parser.add_argument('--bistream',
+                        action='store_true',
+                        help='send tts_text in deltas through StreamInference, only for CosyVoice2/3')
+    parser.add_argument('--delta_len',
+                        type=int,
+                        default=4,
+                        help='characters per tts_text delta in bistream mode')
+    parser.add_argument('--delta_interval',
+                        type=float,
+                        default=0.05,
+                        help='seconds between tts_text deltas in bistream mode')
+    parser.add_argument('--timeout',
+                        type=float,
+                        default=None,
+                        help='call deadline in seconds, server stops synthesis when exceeded')
     parser.add_argument('--tts_text',
                         type=str,
                         default='你好，我是通义千问语音合成大模型，请问有什么可以帮您的吗？')
     parser.add_argument('--spk_id',
                         type=str,
                         default='中文女')
+    parser.add_argument('--zero_shot_spk_id',
+                        type=str,
+                        default='',
+                        help='registered speaker used instead of prompt_wav')
+    parser.add_argument('--register',
+                        action='store_true',
+                        help='register prompt_wav as zero_shot_spk_id first, a new id is generated if it is empty')
     parser.add_argument('--prompt_text',
                         type=str,
                         default='希望你以后能够做的比我还好呦。')
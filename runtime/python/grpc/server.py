@@ -13,71 +13,313 @@
 # limitations under the License.
 import os
 import sys
-from concurrent import futures
+import io
+import json
+import uuid
 import argparse
+import asyncio
+import queue
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
 import cosyvoice_pb2
 import cosyvoice_pb2_grpc
 import logging
 logging.getLogger('matplotlib').setLevel(logging.WARNING)
 import grpc
-import torch
 import numpy as np
+import soundfile as sf
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append('{}/../../..'.format(ROOT_DIR))
 sys.path.append('{}/../../../third_party/Matcha-TTS'.format(ROOT_DIR))
-from cosyvoice.cli.cosyvoice import CosyVoice, CosyVoice2
+from cosyvoice.cli.model import CancelScope, SessionCancelled
+from cosyvoice.cli.model_manager import ServerModels
+from cosyvoice.cli.scheduler import Scheduler, PRIORITIES, DeadlineExceeded
+from cosyvoice.utils.audio_encoder import AUDIO_ENCODERS, get_audio_encoder, encode_audio
+from cosyvoice.utils.metrics import PrometheusMetrics, get_metrics, set_metrics
+from cosyvoice.utils.profiler import ChromeTraceProfiler, get_profiler, set_profiler
 
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s %(levelname)s %(message)s')
 
 
+def pcm_to_wav(prompt_audio):
+    """Wrap 16k int16 pcm prompt_audio into in-memory wav, as frontend loads prompt wav by itself."""
+    if len(prompt_audio) == 0:
+        # registered speaker has no prompt audio
+        return ''
+    prompt_wav = io.BytesIO()
+    sf.write(prompt_wav, np.frombuffer(prompt_audio, dtype=np.int16), 16000, format='WAV')
+    return prompt_wav
+
+
 class CosyVoiceServiceImpl(cosyvoice_pb2_grpc.CosyVoiceServicer):
     def __init__(self, args):
-        try:
-            self.cosyvoice = CosyVoice(args.model_dir, trt_concurrent=args.max_conc)
-        except Exception:
-            try:
-                self.cosyvoice = CosyVoice2(args.model_dir, trt_concurrent=args.max_conc)
-            except Exception:
-                raise TypeError('no valid model_type!')
+        self.args = args
+        self.models = ServerModels(args, args.max_conc)
+        # NOTE synthesis is blocking, run it in scheduler worker threads and keep event loop for grpc io
+        self.scheduler = Scheduler(args.max_conc, args.max_in_flight, deadlines={'interactive': args.interactive_deadline, 'batch': args.batch_deadline},
+                                   max_batch_workers=args.max_batch_workers, aging=args.aging)
         logging.info('grpc service initialized')
 
-    def Inference(self, request, context):
+    async def load_model(self, context, model):
+        """Load model in executor if it is not resident, and return it for request checks, job acquires it again in worker thread."""
+        if model not in self.models:
+            await context.abort(grpc.StatusCode.NOT_FOUND, 'model {} not registered, choose from {}'.format(model, list(self.models.model_dirs.keys())))
+        loaded = await asyncio.get_running_loop().run_in_executor(None, self.models.acquire, model)
+        self.models.release(loaded)
+        return loaded
+
+    def model_output(self, loaded, request, tts_text):
+        """Map request to cosyvoice inference through result cache, tts_text is str or text generator for bistream inference."""
+        result_cache = loaded.result_cache
+        stream = request.stream
+        seed = request.seed if request.HasField('seed') else None
         if request.HasField('sft_request'):
             logging.info('get sft inference request')
-            model_output = self.cosyvoice.inference_sft(request.sft_request.tts_text, request.sft_request.spk_id)
+            return result_cache.inference('sft', tts_text, request.sft_request.spk_id, stream=stream, seed=seed)
         elif request.HasField('zero_shot_request'):
             logging.info('get zero_shot inference request')
-            prompt_speech_16k = torch.from_numpy(np.array(np.frombuffer(request.zero_shot_request.prompt_audio, dtype=np.int16))).unsqueeze(dim=0)
-            prompt_speech_16k = prompt_speech_16k.float() / (2**15)
-            model_output = self.cosyvoice.inference_zero_shot(request.zero_shot_request.tts_text,
-                                                              request.zero_shot_request.prompt_text,
-                                                              prompt_speech_16k)
+            return result_cache.inference('zero_shot', tts_text, request.zero_shot_request.prompt_text, pcm_to_wav(request.zero_shot_request.prompt_audio),
+                                          zero_shot_spk_id=request.zero_shot_request.spk_id, stream=stream, seed=seed)
         elif request.HasField('cross_lingual_request'):
             logging.info('get cross_lingual inference request')
-            prompt_speech_16k = torch.from_numpy(np.array(np.frombuffer(request.cross_lingual_request.prompt_audio, dtype=np.int16))).unsqueeze(dim=0)
-            prompt_speech_16k = prompt_speech_16k.float() / (2**15)
-            model_output = self.cosyvoice.inference_cross_lingual(request.cross_lingual_request.tts_text, prompt_speech_16k)
+            return result_cache.inference('cross_lingual', tts_text, pcm_to_wav(request.cross_lingual_request.prompt_audio),
+                                          zero_shot_spk_id=request.cross_lingual_request.spk_id, stream=stream, seed=seed)
+        elif request.HasField('instruct2_request'):
+            logging.info('get instruct2 inference request')
+            return result_cache.inference('instruct2', tts_text, request.instruct2_request.instruct_text, pcm_to_wav(request.instruct2_request.prompt_audio),
+                                          zero_shot_spk_id=request.instruct2_request.spk_id, stream=stream, seed=seed)
         else:
             logging.info('get instruct inference request')
-            model_output = self.cosyvoice.inference_instruct(request.instruct_request.tts_text,
-                                                             request.instruct_request.spk_id,
-                                                             request.instruct_request.instruct_text)
+            return result_cache.inference('instruct', tts_text, request.instruct_request.spk_id, request.instruct_request.instruct_text, stream=stream, seed=seed)
+
+    def check_request(self, loaded, request):
+        mode = request.WhichOneof('RequestPayload')
+        if mode is None:
+            return 'empty request'
+        if mode == 'instruct_request' and loaded.cosyvoice.__class__.__name__ != 'CosyVoice':
+            return 'instruct is only implemented for CosyVoice, use instruct2 instead'
+        if mode == 'instruct2_request' and loaded.cosyvoice.__class__.__name__ == 'CosyVoice':
+            return 'instruct2 is not implemented for CosyVoice, use instruct instead'
+        if mode in ['zero_shot_request', 'cross_lingual_request', 'instruct2_request']:
+            spk_id, prompt_audio = getattr(request, mode).spk_id, getattr(request, mode).prompt_audio
+            if spk_id != '' and spk_id not in loaded.speaker_store:
+                return 'speaker {} not registered'.format(spk_id)
+            if spk_id == '' and len(prompt_audio) == 0:
+                return 'prompt_audio or spk_id is required'
+        if request.priority != '' and request.priority not in PRIORITIES:
+            return 'unsupported priority {}, choose from {}'.format(request.priority, list(PRIORITIES.keys()))
+        if request.format != '' and request.format not in AUDIO_ENCODERS:
+            return 'unsupported format {}, choose from {}'.format(request.format, list(AUDIO_ENCODERS.keys()))
+        return None
+
+    async def stream_response(self, context, loaded, request, tts_text):
+        """Run synthesis in worker thread, and yield its chunks without blocking event loop.
+
+        NOTE if call is cancelled or its deadline passes, tts sessions of the request are cancelled through a CancelScope, which stops llm job
+            at once and skips flow and hift, also for stream=False and for bistream llm still decoding, chunks of model worker processes are
+            only closed at next chunk. queued request waits at most until rpc deadline or default deadline of its priority, started one until
+            rpc deadline.
+        """
+        loop = asyncio.get_running_loop()
+        chunk_queue, cancel, scope = asyncio.Queue(), threading.Event(), CancelScope()
+
+        def worker():
+            with get_profiler().request(uuid.uuid4().hex), scope.bind():
+                try:
+                    model_output = self.models.inference(request.model, lambda m: self.model_output(m, request, tts_text))
+                    encoder = get_audio_encoder(request.format or 'pcm', loaded.cosyvoice.sample_rate)
+                    try:
+                        for tts_audio in encode_audio(model_output, encoder):
+                            if cancel.is_set():
+                                logging.info('inference cancelled')
+                                break
+                            loop.call_soon_threadsafe(chunk_queue.put_nowait, (tts_audio, None))
+                    finally:
+                        model_output.close()
+                except SessionCancelled:
+                    logging.info('inference cancelled')
+                except Exception as e:
+                    logging.exception('inference failed')
+                    loop.call_soon_threadsafe(chunk_queue.put_nowait, (None, e))
+                finally:
+                    loop.call_soon_threadsafe(chunk_queue.put_nowait, (None, None))
+
+        def on_shed():
+            loop.call_soon_threadsafe(chunk_queue.put_nowait, (None, DeadlineExceeded('request is not started before its deadline')))
+
+        def on_expire():
+            scope.cancel()
+            chunk_queue.put_nowait((None, DeadlineExceeded('request is not finished before its deadline')))
 
+        priority = request.priority if request.priority != '' else ('interactive' if request.stream is True else 'batch')
+        remaining = context.time_remaining()
+        deadline = min(remaining, self.scheduler.deadlines[priority]) if remaining is not None else None
+        scheduled = self.scheduler.submit(worker, priority, deadline, on_shed)
+        if scheduled is None:
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, 'server busy, {} requests in flight'.format(self.scheduler.in_flight))
+        expire = loop.call_later(remaining, on_expire) if remaining is not None else None
         logging.info('send inference response')
-        for i in model_output:
-            response = cosyvoice_pb2.Response()
-            response.tts_audio = (i['tts_speech'].numpy() * (2 ** 15)).astype(np.int16).tobytes()
+        try:
+            while True:
+                tts_audio, e = await chunk_queue.get()
+                if e is not None:
+                    await context.abort(grpc.StatusCode.DEADLINE_EXCEEDED if isinstance(e, DeadlineExceeded) else grpc.StatusCode.INTERNAL, str(e))
+                if tts_audio is None:
+                    break
+                response = cosyvoice_pb2.Response()
+                response.tts_audio = tts_audio
+                yield response
+        finally:
+            if expire is not None:
+                expire.cancel()
+            cancel.set()
+            scope.cancel()
+            self.scheduler.cancel(scheduled)
+
+    async def Inference(self, request, context):
+        loaded = await self.load_model(context, request.model)
+        error = self.check_request(loaded, request)
+        if error is not None:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, error)
+        tts_text = getattr(request, request.WhichOneof('RequestPayload')).tts_text
+        async for response in self.stream_response(context, loaded, request, tts_text):
             yield response
 
+    async def StreamInference(self, request_iterator, context):
+        setup = await request_iterator.__anext__()
+        if not setup.HasField('setup'):
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, 'first message should be setup')
+        request = setup.setup
+        loaded = await self.load_model(context, request.model)
+        error = self.check_request(loaded, request)
+        if error is None and loaded.cosyvoice.__class__.__name__ == 'CosyVoice':
+            error = 'streaming input text is only implemented for CosyVoice2/3'
+        if error is not None:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, error)
+
+        # NOTE text_queue is read by llm job thread through text_generator, None means end of text
+        text_queue = queue.Queue()
+        tts_text = getattr(request, request.WhichOneof('RequestPayload')).tts_text
+        if tts_text != '':
+            text_queue.put(tts_text)
+
+        def text_generator():
+            while True:
+                text = text_queue.get()
+                if text is None:
+                    break
+                yield text
+
+        async def read_text():
+            try:
+                async for i in request_iterator:
+                    text_queue.put(i.tts_text)
+            finally:
+                text_queue.put(None)
+
+        read_task = asyncio.ensure_future(read_text())
+        try:
+            async for response in self.stream_response(context, loaded, request, text_generator()):
+                yield response
+        finally:
+            read_task.cancel()
+            text_queue.put(None)
+
+    def speaker_info(self, loaded, spk_id):
+        return cosyvoice_pb2.SpeakerInfo(**loaded.speaker_store.get(spk_id))
+
+    async def RegisterSpeaker(self, request, context):
+        loaded = await self.load_model(context, request.model)
+        if request.spk_id != '' and request.spk_id not in loaded.speaker_store and request.spk_id in loaded.cosyvoice.list_available_spks():
+            await context.abort(grpc.StatusCode.ALREADY_EXISTS, 'can not overwrite builtin speaker {}'.format(request.spk_id))
+        if len(request.prompt_audio) == 0:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, 'prompt_audio is required')
+        logging.info('get register speaker request')
+        spk_id = await asyncio.get_running_loop().run_in_executor(None, loaded.speaker_store.add, request.prompt_text,
+                                                                  pcm_to_wav(request.prompt_audio), request.spk_id)
+        return self.speaker_info(loaded, spk_id)
 
-def main():
-    grpcServer = grpc.server(futures.ThreadPoolExecutor(max_workers=args.max_conc), maximum_concurrent_rpcs=args.max_conc)
-    cosyvoice_pb2_grpc.add_CosyVoiceServicer_to_server(CosyVoiceServiceImpl(args), grpcServer)
+    async def GetSpeaker(self, request, context):
+        loaded = await self.load_model(context, request.model)
+        if request.spk_id not in loaded.speaker_store:
+            await context.abort(grpc.StatusCode.NOT_FOUND, 'speaker {} not registered'.format(request.spk_id))
+        return self.speaker_info(loaded, request.spk_id)
+
+    async def DeleteSpeaker(self, request, context):
+        loaded = await self.load_model(context, request.model)
+        if request.spk_id not in loaded.speaker_store:
+            await context.abort(grpc.StatusCode.NOT_FOUND, 'speaker {} not registered'.format(request.spk_id))
+        speaker_info = self.speaker_info(loaded, request.spk_id)
+        await asyncio.get_running_loop().run_in_executor(None, loaded.speaker_store.delete, request.spk_id)
+        return speaker_info
+
+
+def serve_metrics(port, service):
+    """Serve /metrics over plain http in a daemon thread, as prometheus can not scrape grpc.
+
+    POST /profiler?sample_rate=<rate> changes trace sample rate at runtime.
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != '/profiler':
+                self.send_error(404)
+                return
+            profiler = get_profiler()
+            sample_rate = parse_qs(url.query).get('sample_rate', [''])[0]
+            if profiler.enabled is False:
+                self.send_error(400, 'tracing is disabled, start server with --trace_dir')
+                return
+            try:
+                sample_rate = float(sample_rate)
+                assert 0 <= sample_rate <= 1
+            except (ValueError, AssertionError):
+                self.send_error(400, 'sample_rate should be in [0, 1]')
+                return
+            profiler.sample_rate = sample_rate
+            body = json.dumps({'sample_rate': profiler.sample_rate, 'trace_dir': profiler.trace_dir}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = (get_metrics().render() + service.scheduler.render_metrics() + service.models.render_metrics()).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+    server = ThreadingHTTPServer(('0.0.0.0', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logging.info("metrics listening on 0.0.0.0:{}/metrics".format(port))
+    return server
+
+
+async def main():
+    if args.disable_metrics is False:
+        set_metrics(PrometheusMetrics())
+    if args.trace_dir != '':
+        set_profiler(ChromeTraceProfiler(args.trace_sample_rate, outside_requests=False, trace_dir=args.trace_dir))
+    # NOTE admission is done by scheduler with priority and deadline, not by maximum_concurrent_rpcs
+    grpcServer = grpc.aio.server()
+    service = CosyVoiceServiceImpl(args)
+    cosyvoice_pb2_grpc.add_CosyVoiceServicer_to_server(service, grpcServer)
     grpcServer.add_insecure_port('0.0.0.0:{}'.format(args.port))
-    grpcServer.start()
+    await grpcServer.start()
     logging.info("server listening on 0.0.0.0:{}".format(args.port))
-    grpcServer.wait_for_termination()
+    if args.metrics_port != 0:
+        serve_metrics(args.metrics_port, service)
+    await grpcServer.wait_for_termination()
 
 
 if __name__ == '__main__':
@@ -88,9 +330,90 @@ if __name__ == '__main__':
     parser.add_argument('--max_conc',
                         type=int,
                         default=4)
+    parser.add_argument('--stub',
+                        action='store_true',
+                        help='serve StubCosyVoice, which yields silence at rtf 0.1, for load tests without pretrained models')
+    parser.add_argument('--num_procs',
+                        type=int,
+                        default=0,
+                        help='model worker processes per model, requests go to the least loaded one, 0 means synthesis in server process')
+    parser.add_argument('--threads_per_proc',
+                        type=int,
+                        default=0,
+                        help='torch threads of a model worker process, 0 means cores / num_procs')
+    parser.add_argument('--pin_cpus',
+                        action='store_true',
+                        help='pin every model worker process to its own cores')
+    parser.add_argument('--max_in_flight',
+                        type=int,
+                        default=8,
+                        help='max running and waiting requests, extra requests get RESOURCE_EXHAUSTED')
+    parser.add_argument('--max_batch_workers',
+                        type=int,
+                        default=None,
+                        help='max synthesis threads of batch priority requests, default max_conc - 1')
+    parser.add_argument('--interactive_deadline',
+                        type=float,
+                        default=2.0,
+                        help='default seconds an interactive request may wait in queue')
+    parser.add_argument('--batch_deadline',
+                        type=float,
+                        default=60.0,
+                        help='default seconds a batch request may wait in queue')
+    parser.add_argument('--aging',
+                        type=float,
+                        default=None,
+                        help='seconds before its deadline a queued batch request is promoted to interactive, default interactive_deadline, 0 means strict priority')
     parser.add_argument('--model_dir',
                         type=str,
                         default='iic/CosyVoice-300M',
-                        help='local path or modelscope repo id')
+                        help='local path or modelscope repo id of default model, loaded at startup')
+    parser.add_argument('--models',
+                        type=str,
+                        nargs='*',
+                        default=[],
+                        help='extra models as name=model_dir, routed by model field of request and loaded on first request')
+    parser.add_argument('--memory_budget_gb',
+                        type=float,
+                        default=0,
+                        help='memory of resident models, least recently used idle models are evicted, 0 means no limit')
+    parser.add_argument('--session_ttl',
+                        type=float,
+                        default=600,
+                        help='release tts sessions whose consumer is idle for more than session_ttl seconds without closing them, 0 means never')
+    parser.add_argument('--spk_store',
+                        type=str,
+                        default='speakers.pt',
+                        help='file of registered speakers, empty means not persisted')
+    parser.add_argument('--cache_memory_mb',
+                        type=int,
+                        default=0,
+                        help='memory of synthesized result cache, only requests with seed are cached, 0 means disabled')
+    parser.add_argument('--cache_dir',
+                        type=str,
+                        default='',
+                        help='directory of on-disk result cache, empty means disabled')
+    parser.add_argument('--cache_disk_mb',
+                        type=int,
+                        default=10240,
+                        help='max size of on-disk result cache, least recently used results are evicted')
+    parser.add_argument('--metrics_port',
+                        type=int,
+                        default=50001,
+                        help='http port of prometheus /metrics, 0 means disabled')
+    parser.add_argument('--disable_metrics',
+                        action='store_true',
+                        help='do not record per-stage metrics, /metrics only reports scheduler state')
+    parser.add_argument('--trace_dir',
+                        type=str,
+                        default='',
+                        help='write chrome trace of sampled requests to trace_dir/<request_id>.json, empty means tracing is disabled')
+    parser.add_argument('--trace_sample_rate',
+                        type=float,
+                        default=0.01,
+                        help='fraction of requests traced, changed at runtime by POST /profiler of metrics port, spans in model worker processes are not traced')
+    parser.add_argument('--verbose',
+                        action='store_true',
+                        help='log every chunk and show tqdm progress, which costs a few ms per chunk')
     args = parser.parse_args()
-    main()
+    asyncio.run(main())
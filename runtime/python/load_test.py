@@ -0,0 +1,314 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Asyncio load generator of the fastapi and grpc servers, replays a manifest at a target concurrency or request rate.
+
+summary follows runtime/triton_trtllm/client_grpc.py, with time to first byte, inter chunk gap, total latency, rtf and error rates.
+"""
+import os
+import sys
+import time
+import random
+import socket
+import asyncio
+import argparse
+import logging
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import numpy as np
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/grpc'.format(ROOT_DIR))
+
+
+def load_manifest(manifest_path):
+    """Manifest lines are utt|prompt_text|prompt_wav|tts_text as in triton client, relative prompt_wav is relative to manifest."""
+    items = []
+    with open(manifest_path, 'r') as f:
+        for line in f:
+            assert len(line.strip().split('|')) == 4
+            utt, prompt_text, prompt_wav, tts_text = line.strip().split('|')
+            if not os.path.isabs(prompt_wav):
+                prompt_wav = os.path.join(os.path.dirname(manifest_path), prompt_wav)
+            items.append({'utt': utt, 'prompt_text': prompt_text, 'prompt_wav': prompt_wav, 'tts_text': tts_text})
+    return items
+
+
+def http_request(item, prompt_wav):
+    """Blocking streaming http request, run in executor threads, return status, chunk arrival times and audio bytes."""
+    url = "http://{}:{}/inference_{}".format(args.host, args.port, args.mode)
+    payload = {'tts_text': item['tts_text'], 'priority': args.priority, 'format': 'pcm', 'model': args.model}
+    files = None
+    if args.mode in ['sft', 'instruct']:
+        payload['spk_id'] = args.spk_id
+    if args.mode in ['zero_shot']:
+        payload['prompt_text'] = item['prompt_text']
+    if args.mode in ['instruct', 'instruct2']:
+        payload['instruct_text'] = args.instruct_text
+    if args.mode in ['zero_shot', 'cross_lingual', 'instruct2']:
+        files = [('prompt_wav', ('prompt_wav', prompt_wav, 'application/octet-stream'))]
+    start_time = time.time()
+    chunk_times, audio_bytes = [], 0
+    try:
+        response = requests.request("POST", url, data=payload, files=files, stream=True, timeout=args.timeout)
+        if response.status_code != 200:
+            return {'status': 'busy' if response.status_code in [429, 503] else 'error', 'code': response.status_code}
+        for r in response.iter_content(chunk_size=None):
+            chunk_times.append(time.time() - start_time)
+            audio_bytes += len(r)
+    except requests.RequestException as e:
+        logging.warning('request {} failed {}'.format(item['utt'], e))
+        return {'status': 'error', 'code': -1}
+    return {'status': 'ok', 'chunk_times': chunk_times, 'total_time': time.time() - start_time, 'audio_len': audio_bytes / 2 / args.sample_rate}
+
+
+async def grpc_request(stub, item, prompt_audio):
+    import grpc
+    import cosyvoice_pb2
+    request = cosyvoice_pb2.Request(stream=args.stream, format='pcm', priority=args.priority, model=args.model)
+    if args.mode == 'sft':
+        request.sft_request.CopyFrom(cosyvoice_pb2.sftRequest(tts_text=item['tts_text'], spk_id=args.spk_id))
+    elif args.mode == 'zero_shot':
+        request.zero_shot_request.CopyFrom(cosyvoice_pb2.zeroshotRequest(tts_text=item['tts_text'], prompt_text=item['prompt_text'], prompt_audio=prompt_audio))
+    elif args.mode == 'cross_lingual':
+        request.cross_lingual_request.CopyFrom(cosyvoice_pb2.crosslingualRequest(tts_text=item['tts_text'], prompt_audio=prompt_audio))
+    elif args.mode == 'instruct2':
+        request.instruct2_request.CopyFrom(cosyvoice_pb2.instruct2Request(tts_text=item['tts_text'], instruct_text=args.instruct_text, prompt_audio=prompt_audio))
+    else:
+        request.instruct_request.CopyFrom(cosyvoice_pb2.instructRequest(tts_text=item['tts_text'], spk_id=args.spk_id, instruct_text=args.instruct_text))
+    start_time = time.time()
+    chunk_times, audio_bytes = [], 0
+    try:
+        async for response in stub.Inference(request, timeout=args.timeout):
+            chunk_times.append(time.time() - start_time)
+            audio_bytes += len(response.tts_audio)
+    except grpc.aio.AioRpcError as e:
+        busy = e.code() in [grpc.StatusCode.RESOURCE_EXHAUSTED, grpc.StatusCode.DEADLINE_EXCEEDED]
+        if busy is False:
+            logging.warning('request {} failed {} {}'.format(item['utt'], e.code(), e.details()))
+        return {'status': 'busy' if busy is True else 'error', 'code': e.code().name}
+    return {'status': 'ok', 'chunk_times': chunk_times, 'total_time': time.time() - start_time, 'audio_len': audio_bytes / 2 / args.sample_rate}
+
+
+def prompt_inputs(items):
+    """Read every distinct prompt once, raw wav bytes for http, 16k int16 pcm for grpc."""
+    prompts = {}
+    if args.mode not in ['zero_shot', 'cross_lingual', 'instruct2']:
+        return prompts
+    for item in items:
+        if item['prompt_wav'] in prompts:
+            continue
+        if args.protocol == 'http':
+            with open(item['prompt_wav'], 'rb') as f:
+                prompts[item['prompt_wav']] = f.read()
+        else:
+            from cosyvoice.utils.file_utils import load_wav
+            prompts[item['prompt_wav']] = (load_wav(item['prompt_wav'], 16000).numpy() * (2 ** 15)).astype(np.int16).tobytes()
+    return prompts
+
+
+async def run(items):
+    """Closed loop of concurrency clients if request_rate is 0, else open loop with poisson arrivals at request_rate."""
+    loop = asyncio.get_running_loop()
+    # NOTE blocking http requests run in threads, one per in flight request
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=max(args.concurrency, 256)))
+    prompts = prompt_inputs(items)
+    stub = None
+    if args.protocol == 'grpc':
+        import grpc
+        import cosyvoice_pb2_grpc
+        stub = cosyvoice_pb2_grpc.CosyVoiceStub(grpc.aio.insecure_channel('{}:{}'.format(args.host, args.port)))
+    semaphore = asyncio.Semaphore(args.concurrency) if args.request_rate == 0 else None
+
+    async def send(i):
+        item = items[i % len(items)]
+        if semaphore is not None:
+            await semaphore.acquire()
+        try:
+            if args.protocol == 'http':
+                return await loop.run_in_executor(None, http_request, item, prompts.get(item['prompt_wav']))
+            return await grpc_request(stub, item, prompts.get(item['prompt_wav'], b''))
+        finally:
+            if semaphore is not None:
+                semaphore.release()
+
+    tasks = []
+    for i in range(args.num_requests):
+        tasks.append(asyncio.ensure_future(send(i)))
+        if args.request_rate != 0:
+            await asyncio.sleep(random.expovariate(args.request_rate))
+    return await asyncio.gather(*tasks)
+
+
+def latency_lines(name, values, scale=1000.0, unit='_ms'):
+    if len(values) == 0:
+        return 'No {} data collected.\n'.format(name)
+    s = '{}_variance: {:.2f}\n'.format(name, np.var(values, dtype=np.float64) * scale)
+    for q in [50, 90, 95, 99]:
+        s += '{}_{}_percentile{}: {:.2f}\n'.format(name, q, unit, np.percentile(values, q) * scale)
+    s += 'average_{}{}: {:.2f}\n'.format(name, unit, np.mean(values) * scale)
+    return s
+
+
+def summary(results, elapsed):
+    success = [i for i in results if i['status'] == 'ok']
+    busy = [i for i in results if i['status'] == 'busy']
+    total_duration = sum([i['audio_len'] for i in success])
+    ttfb = [i['chunk_times'][0] for i in success if len(i['chunk_times']) != 0]
+    gaps = [b - a for i in success for a, b in zip(i['chunk_times'][:-1], i['chunk_times'][1:])]
+    s = 'Protocol: {}\nMode: {}\n'.format(args.protocol, args.mode)
+    s += 'Load: {}\n'.format('{} concurrent clients'.format(args.concurrency) if args.request_rate == 0 else '{} requests per second'.format(args.request_rate))
+    s += 'RTF: {:.4f}\n'.format(elapsed / total_duration if total_duration != 0 else float('inf'))
+    s += 'total_duration: {:.3f} seconds\n({:.2f} hours)\n'.format(total_duration, total_duration / 3600)
+    s += 'processing time: {:.3f} seconds ({:.2f} hours)\n'.format(elapsed, elapsed / 3600)
+    s += 'requests: {} success: {} busy: {} error: {}\n'.format(len(results), len(success), len(busy), len(results) - len(success) - len(busy))
+    s += 'busy_rate: {:.4f}\nerror_rate: {:.4f}\n'.format(len(busy) / len(results), (len(results) - len(success) - len(busy)) / len(results))
+    s += '\n--- Time To First Byte ---\n' + latency_lines('first_chunk_latency', ttfb)
+    s += '\n--- Inter Chunk Gap ---\n' + latency_lines('inter_chunk_gap', gaps)
+    s += '\n--- Total Request Latency ---\n' + latency_lines('total_request_latency', [i['total_time'] for i in success])
+    s += '\n--- Request RTF ---\n' + latency_lines('rtf', [i['total_time'] / i['audio_len'] for i in success if i['audio_len'] != 0], 1.0, '')
+    return s
+
+
+def start_stub_server():
+    """Run the server of protocol with StubCosyVoice in a subprocess, return it once its port accepts connections."""
+    server = os.path.join(ROOT_DIR, 'fastapi' if args.protocol == 'http' else 'grpc', 'server.py')
+    command = [sys.executable, server, '--port', str(args.port), '--stub', '--max_in_flight', str(args.stub_max_in_flight)]
+    command += ['--max_workers', str(args.stub_workers)] if args.protocol == 'http' else ['--max_conc', str(args.stub_workers), '--metrics_port', '0']
+    process = subprocess.Popen(command)
+    start_time = time.time()
+    while time.time() - start_time < 120:
+        assert process.poll() is None, 'stub server exited with code {}'.format(process.returncode)
+        try:
+            socket.create_connection((args.host, args.port), timeout=1).close()
+            logging.info('stub server ready in {:.2f}s'.format(time.time() - start_time))
+            return process
+        except OSError:
+            time.sleep(0.5)
+    process.terminate()
+    raise TimeoutError('stub server is not ready in 120s')
+
+
+def main():
+    if args.manifest_path != '':
+        items = load_manifest(args.manifest_path)
+        name = os.path.splitext(os.path.basename(args.manifest_path))[0]
+    else:
+        items = [{'utt': 'default', 'prompt_text': args.prompt_text, 'prompt_wav': args.prompt_wav, 'tts_text': args.tts_text}]
+        name = 'results'
+    server = None
+    if args.stub_server is True:
+        from cosyvoice.cli.stub_model import StubCosyVoice
+        args.sample_rate = StubCosyVoice.sample_rate
+        server = start_stub_server()
+    try:
+        start_time = time.time()
+        results = asyncio.run(run(items))
+        elapsed = time.time() - start_time
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    s = summary(results, elapsed)
+    print(s)
+    os.makedirs(args.log_dir, exist_ok=True)
+    with open('{}/rtf-{}-{}.txt'.format(args.log_dir, args.protocol, name), 'w') as f:
+        f.write(s)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--protocol',
+                        default='http',
+                        choices=['http', 'grpc'],
+                        help='http for fastapi server, grpc for grpc server')
+    parser.add_argument('--host',
+                        type=str,
+                        default='127.0.0.1')
+    parser.add_argument('--port',
+                        type=int,
+                        default='50000')
+    parser.add_argument('--mode',
+                        default='sft',
+                        choices=['sft', 'zero_shot', 'cross_lingual', 'instruct', 'instruct2'],
+                        help='request mode')
+    parser.add_argument('--model',
+                        type=str,
+                        default='',
+                        help='registered model name of server, empty means default model')
+    parser.add_argument('--stream',
+                        action='store_true',
+                        help='streaming inference of grpc server, fastapi server returns audio sentence by sentence')
+    parser.add_argument('--priority',
+                        default='interactive',
+                        choices=['interactive', 'batch'],
+                        help='request priority class of server scheduler')
+    parser.add_argument('--concurrency',
+                        type=int,
+                        default=8,
+                        help='number of concurrent clients, used if request_rate is 0')
+    parser.add_argument('--request_rate',
+                        type=float,
+                        default=0,
+                        help='poisson arrival rate in requests per second regardless of responses, 0 means closed loop of concurrency clients')
+    parser.add_argument('--num_requests',
+                        type=int,
+                        default=32)
+    parser.add_argument('--timeout',
+                        type=float,
+                        default=60,
+                        help='seconds of a request before it counts as error')
+    parser.add_argument('--sample_rate',
+                        type=int,
+                        default=22050,
+                        help='server model sample rate, used to compute audio length')
+    parser.add_argument('--manifest_path',
+                        type=str,
+                        default='',
+                        help='utt|prompt_text|prompt_wav|tts_text per line, requests cycle through it, empty means tts_text/prompt_wav args')
+    parser.add_argument('--log_dir',
+                        type=str,
+                        default='./log_load_test',
+                        help='summary is written to log_dir/rtf-<protocol>-<manifest name>.txt')
+    parser.add_argument('--stub_server',
+                        action='store_true',
+                        help='start the server of protocol on port with StubCosyVoice, to test the runtime without pretrained models')
+    parser.add_argument('--stub_workers',
+                        type=int,
+                        default=4,
+                        help='synthesis threads of stub server')
+    parser.add_argument('--stub_max_in_flight',
+                        type=int,
+                        default=8,
+                        help='max running and waiting requests of stub server')
+    parser.add_argument('--tts_text',
+                        type=str,
+                        default='你好，我是通义千问语音合成大模型，请问有什么可以帮您的吗？')
+    parser.add_argument('--spk_id',
+                        type=str,
+                        default='中文女')
+    parser.add_argument('--prompt_text',
+                        type=str,
+                        default='希望你以后能够做的比我还好呦。')
+    parser.add_argument('--prompt_wav',
+                        type=str,
+                        default='../../asset/zero_shot_prompt.wav')
+    parser.add_argument('--instruct_text',
+                        type=str,
+                        default='Theo \'Crimson\', is a fiery, passionate rebel leader. \
+                                 Fights with fervor for justice, but struggles with impulsiveness.')
+    args = parser.parse_args()
+    main()
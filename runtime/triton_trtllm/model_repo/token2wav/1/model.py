@@ -90,7 +90,7 @@ class CosyVoice2Model:
         self.token_hop_len = 25
         self.mel_cache_len = 8
         self.source_cache_len = int(self.mel_cache_len * 480)
-        self.speech_window = np.hamming(2 * self.source_cache_len)
+        self.speech_window = torch.hamming_window(2 * self.source_cache_len, periodic=False, device=self.device)
         self.hift_cache_dict = defaultdict(lambda: None)
 
     def load_jit(self, flow_encoder_model):
@@ -140,7 +140,7 @@ class CosyVoice2Model:
             hift_cache_mel, hift_cache_source = self.hift_cache_dict[uuid]['mel'], self.hift_cache_dict[uuid]['source']
             tts_mel = torch.concat([hift_cache_mel, tts_mel], dim=2)
         else:
-            hift_cache_source = torch.zeros(1, 1, 0)
+            hift_cache_source = torch.zeros(1, 1, 0, device=self.device)
         # keep overlap mel and hift cache
         if finalize is False:
             tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Add duration/sample_rate/num_samples/speech_token_len columns to parquet shards made before tools/make_parquet_list.py wrote them,
+and report the decode work processor.filter saves by rejecting on them before decoding audio_data.
+"""
+import argparse
+import logging
+import os
+import time
+from io import BytesIO
+import multiprocessing
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.compute as pc
+import torchaudio
+from cosyvoice.dataset.processor import METADATA_COLUMNS, arrow_column_values
+from cosyvoice.utils.file_utils import read_lists, audio_metadata
+
+
+def backfill(parquet_file):
+    table = pq.read_table(parquet_file)
+    if all([i in table.schema.names for i in METADATA_COLUMNS]) and args.overwrite is False:
+        return 0
+    metadata_list = [audio_metadata(i) for i in arrow_column_values(table.column('audio_data').combine_chunks())]
+    table = table.drop([i for i in METADATA_COLUMNS if i in table.schema.names])
+    table = table.append_column('duration', pa.array([i['duration'] for i in metadata_list], type=pa.float64()))
+    table = table.append_column('sample_rate', pa.array([i['sample_rate'] for i in metadata_list], type=pa.int64()))
+    table = table.append_column('num_samples', pa.array([i['num_samples'] for i in metadata_list], type=pa.int64()))
+    table = table.append_column('speech_token_len', pc.list_value_length(table.column('speech_token')).cast(pa.int64()).fill_null(0))
+    # NOTE pandas metadata of make_parquet_list.py does not know new columns, write to a temp file so an interrupted run keeps the shard
+    pq.write_table(table.replace_schema_metadata(None), parquet_file + '.tmp')
+    os.replace(parquet_file + '.tmp', parquet_file)
+    return len(metadata_list)
+
+
+def report(parquet_file):
+    """Utts of parquet_file which filter rejects on metadata, with audio bytes, seconds and decode time of them."""
+    table = pq.read_table(parquet_file, columns=['audio_data'] + METADATA_COLUMNS)
+    stats = {'utts': table.num_rows, 'seconds': 0, 'rejected': 0, 'rejected_bytes': 0, 'rejected_seconds': 0, 'decode_seconds': 0}
+    audio_data = arrow_column_values(table.column('audio_data').combine_chunks())
+    columns = [table.column(k).to_pylist() for k in ['duration', 'num_samples', 'sample_rate', 'speech_token_len']]
+    for i, (duration, num_samples, sample_rate, speech_token_len) in enumerate(zip(*columns)):
+        stats['seconds'] += duration
+        num_frames = num_samples / sample_rate * 100
+        if speech_token_len != 0 and (num_samples == 0 or args.min_length <= num_frames <= args.max_length):
+            continue
+        stats['rejected'] += 1
+        stats['rejected_bytes'] += len(audio_data[i])
+        stats['rejected_seconds'] += duration
+        start_time = time.perf_counter()
+        torchaudio.load(BytesIO(audio_data[i]))
+        stats['decode_seconds'] += time.perf_counter() - start_time
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_list',
+                        type=str,
+                        help='data.list of make_parquet_list.py')
+    parser.add_argument('--num_processes',
+                        type=int,
+                        default=1,
+                        help='num processes for backfill')
+    parser.add_argument('--overwrite',
+                        action='store_true',
+                        default=False,
+                        help='recompute metadata of shards which already have it')
+    parser.add_argument('--report',
+                        action='store_true',
+                        default=False,
+                        help='report decode work saved by filter instead of backfill')
+    parser.add_argument('--min_length',
+                        type=float,
+                        default=10,
+                        help='min_length of filter in the training config, in 10ms frames')
+    parser.add_argument('--max_length',
+                        type=float,
+                        default=10240,
+                        help='max_length of filter in the training config, in 10ms frames')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    parquet_list = read_lists(args.data_list)
+    start_time = time.time()
+    with multiprocessing.Pool(processes=args.num_processes) as pool:
+        results = pool.map(report if args.report is True else backfill, parquet_list)
+    if args.report is False:
+        logging.info('backfill {} utts of {} shards, skip {} shards with metadata, spend time {:.2f}s'.format(
+            sum(results), len(parquet_list), len([i for i in results if i == 0]), time.time() - start_time))
+    else:
+        stats = {k: sum([i[k] for i in results]) for k in results[0]}
+        logging.info('{} utts {:.2f}h, filter rejects {} utts ({:.2%}) {:.2f}h {:.1f}MB before decode, '
+                     'saving {:.1f} decode seconds per epoch ({:.2f}ms per rejected utt)'.format(
+                         stats['utts'], stats['seconds'] / 3600, stats['rejected'], stats['rejected'] / max(stats['utts'], 1),
+                         stats['rejected_seconds'] / 3600, stats['rejected_bytes'] / 1024 ** 2, stats['decode_seconds'],
+                         stats['decode_seconds'] / max(stats['rejected'], 1) * 1000))
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Extract speech_feat/pitch_feat of parquet shards into sidecar shards <shard>.feat, loaded by data_pipeline_feat/data_pipeline_gan_feat
+of train.py --precomputed_feat instead of running compute_fbank/compute_f0 every epoch.
+
+features are computed by resample, feat_extractor and compute_f0 settings of the config on whole utts, truncate_feat of gan pipeline crops them.
+--check compares sidecar features with the online path of the config, --benchmark compares samples/s of the online and precomputed pipelines.
+"""
+import argparse
+import logging
+import os
+import time
+import random
+from io import BytesIO
+from itertools import islice
+import multiprocessing
+import pyarrow as pa
+import pyarrow.parquet as pq
+import torch
+import torchaudio
+from hyperpyyaml import load_hyperpyyaml
+from cosyvoice.dataset.dataset import Dataset
+from cosyvoice.dataset.processor import arrow_column_values, extract_f0
+from cosyvoice.utils.file_utils import read_lists
+
+
+def decode(data):
+    """Decode audio_data like filter, without filtering."""
+    for sample in data:
+        sample['speech'], sample['sample_rate'] = torchaudio.load(BytesIO(sample['audio_data']))
+        sample['speech'] = sample['speech'].mean(dim=0, keepdim=True)
+        del sample['audio_data']
+        yield sample
+
+
+def extract(parquet_file):
+    # NOTE one torch thread per process, pyworld is single threaded anyway
+    torch.set_num_threads(1)
+    start_time = time.time()
+    table = pq.read_table(parquet_file, columns=['utt', 'audio_data'])
+    utts = table.column('utt').to_pylist()
+    samples = [{'utt': utt, 'audio_data': audio_data} for utt, audio_data in zip(utts, arrow_column_values(table.column('audio_data').combine_chunks()))]
+    feat_extractor, f0_conf = configs['compute_fbank'].keywords['feat_extractor'], configs['compute_f0'].keywords
+    utt2feat = {}
+    # resample drops utts under its min_sample_rate, they get null features
+    for sample in configs['resample'](decode(samples)):
+        speech_feat = feat_extractor(sample['speech']).squeeze(dim=0).transpose(0, 1)
+        pitch_feat = extract_f0(sample['speech'], f0_conf['sample_rate'], f0_conf['hop_size'], speech_feat.shape[0]) if args.pitch is True else None
+        utt2feat[sample['utt']] = (speech_feat, pitch_feat)
+    table = pa.table({
+        'utt': pa.array(utts, type=pa.string()),
+        'speech_feat': pa.array([utt2feat[i][0].flatten().numpy() if i in utt2feat else None for i in utts], type=pa.list_(pa.float32())),
+        'speech_feat_dim': pa.array([utt2feat[i][0].shape[1] if i in utt2feat else None for i in utts], type=pa.int64()),
+        'pitch_feat': pa.array([utt2feat[i][1].numpy() if i in utt2feat and args.pitch is True else None for i in utts], type=pa.list_(pa.float64())),
+        'feat_sample_rate': pa.array([configs['resample'].keywords['resample_rate']] * len(utts), type=pa.int64()),
+        'feat_hop_size': pa.array([f0_conf['hop_size']] * len(utts), type=pa.int64()),
+    })
+    pq.write_table(table, parquet_file + args.feat_suffix + '.tmp')
+    os.replace(parquet_file + args.feat_suffix + '.tmp', parquet_file + args.feat_suffix)
+    logging.info('extract {}/{} utts of {}, spend time {:.2f}s'.format(len(utt2feat), len(utts), parquet_file, time.time() - start_time))
+    return len(utt2feat)
+
+
+def check(parquet_file, gan=False):
+    """Max abs error between loaded features and features of the online path, of the first args.check utts of parquet_file.
+
+    gan compares truncate, compute_fbank and compute_f0 of data_pipeline_gan with load_feature_gan and truncate_feat of data_pipeline_gan_feat,
+    both truncate with the same random starts, NOTE truncate_feat starts at a multiple of hop_size and pads features instead of speech,
+    so shapes must match but values differ around the start and the padding.
+    """
+    online = list(islice(decode(configs['parquet_opener']([{'src': parquet_file}])), args.check))
+    for sample in online:
+        # NOTE text_token is only asserted by compute_fbank/compute_f0
+        sample['text_token'] = []
+    online = configs['resample'](iter(online))
+    random.seed(args.seed)
+    if gan is True:
+        online = configs['truncate'](online)
+    online = configs['compute_fbank'](online)
+    if args.pitch is True:
+        online = configs['compute_f0'](online)
+    online = list(online)
+    loaded = islice(configs['parquet_opener_feat']([{'src': parquet_file}]), args.check)
+    random.seed(args.seed)
+    if gan is True:
+        loaded = configs['truncate_feat'](configs.get('load_feature_gan', configs['load_feature'])(configs['resample'](decode(loaded))))
+    else:
+        loaded = configs['load_feature'](loaded)
+    loaded = {i['utt']: i for i in loaded}
+    errors = {'speech_feat': 0.0, 'pitch_feat': 0.0, 'speech_token': 0.0}
+    for sample in online:
+        assert sample['utt'] in loaded, 'utt {} has no feature in sidecar of {}'.format(sample['utt'], parquet_file)
+        keys = ['speech_feat', 'pitch_feat', 'speech_token'] if args.pitch is True else ['speech_feat', 'speech_token']
+        for k in keys:
+            online_feat, loaded_feat = torch.as_tensor(sample[k]), torch.as_tensor(loaded[sample['utt']][k])
+            assert online_feat.shape == loaded_feat.shape, \
+                '{} of utt {} has shape {} online, {} loaded'.format(k, sample['utt'], online_feat.shape, loaded_feat.shape)
+            errors[k] = max(errors[k], (online_feat.double() - loaded_feat.double()).abs().max().item() if online_feat.numel() != 0 else 0.0)
+    return errors
+
+
+def benchmark():
+    """Samples/s of one data loader worker, online pipeline against precomputed pipeline."""
+    suffix = '_gan' if args.pitch is True else ''
+    for name in ['data_pipeline' + suffix, 'data_pipeline' + suffix + '_feat']:
+        dataset = Dataset(args.data_list, data_pipeline=list(configs[name]), mode='train', gan=args.pitch, shuffle=False, partition=False)
+        start_time = time.time()
+        num_samples = sum([len(batch['utts']) for batch in dataset])
+        cost = time.time() - start_time
+        logging.info('{} {} samples {:.2f}s {:.1f} samples/s'.format(name, num_samples, cost, num_samples / cost))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config',
+                        type=str,
+                        help='training config')
+    parser.add_argument('--qwen_pretrain_path',
+                        type=str,
+                        default='',
+                        help='qwen pretrain path of cosyvoice2/3 config, only used by tokenize of --benchmark')
+    parser.add_argument('--data_list',
+                        type=str,
+                        help='data.list of make_parquet_list.py')
+    parser.add_argument('--num_processes',
+                        type=int,
+                        default=1,
+                        help='num processes for extraction')
+    parser.add_argument('--feat_suffix',
+                        type=str,
+                        default='.feat',
+                        help='sidecar of a shard, same as feat_suffix of parquet_opener_feat in config')
+    parser.add_argument('--pitch',
+                        action='store_true',
+                        default=False,
+                        help='also extract pitch_feat, which gan training of hift needs')
+    parser.add_argument('--check',
+                        type=int,
+                        default=0,
+                        help='compare first N utts of every shard with the online path instead of extraction')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=1986,
+                        help='random seed of truncate in --check of gan features')
+    parser.add_argument('--benchmark',
+                        action='store_true',
+                        default=False,
+                        help='compare samples/s of online and precomputed pipelines instead of extraction')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    override_dict = {k: None for k in ['llm', 'flow', 'hift', 'hifigan']}
+    try:
+        with open(args.config, 'r') as f:
+            configs = load_hyperpyyaml(f, overrides={**override_dict, 'qwen_pretrain_path': args.qwen_pretrain_path})
+    except Exception:
+        with open(args.config, 'r') as f:
+            configs = load_hyperpyyaml(f, overrides=override_dict)
+    parquet_list = read_lists(args.data_list)
+    if args.benchmark is True:
+        benchmark()
+    elif args.check != 0:
+        for parquet_file in parquet_list:
+            logging.info('{} max abs error of loaded features {}'.format(parquet_file, check(parquet_file)))
+            if args.pitch is True:
+                logging.info('{} max abs error of truncated gan features {}'.format(parquet_file, check(parquet_file, gan=True)))
+    else:
+        start_time = time.time()
+        # Using process pool to speedup
+        with multiprocessing.Pool(processes=args.num_processes) as pool:
+            num_utts = sum(pool.map(extract, parquet_list))
+        logging.info('extract {} utts of {} shards, spend time {:.2f}s'.format(num_utts, len(parquet_list), time.time() - start_time))
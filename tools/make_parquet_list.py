@@ -21,6 +21,7 @@ import pandas as pd
 import multiprocessing
 import time
 import torch
+from cosyvoice.utils.file_utils import audio_metadata
 
 
 def job(utt_list, parquet_file, utt2parquet_file, spk2parquet_file):
@@ -35,6 +36,8 @@ def job(utt_list, parquet_file, utt2parquet_file, spk2parquet_file):
     uttembedding_list = [utt2embedding[utt] for utt in utt_list]
     spkembedding_list = [spk2embedding[utt2spk[utt]] for utt in utt_list]
     speech_token_list = [utt2speech_token.get(utt, []) for utt in utt_list]
+    # NOTE metadata lets processor.filter drop utts by length before decoding audio_data
+    metadata_list = [audio_metadata(data) for data in data_list]
     if args.dpo:
         reject_speech_token_list = [utt2reject_speech_token[utt] for utt in utt_list]
     if args.instruct:
@@ -50,6 +53,10 @@ def job(utt_list, parquet_file, utt2parquet_file, spk2parquet_file):
     df['utt_embedding'] = uttembedding_list
     df['spk_embedding'] = spkembedding_list
     df['speech_token'] = speech_token_list
+    df['duration'] = [i['duration'] for i in metadata_list]
+    df['sample_rate'] = [i['sample_rate'] for i in metadata_list]
+    df['num_samples'] = [i['num_samples'] for i in metadata_list]
+    df['speech_token_len'] = [len(i) for i in speech_token_list]
     if args.dpo:
         df['reject_speech_token'] = reject_speech_token_list
     if args.instruct: